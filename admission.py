@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+准入控制
+
+在 gemini_gateway 发出生成请求（generate_content / send_message）之前按模型限流，
+避免个别用户反复点击“分析图片”等操作耗尽整个项目的Gemini配额：
+- 每个模型（chat、vision、pdf）一个全局令牌桶，对应项目的总配额
+- 每个用户在每个模型上另有一个令牌桶，超出时立即拒绝，不占用等待队列
+- 全局令牌不足时进入有界的优先级等待队列：首次报告分析（pdf 流程）优先于
+  报告追问（report 流程），其余请求居中；队列已满或等待超过 max_wait 时快速拒绝，
+  AdmissionRejected.retry_after 给出建议的重试间隔
+
+业务流程（flow）到模型和优先级的对应关系见 FLOW_KINDS / FLOW_PRIORITIES，
+未列出的流程（files、warmup、compaction 等）不限流。当前用户通过 user_scope() /
+set_user() 设置（Streamlit、Gradio 用浏览器会话ID，API服务用客户端地址或可信网关转发的 X-User-Id），
+未设置用户的调用（命令行、批量分析、分块总结的子请求）只受全局令牌桶限制。
+
+参数来自 system_config.admission；队列长度、排队耗时和拒绝次数计入运行指标。
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from config import config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    'enabled': True,
+    # 每个模型等待队列的最大长度
+    'max_queue': 50,
+    # 在队列中最多等待的秒数
+    'max_wait': 30,
+    # 保留令牌桶的用户数上限（按最近使用淘汰）
+    'max_users': 10000,
+    # rate 为每秒补充的令牌数，burst 为令牌桶容量
+    'models': {
+        'chat': {'rate': 5, 'burst': 10},
+        'vision': {'rate': 2, 'burst': 5},
+        'pdf': {'rate': 2, 'burst': 10},
+    },
+    'per_user': {
+        'chat': {'rate': 0.5, 'burst': 5},
+        'vision': {'rate': 0.2, 'burst': 3},
+        'pdf': {'rate': 0.2, 'burst': 5},
+    },
+}
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = {HIGH: 'high', NORMAL: 'normal', LOW: 'low'}
+
+# 业务流程对应的模型，以及排队时的优先级
+FLOW_KINDS = {'chat': 'chat', 'vision': 'vision', 'pdf': 'pdf', 'report': 'pdf'}
+FLOW_PRIORITIES = {'pdf': HIGH, 'report': LOW}
+# 消耗模型配额、需要准入的SDK方法
+ADMIT_OPS = {'generate_content', 'send_message'}
+
+QUEUE_DEPTH = metrics.gauge('admission_queue_depth', '等待准入的请求数')
+WAIT_SECONDS = metrics.histogram('admission_wait_seconds', '请求获准前的排队耗时',
+                                 buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+REJECTIONS = metrics.counter('admission_rejections_total', '被准入控制拒绝的请求数（按原因）')
+
+_user: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('admission_user', default=None)
+_overrides: Dict[str, Any] = {}
+
+
+class AdmissionRejected(Exception):
+    """请求被准入控制拒绝"""
+
+    REASONS = {
+        'user_rate': '您的请求过于频繁',
+        'queue_full': '当前请求较多',
+        'timeout': '当前请求较多',
+    }
+
+    def __init__(self, kind: str, reason: str, retry_after: float):
+        super().__init__(f"{self.REASONS.get(reason, '当前请求较多')}（{kind}），"
+                         f"请 {max(1, math.ceil(retry_after))} 秒后重试")
+        self.kind = kind
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def configure(**overrides) -> None:
+    """在运行时覆盖配置项（如基准测试中关闭准入控制），传入None表示恢复配置值"""
+    for key, value in overrides.items():
+        if value is None:
+            _overrides.pop(key, None)
+        else:
+            _overrides[key] = value
+    admission_control.reset()
+
+
+def get_options() -> Dict[str, Any]:
+    """获取合并默认值后的准入控制参数（models、per_user 按模型合并）"""
+    options = dict(DEFAULT_OPTIONS)
+    configured = dict(config.get_admission_config())
+    configured.update(_overrides)
+    for key in ('models', 'per_user'):
+        merged = {kind: dict(limits) for kind, limits in DEFAULT_OPTIONS[key].items()}
+        for kind, limits in configured.pop(key, {}).items():
+            merged.setdefault(kind, {}).update(limits)
+        options[key] = merged
+    options.update(configured)
+    return options
+
+
+def set_user(user_id: Optional[str]) -> contextvars.Token:
+    """设置当前上下文的用户（如Streamlit每次重跑时设置会话ID）"""
+    return _user.set(user_id)
+
+
+def get_user() -> Optional[str]:
+    return _user.get()
+
+
+@contextmanager
+def user_scope(user_id: Optional[str]) -> Iterator[None]:
+    """在代码块内以 user_id 的身份发出请求"""
+    token = _user.set(user_id)
+    try:
+        yield
+    finally:
+        _user.reset(token)
+
+
+def iterate_as(user_id: Optional[str], iterable: Iterable[Any]) -> Iterator[Any]:
+    """逐步迭代生成器，每一步都在 user_id 的上下文中执行（Gradio 的每一步可能在不同线程中执行）"""
+    iterator = iter(iterable)
+    while True:
+        with user_scope(user_id):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class TokenBucket:
+    """令牌桶（非线程安全，由调用方加锁）"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """取一个令牌，成功返回0，否则返回距离下一个令牌可用的秒数"""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.burst
+
+
+class _Waiter:
+    __slots__ = ('priority', 'seq', 'enqueued_at', 'admitted')
+
+    def __init__(self, priority: int, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.admitted = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class ModelGate:
+    """单个模型的准入控制：全局令牌桶、按用户的令牌桶和有界优先级等待队列"""
+
+    def __init__(self, kind: str, options: Dict[str, Any]):
+        self.kind = kind
+        limits = options['models'].get(kind, {})
+        self.rate = float(limits.get('rate', 0))
+        self.bucket = TokenBucket(self.rate, limits.get('burst', 1))
+        self.user_limits = options['per_user'].get(kind)
+        self.max_queue = int(options['max_queue'])
+        self.max_wait = float(options['max_wait'])
+        self.max_users = int(options['max_users'])
+        self._lock = threading.Lock()
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._users: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def _reject(self, reason: str, retry_after: float) -> AdmissionRejected:
+        REJECTIONS.inc(model=self.kind, reason=reason)
+        logger.warning(f"准入控制拒绝请求：{self.kind}，原因 {reason}，建议 {retry_after:.1f} 秒后重试")
+        return AdmissionRejected(self.kind, reason, retry_after)
+
+    def _take_user_token(self, user: Optional[str], now: float) -> None:
+        """按用户限流，超出时立即拒绝"""
+        if user is None or not self.user_limits:
+            return
+        bucket = self._users.get(user)
+        if bucket is None:
+            bucket = self._users[user] = TokenBucket(self.user_limits.get('rate', 0),
+                                                     self.user_limits.get('burst', 1))
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        self._users.move_to_end(user)
+        wait = bucket.take(now)
+        if wait > 0:
+            raise self._reject('user_rate', wait)
+
+    def _queue_wait_estimate(self) -> float:
+        return (len(self._queue) + 1) / self.rate if self.rate > 0 else self.max_wait
+
+    def _enter(self, user: Optional[str], priority: int) -> Optional[_Waiter]:
+        """检查用户令牌；全局令牌充足且无人排队时直接放行（返回None），否则进入等待队列"""
+        now = time.monotonic()
+        with self._lock:
+            self._take_user_token(user, now)
+            if not self._queue and self.bucket.take(now) == 0:
+                WAIT_SECONDS.observe(0.0, model=self.kind, priority=PRIORITY_NAMES[priority])
+                return None
+            if len(self._queue) >= self.max_queue:
+                raise self._reject('queue_full', self._queue_wait_estimate())
+            waiter = _Waiter(priority, next(self._seq))
+            heapq.heappush(self._queue, waiter)
+            QUEUE_DEPTH.set(len(self._queue), model=self.kind)
+            return waiter
+
+    def _poll(self, waiter: _Waiter) -> float:
+        """排在队首且有令牌时获准（返回0），否则返回建议的等待秒数；等待超时则拒绝"""
+        now = time.monotonic()
+        with self._lock:
+            if self._queue and self._queue[0] is waiter:
+                wait = self.bucket.take(now)
+                if wait == 0:
+                    heapq.heappop(self._queue)
+                    waiter.admitted = True
+                    QUEUE_DEPTH.set(len(self._queue), model=self.kind)
+                    WAIT_SECONDS.observe(now - waiter.enqueued_at, model=self.kind,
+                                         priority=PRIORITY_NAMES[waiter.priority])
+                    return 0.0
+            else:
+                wait = 1 / self.rate if self.rate > 0 else 0.1
+            if now - waiter.enqueued_at + wait > self.max_wait:
+                self._queue.remove(waiter)
+                heapq.heapify(self._queue)
+                QUEUE_DEPTH.set(len(self._queue), model=self.kind)
+                raise self._reject('timeout', self._queue_wait_estimate())
+            # 排在后面的请求也要及时察觉前面的请求已离开队列
+            return min(max(wait, 0.005), 0.1)
+
+    def acquire(self, user: Optional[str], priority: int = NORMAL) -> None:
+        """
+        等待准入（阻塞当前线程）
+        :raises AdmissionRejected: 用户超限、队列已满或排队超时
+        """
+        waiter = self._enter(user, priority)
+        while waiter is not None:
+            wait = self._poll(waiter)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, user: Optional[str], priority: int = NORMAL) -> None:
+        """acquire() 的异步版本，排队时不阻塞事件循环"""
+        waiter = self._enter(user, priority)
+        while waiter is not None:
+            wait = self._poll(waiter)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'queue_depth': len(self._queue), 'tokens': round(self.bucket.tokens, 2),
+                    'users': len(self._users)}
+
+
+class AdmissionController:
+    """按业务流程选择模型和优先级，交给对应的 ModelGate"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._gates: Dict[str, ModelGate] = {}
+
+    def reset(self) -> None:
+        """丢弃现有的令牌桶和队列（配置变更后调用）"""
+        with self._lock:
+            self._gates = {}
+
+    def _gate(self, flow: str, op: str) -> Optional[ModelGate]:
+        kind = FLOW_KINDS.get(flow)
+        if kind is None or op not in ADMIT_OPS:
+            return None
+        options = get_options()
+        if not options['enabled'] or kind not in options['models']:
+            return None
+        with self._lock:
+            gate = self._gates.get(kind)
+            if gate is None:
+                gate = self._gates[kind] = ModelGate(kind, options)
+            return gate
+
+    def admit(self, flow: str, op: str) -> None:
+        """
+        发出请求前调用，必要时排队等待
+        :raises AdmissionRejected: 请求被拒绝
+        """
+        gate = self._gate(flow, op)
+        if gate is not None:
+            gate.acquire(_user.get(), FLOW_PRIORITIES.get(flow, NORMAL))
+
+    async def admit_async(self, flow: str, op: str) -> None:
+        """admit() 的异步版本"""
+        gate = self._gate(flow, op)
+        if gate is not None:
+            await gate.acquire_async(_user.get(), FLOW_PRIORITIES.get(flow, NORMAL))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            gates = dict(self._gates)
+        return {kind: gate.stats() for kind, gate in gates.items()}
+
+
+# 创建全局准入控制实例
+admission_control = AdmissionController()
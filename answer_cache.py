@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+普通对话答案缓存
+
+以规范化后的问题文本加上提示词/模型/生成参数指纹为键缓存模型回答，重复的常见问题
+（如“CA19-9 是什么”）直接返回缓存结果，不再占用API配额。只有会话首轮（没有历史上下文）
+的问答会被查询和写入，后续提问的回答依赖上下文，不能共享。缓存默认关闭，由
+system_config.answer_cache 开启，支持TTL和按条目数的LRU淘汰，并持久化到缓存目录。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 问题末尾可忽略的标点
+_TRAILING_PUNCTUATION = '?？!！。.～~'
+
+
+class AnswerCache:
+    """普通对话答案缓存类"""
+
+    INDEX_FILENAME = 'answer_cache.json'
+
+    def __init__(self, cache_path: Optional[str] = None, enabled: Optional[bool] = None,
+                 ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        """
+        初始化答案缓存
+        :param cache_path: 持久化目录，默认使用 config.get_cache_path()
+        :param enabled: 是否启用，默认读取 answer_cache.enabled
+        :param ttl: 条目有效期（秒）
+        :param max_entries: 最多保留的条目数
+        """
+        cache_config = config.get_answer_cache_config()
+        self.enabled = bool(enabled if enabled is not None else cache_config.get('enabled', False))
+        self.ttl = float(ttl if ttl is not None else cache_config.get('ttl', 86400))
+        self.max_entries = int(max_entries if max_entries is not None else cache_config.get('max_entries', 500))
+        self.cache_path = cache_path or config.get_cache_path()
+        self.index_path = os.path.join(self.cache_path, self.INDEX_FILENAME)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = self._load() if self.enabled else OrderedDict()
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        """规范化问题文本：全半角统一、去除多余空白和末尾标点、忽略大小写"""
+        text = unicodedata.normalize('NFKC', question).strip().lower()
+        text = re.sub(r'\s+', ' ', text)
+        return text.rstrip(_TRAILING_PUNCTUATION).strip()
+
+    @staticmethod
+    def fingerprint(*parts: Any) -> str:
+        """根据提示词、模型名称和生成参数等计算指纹，任一变化都会使旧答案失效"""
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+    def _make_key(self, question: str, fingerprint: str) -> str:
+        normalized = self.normalize_question(question)
+        return hashlib.sha256(f"{fingerprint}\n{normalized}".encode('utf-8')).hexdigest()
+
+    def get(self, question: str, fingerprint: str) -> Optional[str]:
+        """
+        查询缓存的答案
+        :return: 命中且未过期时返回答案，否则返回None
+        """
+        if not self.enabled:
+            return None
+        key = self._make_key(question, fingerprint)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['created_at'] + self.ttl > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry['answer']
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, question: str, fingerprint: str, answer: str) -> None:
+        """写入答案并持久化"""
+        if not self.enabled or not answer:
+            return
+        key = self._make_key(question, fingerprint)
+        with self._lock:
+            self._entries[key] = {'answer': answer, 'created_at': time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._save()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def _load(self) -> "OrderedDict[str, Dict[str, Any]]":
+        """从磁盘加载未过期的条目"""
+        if not os.path.exists(self.index_path):
+            return OrderedDict()
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            now = time.time()
+            loaded = OrderedDict((k, v) for k, v in entries.items() if v['created_at'] + self.ttl > now)
+            logger.info(f"已加载答案缓存，共 {len(loaded)} 条")
+            return loaded
+        except Exception as e:
+            logger.error(f"加载答案缓存失败: {e}")
+            return OrderedDict()
+
+    def _save(self) -> None:
+        """原子写入缓存文件（按LRU顺序保存）"""
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.error(f"保存答案缓存失败: {e}")
+
+
+# 创建全局答案缓存实例
+answer_cache = AnswerCache()
@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+"""
+异步HTTP API服务
+
+把对话、图片分析、报告上传/问答和文件管理以JSON接口提供给移动端、微信小程序等前端：
+
+    POST   /chat                          普通对话（history 由客户端保存并随请求发送）
+    POST   /images                        上传图片并分析（multipart：file、image_type、message）
+    POST   /images/{image_id}/messages    针对已上传图片继续提问
+    POST   /reports                       上传PDF报告（multipart：file），提交后台分析任务
+    POST   /reports/url                   按URL下载PDF报告并提交分析任务
+    GET    /reports/{report_id}           查询分析进度和概要总结
+    POST   /reports/{report_id}/questions 针对报告提问
+    GET    /files                         已上传文件列表（分页）*
+    DELETE /files/{display_name}          删除文件*
+    POST   /files/clear-cache             清理缓存*
+    GET    /metrics                       本进程的运行指标（Prometheus文本格式）
+
+模型调用使用SDK的异步方法（generate_content_async / send_message_async），经由
+gemini_gateway.call_async 统一重试和记录指标；上传文件、缓存管理等没有异步接口的操作
+在线程池中执行。下载报告URL使用进程内共享的 httpx.AsyncClient 连接池；只允许http(s)，
+目标地址（包括每次重定向后的地址）解析到内网、回环等非公网地址时拒绝，
+system_config.api_server.url_allow_hosts 不为空时只允许列出的域名及其子域名。
+
+接口本身不保存会话状态：对话历史由客户端携带，图片和报告以内容SHA-256为ID，
+任何一个worker都能通过共享的上传目录和PDF去重缓存找到，因此可以用多个uvicorn worker启动：
+
+    python api_server.py
+    uvicorn api_server:app --host 0.0.0.0 --port 8000 --workers 4
+
+默认只监听本机地址。标*的文件管理接口需要在 Authorization 请求头中携带 Bearer 接口密钥
+（环境变量 API_SERVER_KEYS，逗号分隔，可放在 .env 中）；未配置接口密钥时只允许本机直接访问。
+
+请求按客户端地址限流；部署在完成登录校验的网关之后时，把网关地址加入
+system_config.api_server.trusted_proxies，来自网关的请求改按其转发的 X-User-Id 限流。
+被准入控制拒绝时返回429和Retry-After，见 admission.py。监听地址、worker数、连接池大小和上传限制来自 system_config.api_server。
+"""
+import asyncio
+import hmac
+import ipaddress
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import Depends, FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel
+
+import gemini_gateway
+from admission import AdmissionRejected, user_scope
+from answer_cache import answer_cache
+from config import config
+from image_session import image_files
+from mange_filelist import clear_all_cache, count_files, delete_file, find_file, list_all_files
+from metrics import metrics
+from model_registry import init_models, model_registry
+from pdf_cache import pdf_cache
+from report_jobs import report_jobs
+from report_session import ReportSession
+from resilience import CircuitOpenError
+from upload_store import CHUNK_SIZE, upload_store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    'host': '127.0.0.1',
+    'port': 8000,
+    'workers': 4,
+    # 共享 httpx.AsyncClient 连接池的大小
+    'max_connections': 100,
+    'max_keepalive_connections': 20,
+    'download_timeout': 60,
+    'max_upload_mb': 50,
+    # 报告URL允许的域名（含子域名），为空时允许任意公网地址
+    'url_allow_hosts': [],
+    'max_redirects': 5,
+    # 每个worker保留的报告句柄数和闲置时长（秒）
+    'max_reports': 200,
+    'report_idle_timeout': 1800,
+    # 可信的反向代理/网关地址（IP或网段），只有来自这些地址的请求才按 X-User-Id 限流
+    'trusted_proxies': [],
+    # 文件管理接口的密钥（逗号分隔）所在的环境变量
+    'api_key_env': 'API_SERVER_KEYS',
+}
+
+
+def get_options() -> Dict[str, Any]:
+    """获取合并默认值后的服务参数"""
+    options = dict(DEFAULT_OPTIONS)
+    options.update(config.get_api_server_config())
+    return options
+
+
+class ChatMessage(BaseModel):
+    role: str
+    content: str
+
+
+class ChatRequest(BaseModel):
+    message: str
+    history: List[ChatMessage] = []
+
+
+class ImageMessageRequest(BaseModel):
+    image_type: str
+    message: str
+    # 首轮分析之后的对话（含首轮分析结果）
+    history: List[ChatMessage] = []
+
+
+class ReportUrlRequest(BaseModel):
+    url: str
+
+
+class QuestionRequest(BaseModel):
+    question: str
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """每个worker启动时构建模型并创建共享的HTTP连接池"""
+    options = get_options()
+    await asyncio.to_thread(init_models)
+    app.state.http = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=int(options['max_connections']),
+                            max_keepalive_connections=int(options['max_keepalive_connections'])),
+        timeout=float(options['download_timeout']),
+        # 重定向由 upload_report_url 逐跳检查后再跟随
+        follow_redirects=False,
+        # 下载直接连接检查过的IP地址，不经过环境变量中配置的代理（代理会重新解析域名）
+        trust_env=False,
+    )
+    logger.info("API服务已启动")
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(title="小胰宝 API", lifespan=lifespan)
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, error: CircuitOpenError) -> JSONResponse:
+    return JSONResponse(status_code=503, content={'detail': str(error)},
+                        headers={'Retry-After': str(int(error.retry_after))})
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, error: AdmissionRejected) -> JSONResponse:
+    return JSONResponse(status_code=429, content={'detail': str(error)},
+                        headers={'Retry-After': str(max(1, math.ceil(error.retry_after)))})
+
+
+def _from_trusted_proxy(client_host: Optional[str], trusted_proxies: List[str]) -> bool:
+    """客户端地址是否属于 trusted_proxies 中列出的地址或网段"""
+    try:
+        address = ipaddress.ip_address(client_host or '')
+    except ValueError:
+        return False
+    for proxy in trusted_proxies:
+        try:
+            if address in ipaddress.ip_network(proxy, strict=False):
+                return True
+        except ValueError:
+            logger.warning(f"trusted_proxies 中的地址无效：{proxy}")
+    return False
+
+
+def _request_user(request: Request) -> Optional[str]:
+    """
+    准入控制的用户：默认按客户端地址，客户端可以随意设置的 X-User-Id 不可信；
+    只有来自 trusted_proxies 的请求（由网关完成登录校验后转发）才采用 X-User-Id，
+    没有时采用 X-Forwarded-For 中代理记录的最后一个地址
+    """
+    client_host = request.client.host if request.client else None
+    if not _from_trusted_proxy(client_host, get_options()['trusted_proxies']):
+        return client_host
+    forwarded_for = [h.strip() for h in request.headers.get('x-forwarded-for', '').split(',') if h.strip()]
+    return request.headers.get('x-user-id') or (forwarded_for[-1] if forwarded_for else client_host)
+
+
+@app.middleware("http")
+async def bind_user(request: Request, call_next):
+    """按 _request_user() 绑定准入控制的用户"""
+    with user_scope(_request_user(request)):
+        return await call_next(request)
+
+
+@app.exception_handler(ValueError)
+async def value_error_handler(request: Request, error: ValueError) -> JSONResponse:
+    return JSONResponse(status_code=400, content={'detail': str(error)})
+
+
+def _is_local_request(request: Request) -> bool:
+    """请求是否直接来自本机（经反向代理转发的请求不算）"""
+    if any(h in request.headers for h in ('forwarded', 'x-forwarded-for', 'x-real-ip')):
+        return False
+    try:
+        return request.client is not None and ipaddress.ip_address(request.client.host).is_loopback
+    except ValueError:
+        return False
+
+
+def require_api_key(request: Request) -> None:
+    """
+    文件管理接口的访问控制：配置了接口密钥时要求 Authorization: Bearer <密钥>，
+    未配置时只允许本机直接访问
+    """
+    keys = [k.strip() for k in os.getenv(get_options()['api_key_env'] or '', '').split(',') if k.strip()]
+    if not keys:
+        if not _is_local_request(request):
+            raise HTTPException(status_code=403, detail="未配置接口密钥，文件管理接口只允许本机访问")
+        return
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    token = token.strip().encode('utf-8')
+    if scheme.lower() != 'bearer' or not any(hmac.compare_digest(token, key.encode('utf-8')) for key in keys):
+        raise HTTPException(status_code=401, detail="接口密钥无效", headers={'WWW-Authenticate': 'Bearer'})
+
+
+def _to_history(messages: List[ChatMessage]) -> List[Dict[str, Any]]:
+    """客户端的 {role, content} 转为SDK的对话历史"""
+    return [{'role': 'model' if m.role in ('assistant', 'model') else 'user', 'parts': [m.content]}
+            for m in messages]
+
+
+def _check_size(upload: UploadFile) -> None:
+    limit = int(get_options()['max_upload_mb']) * 1024 * 1024
+    if upload.size is not None and upload.size > limit:
+        raise HTTPException(status_code=413, detail=f"文件超过 {limit // (1024 * 1024)}MB 限制")
+
+
+def _image_config(image_type: str) -> Dict[str, Any]:
+    image_config = config.get_image_type_prompt(image_type)
+    if image_config is None:
+        raise ValueError(f"不支持的图片类型: {image_type}")
+    return image_config
+
+
+@app.get("/health")
+async def health() -> Dict[str, str]:
+    return {'status': 'ok'}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    return metrics.render_prometheus()
+
+
+# --- 对话 ---
+
+@app.post("/chat")
+async def chat(request: ChatRequest) -> Dict[str, Any]:
+    """普通对话，首轮问题优先查询答案缓存"""
+    if not request.message:
+        raise ValueError("消息不能为空")
+    fingerprint = answer_cache.fingerprint(config.get_prompts()['chat'], config.get_model_config().get('chat', {}))
+    if not request.history:
+        cached_answer = answer_cache.get(request.message, fingerprint)
+        if cached_answer is not None:
+            return {'answer': cached_answer, 'cached': True}
+
+    session = model_registry.get('chat').start_chat(history=_to_history(request.history))
+    response = await gemini_gateway.call_async("chat", session.send_message_async, request.message)
+    if not request.history:
+        await asyncio.to_thread(answer_cache.put, request.message, fingerprint, response.text)
+    return {'answer': response.text, 'cached': False}
+
+
+# --- 图片分析 ---
+
+@app.post("/images")
+async def analyze_image(file: UploadFile = File(...), image_type: str = Form(...),
+                        message: str = Form("")) -> Dict[str, Any]:
+    """上传图片并进行首轮分析，返回图片ID（内容SHA-256）供后续提问使用"""
+    image_config = _image_config(image_type)
+    _check_size(file)
+    stored = await asyncio.to_thread(upload_store.save_stream, file.file, file.filename or 'image',
+                                     file.content_type)
+    remote = await asyncio.to_thread(image_files.get_or_upload, stored.path, image_config['mime_type'],
+                                     image_type, stored.sha256)
+    response = await gemini_gateway.call_async("vision", model_registry.get('vision').generate_content_async,
+                                               [remote, message or image_config['system_prompt']])
+    return {'image_id': stored.sha256, 'answer': response.text}
+
+
+@app.post("/images/{image_id}/messages")
+async def image_message(image_id: str, request: ImageMessageRequest) -> Dict[str, Any]:
+    """针对已上传的图片继续提问，图片以远程文件引用放在对话开头"""
+    image_config = _image_config(request.image_type)
+    stored = await asyncio.to_thread(upload_store.get, image_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="图片不存在，请重新上传")
+    remote = await asyncio.to_thread(image_files.get_or_upload, stored.path, image_config['mime_type'],
+                                     request.image_type, stored.sha256)
+    history = [{'role': 'user', 'parts': [remote, image_config['system_prompt']]}] + _to_history(request.history)
+    session = model_registry.get('vision').start_chat(history=history)
+    response = await gemini_gateway.call_async("vision", session.send_message_async, request.message)
+    return {'image_id': image_id, 'answer': response.text}
+
+
+# --- 报告分析 ---
+
+# 本进程中已打开的报告句柄（按报告ID，最近使用的在最后）及其最近使用时间；
+# 超过 max_reports 个或闲置超过 report_idle_timeout 秒时丢弃，再次提问时通过去重缓存重新打开
+_reports: "OrderedDict[str, Tuple[ReportSession, float]]" = OrderedDict()
+_reports_lock = threading.Lock()
+
+
+def _cached_report(report_id: str) -> Optional[ReportSession]:
+    """取本进程中已打开的报告句柄，顺便清理闲置的句柄"""
+    idle_timeout = float(get_options()['report_idle_timeout'])
+    now = time.time()
+    with _reports_lock:
+        for key in [k for k, (_, last_access) in _reports.items() if now - last_access > idle_timeout]:
+            del _reports[key]
+        item = _reports.get(report_id)
+        if item is None:
+            return None
+        _reports[report_id] = (item[0], now)
+        _reports.move_to_end(report_id)
+        return item[0]
+
+
+def _keep_report(report_id: str, report: ReportSession) -> None:
+    max_reports = int(get_options()['max_reports'])
+    with _reports_lock:
+        _reports[report_id] = (report, time.time())
+        _reports.move_to_end(report_id)
+        while len(_reports) > max_reports:
+            _reports.popitem(last=False)
+
+
+def _report_status(report_id: str) -> Optional[Dict[str, Any]]:
+    """
+    查询报告状态：先查本进程的任务，再查各worker共享的PDF去重缓存
+    上传过但还没有结果（可能在其他worker中处理）时返回 pending
+    """
+    job = report_jobs.find(report_id)
+    if job is not None:
+        return dict(job.to_dict(), report_id=report_id)
+    entry = pdf_cache.get(report_id)
+    if entry is not None and entry.get('summary'):
+        return {'report_id': report_id, 'state': 'done', 'summary': entry['summary']}
+    if upload_store.get(report_id) is not None:
+        return {'report_id': report_id, 'state': 'pending', 'summary': None}
+    return None
+
+
+def _open_report(report_id: str) -> Optional[ReportSession]:
+    """获取报告句柄；由其他worker分析的报告通过去重缓存打开（不重新分析）"""
+    report = _cached_report(report_id)
+    if report is not None:
+        return report
+    job = report_jobs.find(report_id)
+    if job is not None:
+        report = job.report
+    else:
+        entry = pdf_cache.get(report_id)
+        stored = upload_store.get(report_id)
+        if entry is None or stored is None:
+            return None
+        report = ReportSession.open(stored.path)
+    if report is not None:
+        _keep_report(report_id, report)
+    return report
+
+
+def _submit_report(stored) -> Dict[str, Any]:
+    job = report_jobs.submit(stored.path)
+    return dict(job.to_dict(), report_id=stored.sha256)
+
+
+@app.post("/reports", status_code=202)
+async def upload_report(file: UploadFile = File(...)) -> Dict[str, Any]:
+    """上传PDF报告并提交后台分析任务，同一份报告重复提交时返回已有任务"""
+    _check_size(file)
+    stored = await asyncio.to_thread(upload_store.save_stream, file.file, file.filename or 'report.pdf',
+                                     'application/pdf')
+    return await asyncio.to_thread(_submit_report, stored)
+
+
+async def _check_download_url(url: httpx.URL, options: Dict[str, Any]) -> str:
+    """
+    检查报告URL是否允许下载，防止借服务端访问内网或云元数据地址
+    :return: 检查通过的IP地址，下载时直接连接该地址，避免再次解析时被DNS重绑定到内网
+    :raises ValueError: 非http(s)、不在允许的域名中，或解析到非公网地址
+    """
+    if url.scheme not in ('http', 'https') or not url.host:
+        raise ValueError("报告URL只支持 http/https")
+    host = url.host.lower().rstrip('.')
+    allow_hosts = [h.lower().rstrip('.') for h in options.get('url_allow_hosts') or []]
+    if allow_hosts and not any(host == h or host.endswith('.' + h) for h in allow_hosts):
+        raise ValueError(f"不允许从该地址下载报告：{host}")
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, url.port or (443 if url.scheme == 'https' else 80))
+    except OSError as e:
+        raise ValueError(f"无法解析报告地址：{host}") from e
+    addresses = [ipaddress.ip_address(info[4][0].split('%', 1)[0]) for info in infos]
+    for address in addresses:
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"不允许从内网地址下载报告：{host}")
+    if not addresses:
+        raise ValueError(f"无法解析报告地址：{host}")
+    return str(addresses[0])
+
+
+@app.post("/reports/url", status_code=202)
+async def upload_report_url(request: ReportUrlRequest, http_request: Request) -> Dict[str, Any]:
+    """通过共享连接池下载PDF报告后提交分析任务（逐跳检查重定向地址）"""
+    options = get_options()
+    limit = int(options['max_upload_mb']) * 1024 * 1024
+    client: httpx.AsyncClient = http_request.app.state.http
+    buffer = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE * 8)
+    try:
+        size = 0
+        url = httpx.URL(request.url)
+        for _ in range(int(options['max_redirects']) + 1):
+            address = await _check_download_url(url, options)
+            # 连接检查过的地址，Host请求头和TLS的SNI/证书校验仍使用原域名
+            async with client.stream('GET', url.copy_with(host=address), headers={'Host': url.netloc.decode('ascii')},
+                                     extensions={'sni_hostname': url.host}) as response:
+                if response.is_redirect:
+                    url = url.join(response.headers['location'])
+                    continue
+                if response.status_code >= 400:
+                    raise HTTPException(status_code=502, detail=f"下载报告失败：HTTP {response.status_code}")
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > limit:
+                        raise HTTPException(status_code=413, detail=f"文件超过 {limit // (1024 * 1024)}MB 限制")
+                    buffer.write(chunk)
+                break
+        else:
+            raise HTTPException(status_code=502, detail="下载报告失败：重定向次数过多")
+        buffer.seek(0)
+        name = url.path.rsplit('/', 1)[-1] or 'report.pdf'
+        stored = await asyncio.to_thread(upload_store.save_stream, buffer, name, 'application/pdf')
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"下载报告失败：{e}")
+    finally:
+        buffer.close()
+    return await asyncio.to_thread(_submit_report, stored)
+
+
+@app.get("/reports/{report_id}")
+async def report_status(report_id: str) -> Dict[str, Any]:
+    """查询报告分析进度，客户端可每秒轮询一次"""
+    status = await asyncio.to_thread(_report_status, report_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="报告不存在，请重新上传")
+    return status
+
+
+@app.post("/reports/{report_id}/questions")
+async def report_question(report_id: str, request: QuestionRequest) -> Dict[str, Any]:
+    """针对已分析完成的报告提问，只发送问题本身"""
+    report = await asyncio.to_thread(_open_report, report_id)
+    if report is None:
+        status = await asyncio.to_thread(_report_status, report_id)
+        if status is not None and status['state'] != 'failed':
+            raise HTTPException(status_code=409, detail="报告仍在分析中，请稍候再提问")
+        raise HTTPException(status_code=404, detail="报告不存在或分析失败，请重新上传")
+    answer = await report.ask_async(request.question)
+    return {'report_id': report_id, 'answer': answer}
+
+
+# --- 文件管理 ---
+
+@app.get("/files", dependencies=[Depends(require_api_key)])
+async def list_files(page: int = 1, refresh: bool = False) -> Dict[str, Any]:
+    """已上传文件列表（读取本地文件索引，按页返回）"""
+    page_size = int(config.get_file_inventory_config().get('page_size', 50))
+    page = max(1, page)
+    files = await asyncio.to_thread(list_all_files, refresh, (page - 1) * page_size, page_size, False)
+    total = await asyncio.to_thread(count_files)
+    return {
+        'total': total,
+        'page': page,
+        'page_size': page_size,
+        'files': [{'name': file.name, 'display_name': file.display_name, 'uri': file.uri, 'type': file_type}
+                  for file_type, file in files],
+    }
+
+
+@app.delete("/files/{display_name}", dependencies=[Depends(require_api_key)])
+async def remove_file(display_name: str) -> Dict[str, Any]:
+    found = await asyncio.to_thread(find_file, display_name)
+    if not found:
+        raise HTTPException(status_code=404, detail=f"未找到文件：{display_name}")
+    if not await asyncio.to_thread(delete_file, *found):
+        raise HTTPException(status_code=502, detail=f"删除文件失败：{display_name}")
+    return {'deleted': display_name}
+
+
+@app.post("/files/clear-cache", dependencies=[Depends(require_api_key)])
+async def clear_cache() -> Dict[str, Any]:
+    if not await asyncio.to_thread(clear_all_cache):
+        raise HTTPException(status_code=502, detail="清理缓存失败")
+    return {'cleared': True}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    options = get_options()
+    uvicorn.run("api_server:app", host=options['host'], port=int(options['port']),
+                workers=int(options['workers']))
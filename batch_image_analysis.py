@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+批量图片分析
+
+非交互地分析一个目录（或glob匹配）下的全部图片，以有界并发调用 main.analyze_image，
+结果逐行写入JSONL。已完成的文件记录在清单文件中，中断后重新运行会自动跳过。
+
+用法：
+    python batch_image_analysis.py uploads/patient_001 --type CT --concurrency 4 --output ct_results.jsonl
+    python batch_image_analysis.py "scans/**/*.png" --type MRI
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Set
+
+from config import config
+from genai_backend import configure_genai
+import main
+from metrics import register_json_dump
+from model_registry import model_registry
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def collect_images(target: str) -> List[str]:
+    """收集目录下或glob匹配的图片路径（按路径排序）"""
+    if os.path.isdir(target):
+        paths = [os.path.join(root, name) for root, _, names in os.walk(target) for name in names]
+    else:
+        paths = glob.glob(target, recursive=True)
+    return sorted(p for p in paths if p.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(p))
+
+
+def load_manifest(manifest_path: str) -> Set[str]:
+    """读取已完成文件的清单"""
+    if not os.path.exists(manifest_path):
+        return set()
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def run_batch(target: str, image_type: str, concurrency: int, output_path: str, manifest_path: str) -> dict:
+    """
+    执行批量分析
+    :return: 统计信息
+    """
+    images = collect_images(target)
+    finished = load_manifest(manifest_path)
+    pending = [p for p in images if os.path.abspath(p) not in finished]
+    print(f"共 {len(images)} 张图片，已完成 {len(images) - len(pending)} 张，待分析 {len(pending)} 张")
+
+    model = model_registry.get('vision')
+    write_lock = threading.Lock()
+    latencies = []
+    failed = 0
+
+    def analyze(path: str) -> dict:
+        start = time.perf_counter()
+        # 每张图片使用独立会话，互不影响上下文
+        result = main.analyze_image(path, image_type, session=model.start_chat(history=[]))
+        result['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        return result
+
+    wall_start = time.perf_counter()
+    with open(output_path, 'a', encoding='utf-8') as output, \
+            open(manifest_path, 'a', encoding='utf-8') as manifest, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch-image') as pool:
+        futures = {pool.submit(analyze, path): path for path in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"success": False, "error": str(e), "latency_ms": None}
+            record = {"path": os.path.abspath(path), "image_type": image_type, **result}
+            with write_lock:
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                if result["success"]:
+                    manifest.write(record["path"] + "\n")
+                    manifest.flush()
+                    latencies.append(result["latency_ms"])
+                else:
+                    failed += 1
+            status = "完成" if result["success"] else f"失败：{result['error']}"
+            print(f"[{done}/{len(pending)}] {path} {status}")
+    wall = time.perf_counter() - wall_start
+
+    return {
+        "total": len(images),
+        "skipped": len(images) - len(pending),
+        "succeeded": len(latencies),
+        "failed": failed,
+        "wall_seconds": round(wall, 2),
+        "images_per_second": round(len(pending) / wall, 2) if pending and wall else 0.0,
+        "median_latency_ms": round(statistics.median(latencies), 1) if latencies else 0.0,
+    }
+
+
+def main_cli() -> None:
+    image_types = list(config.get_image_types().keys())
+    parser = argparse.ArgumentParser(description="批量分析目录或glob匹配的医学图片")
+    parser.add_argument('target', help='图片目录或glob模式')
+    parser.add_argument('--type', dest='image_type', required=True, choices=image_types, help='图片类型')
+    parser.add_argument('--concurrency', type=int, default=4, help='最大并发请求数')
+    parser.add_argument('--output', default='batch_results.jsonl', help='结果JSONL文件')
+    parser.add_argument('--manifest', help='已完成清单文件，默认为 <output>.manifest')
+    args = parser.parse_args()
+
+    configure_genai()
+    register_json_dump()
+    stats = run_batch(args.target, args.image_type, max(1, args.concurrency), args.output,
+                      args.manifest or args.output + '.manifest')
+    print("\n=== 批量分析统计 ===")
+    print(f"图片总数：{stats['total']}，跳过：{stats['skipped']}，成功：{stats['succeeded']}，失败：{stats['failed']}")
+    print(f"总耗时：{stats['wall_seconds']}s，吞吐：{stats['images_per_second']} 张/秒，"
+          f"单张延迟中位数：{stats['median_latency_ms']}ms")
+
+
+if __name__ == '__main__':
+    main_cli()
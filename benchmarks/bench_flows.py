@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+端到端延迟基准测试
+
+基于本地Gemini替身（fake_genai）驱动 main.py 中的对话、图片分析和PDF报告流程，
+在不同并发度下统计 p50/p95/p99 延迟和吞吐量，用于衡量应用自身的开销。
+
+用法：
+    python benchmarks/bench_flows.py --flows chat,image,pdf --concurrency 1,4,16 --requests 32
+    python benchmarks/bench_flows.py --time-scale 0.1 --output bench.json
+    python benchmarks/bench_flows.py --flows chat,summary --error-rate 0.2 --slow-rate 0.05 --retries 0
+    python benchmarks/bench_flows.py --flows chat,summary --error-rate 0.2 --slow-rate 0.05 --hedge-after 1.5
+    python benchmarks/bench_flows.py --flows pdf_large --pdf-pages 120 --chunk-pages 0    # 整份总结
+    python benchmarks/bench_flows.py --flows pdf_large --pdf-pages 120 --chunk-pages 20   # 分块总结
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+# 基准测试始终使用本地替身
+os.environ['GENAI_BACKEND'] = 'fake'
+os.environ.setdefault('GEMINI_API_KEY', 'fake-key')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission  # noqa: E402
+import fake_genai  # noqa: E402
+import gemini_gateway  # noqa: E402
+import main  # noqa: E402
+import pdf_summary  # noqa: E402
+import resilience  # noqa: E402
+from metrics import metrics  # noqa: E402
+from pdf_cache import PdfCache  # noqa: E402
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """计算百分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def make_pdf(path: str, seed: int, pages: int = 1, lines_per_page: int = 1) -> None:
+    """生成一份内容唯一的PDF（每个seed内容不同，避免命中去重缓存），pages 控制页数"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in range(1, pages + 1):
+        lines = [f"Benchmark report {seed} page {page}"]
+        lines += [f"Item {page}-{n}: CA19-9 {seed % 997 + n} U/mL, CEA {n * 0.7:.1f} ng/mL, reference range noted"
+                  for n in range(1, lines_per_page)]
+        text = ' '.join(f"({line}) Tj 0 -14 Td" for line in lines)
+        stream = f"BT /F1 10 Tf 40 760 Td {text} ET".encode('latin-1')
+        kids.append(f"{len(objects) + 1} 0 R")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {len(objects) + 2} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>".encode())
+        objects.append(b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode()
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += f"{i} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode()
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, 'wb') as f:
+        f.write(output)
+
+
+def make_image(path: str, size=(4000, 3000)) -> None:
+    """生成一张模拟手机拍摄的大尺寸图片"""
+    from PIL import Image
+    Image.effect_noise(size, 64).convert('RGB').save(path, quality=95)
+
+
+class FlowBench:
+    """各业务流程的基准测试驱动"""
+
+    def __init__(self, workdir: str, pdf_pages: int = 120):
+        self.workdir = workdir
+        self.pdf_pages = pdf_pages
+        self.model = fake_genai.GenerativeModel('gemini-2.0-flash-exp')
+        self.image_path = os.path.join(workdir, 'bench_image.jpg')
+        self._pdf_seq = 0
+        make_image(self.image_path)
+        # PDF去重缓存写入临时目录，不影响正式缓存
+        main.pdf_cache = PdfCache(cache_path=workdir)
+
+    def chat(self, i: int) -> None:
+        session = self.model.start_chat(history=[])
+        gemini_gateway.call("chat", session.send_message, f"CA19-9 是什么？（请求 {i}）").text
+
+    def summary(self, i: int) -> None:
+        # 无状态的 generate_content，可对冲
+        gemini_gateway.call("report", self.model.generate_content, f"请总结这份报告（请求 {i}）").text
+
+    def image(self, i: int) -> None:
+        result = main.analyze_image(self.image_path, "血液", session=self.model.start_chat(history=[]))
+        if not result['success']:
+            raise RuntimeError(result['error'])
+
+    def pdf(self, i: int) -> None:
+        self._pdf_seq += 1
+        path = os.path.join(self.workdir, f'report_{self._pdf_seq}_{i}.pdf')
+        make_pdf(path, self._pdf_seq * 100000 + i)
+        cache, _ = main.upload_pdf_and_cache(path)
+        if cache is None:
+            raise RuntimeError("PDF处理失败")
+
+    def pdf_large(self, i: int) -> None:
+        # 多页报告合集，用于比较整份总结与分块（map-reduce）总结
+        self._pdf_seq += 1
+        path = os.path.join(self.workdir, f'large_{self._pdf_seq}_{i}.pdf')
+        make_pdf(path, self._pdf_seq * 100000 + i, pages=self.pdf_pages, lines_per_page=40)
+        cache, _ = main.upload_pdf_and_cache(path)
+        if cache is None:
+            raise RuntimeError("PDF处理失败")
+
+    def pdf_repeat(self, i: int) -> None:
+        path = os.path.join(self.workdir, 'report_repeat.pdf')
+        if not os.path.exists(path):
+            make_pdf(path, -1)
+        cache, _ = main.upload_pdf_and_cache(path)
+        if cache is None:
+            raise RuntimeError("PDF处理失败")
+
+
+def run_level(fn: Callable[[int], None], concurrency: int, requests: int) -> Dict[str, float]:
+    """在给定并发度下执行requests次请求并统计延迟"""
+    latencies: List[float] = []
+    errors = 0
+
+    def timed(i: int) -> None:
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            fn(i)
+        except Exception:
+            errors += 1
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, range(requests)))
+    wall = time.perf_counter() - wall_start
+
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p95_ms': round(percentile(latencies, 95), 1),
+        'p99_ms': round(percentile(latencies, 99), 1),
+        'throughput_rps': round(requests / wall, 2) if wall else 0.0,
+    }
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="基于本地Gemini替身的端到端延迟基准测试")
+    parser.add_argument('--flows', default='chat,summary,image,pdf,pdf_repeat', help='逗号分隔的流程列表')
+    parser.add_argument('--concurrency', default='1,4,16', help='逗号分隔的并发度列表')
+    parser.add_argument('--requests', type=int, default=32, help='每个并发度下的请求数')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='替身延迟的整体缩放系数')
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    parser.add_argument('--metrics-json', help='把运行指标（延迟直方图、token用量等）写入JSON文件')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='替身注入错误（429/503）的比例')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='替身注入慢请求的比例')
+    parser.add_argument('--slow-seconds', type=float, default=5.0, help='慢请求额外增加的延迟（秒）')
+    parser.add_argument('--retries', type=int, help='覆盖 proxy.retry_count，0表示不重试')
+    parser.add_argument('--hedge-after', type=float, help='覆盖 resilience.hedge_after（秒），0表示不对冲')
+    parser.add_argument('--base-delay', type=float, help='覆盖重试退避的基础延迟（秒）')
+    parser.add_argument('--pdf-pages', type=int, default=120, help='pdf_large 流程生成的PDF页数')
+    parser.add_argument('--chunk-pages', type=int,
+                        help='覆盖 pdf_summary.pages_per_chunk，0表示关闭分块总结')
+    parser.add_argument('--chunk-concurrency', type=int, help='覆盖 pdf_summary.concurrency')
+    parser.add_argument('--admission', action='store_true',
+                        help='启用准入控制（默认关闭，避免限流影响延迟测量）')
+    args = parser.parse_args()
+
+    latency = fake_genai.LatencyModel.from_config()
+    latency.time_scale = args.time_scale
+    fake_genai.set_latency_model(latency)
+    fake_genai.set_fault_injector(fake_genai.FaultInjector(
+        error_rate=args.error_rate, slow_rate=args.slow_rate, slow_seconds=args.slow_seconds))
+    # 基准测试中不启用熔断，避免注入的错误让后续请求全部被拒绝
+    resilience.configure(retry_count=args.retries, hedge_after=args.hedge_after, base_delay=args.base_delay,
+                         breaker_failure_threshold=0)
+    admission.configure(enabled=args.admission)
+    if args.chunk_pages == 0:
+        pdf_summary.configure(enabled=False)
+    else:
+        pdf_summary.configure(pages_per_chunk=args.chunk_pages, concurrency=args.chunk_concurrency)
+
+    workdir = tempfile.mkdtemp(prefix='gemini_bench_')
+    results = []
+    try:
+        bench = FlowBench(workdir, pdf_pages=args.pdf_pages)
+        levels = [int(c) for c in args.concurrency.split(',')]
+        print(f"{'flow':<12}{'conc':>6}{'reqs':>6}{'err':>5}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'rps':>8}")
+        for flow in args.flows.split(','):
+            fn = getattr(bench, flow.strip())
+            for level in levels:
+                stats = run_level(fn, level, args.requests)
+                stats['flow'] = flow
+                results.append(stats)
+                print(f"{flow:<12}{level:>6}{stats['requests']:>6}{stats['errors']:>5}"
+                      f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['throughput_rps']:>8}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.metrics_json:
+        metrics.dump_json(args.metrics_json)
+
+
+if __name__ == '__main__':
+    main_cli()
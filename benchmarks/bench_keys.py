@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+API密钥池基准测试
+
+基于本地Gemini替身（fake_genai）模拟每个密钥各自的请求配额（fake_backend.key_quota），
+在不同密钥数下以固定并发发出对话请求，统计吞吐量、429次数和各密钥的请求分布，
+用于验证吞吐随密钥数近似线性增长；随后上传文件、创建缓存并基于它们提问，
+验证文件和缓存始终由归属的密钥访问（不出现403）。
+
+用法：
+    python benchmarks/bench_keys.py --keys 1,2,4,8 --quota-rate 1 --concurrency 128 --requests 400
+    python benchmarks/bench_keys.py --time-scale 0.02 --output bench_keys.json
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+# 基准测试始终使用本地替身
+os.environ['GENAI_BACKEND'] = 'fake'
+os.environ.setdefault('GEMINI_API_KEY', 'fake-key')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission  # noqa: E402
+import fake_genai  # noqa: E402
+import gemini_gateway  # noqa: E402
+import key_pool  # noqa: E402
+import resilience  # noqa: E402
+
+
+class CountingQuota(fake_genai.KeyQuota):
+    """统计各密钥成功和超出配额（429）次数的配额"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.accepted: Dict[str, int] = {}
+        self.rejected = 0
+
+    def take(self, key: str) -> bool:
+        allowed = super().take(key)
+        with self._lock:
+            if allowed:
+                self.accepted[key] = self.accepted.get(key, 0) + 1
+            else:
+                self.rejected += 1
+        return allowed
+
+
+def run_keys(count: int, concurrency: int, requests: int, quota: Dict[str, float]) -> Dict[str, Any]:
+    """使用count个密钥并发发出requests次对话请求（每轮重置各密钥的配额）"""
+    key_pool.configure(keys=[f'bench-key-{i}' for i in range(count)])
+    counting = CountingQuota(**quota)
+    fake_genai.set_key_quota(counting)
+    model = fake_genai.GenerativeModel('gemini-2.0-flash-exp')
+    errors = 0
+
+    def chat(i: int) -> None:
+        nonlocal errors
+        try:
+            gemini_gateway.call("chat", model.generate_content, f"CA19-9 是什么？（请求 {i}）").text
+        except Exception:
+            errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(chat, range(requests)))
+    wall = time.perf_counter() - start
+
+    return {
+        'keys': count,
+        'requests': requests,
+        'errors': errors,
+        'quota_429': counting.rejected,
+        'throughput_rps': round((requests - errors) / wall, 2) if wall else 0.0,
+        'distribution': sorted(counting.accepted.values()),
+    }
+
+
+def check_pinning(count: int, files: int) -> Dict[str, Any]:
+    """上传文件、创建缓存并基于它们提问，统计因访问其他密钥的资源而返回的403"""
+    key_pool.configure(keys=[f'bench-key-{i}' for i in range(count)])
+    forbidden = 0
+    owners = set()
+
+    def flow(i: int) -> None:
+        nonlocal forbidden
+        try:
+            data = io.BytesIO(b'%PDF-1.4 ' * 2000 + bytes([i]))
+            document = gemini_gateway.upload("pdf", fake_genai.upload_file, data, mime_type='application/pdf',
+                                             display_name=f'bench_{i}.pdf')
+            owner = key_pool.key_pool.owner(document)
+            owners.add(owner.id if owner is not None else None)
+            cache = gemini_gateway.call("pdf", fake_genai.caching.CachedContent.create,
+                                        model='gemini-2.0-flash-exp', contents=[document])
+            model = fake_genai.GenerativeModel.from_cached_content(cache)
+            gemini_gateway.call("report", model.generate_content, "请总结这份报告").text
+            session = fake_genai.GenerativeModel('gemini-2.0-flash-exp').start_chat(history=[])
+            gemini_gateway.call("chat", session.send_message, [document, "这份报告的要点是什么？"]).text
+            gemini_gateway.call("chat", session.send_message, "还有需要注意的吗？").text
+            gemini_gateway.call("files", fake_genai.get_file, document.name)
+        except fake_genai.PermissionDenied:
+            forbidden += 1
+
+    with ThreadPoolExecutor(max_workers=files) as pool:
+        list(pool.map(flow, range(files)))
+    return {'keys': count, 'files': files, 'owners': len(owners), 'forbidden_403': forbidden}
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="基于本地Gemini替身的API密钥池基准测试")
+    parser.add_argument('--keys', default='1,2,4,8', help='逗号分隔的密钥数列表')
+    parser.add_argument('--concurrency', type=int, default=128, help='并发请求数')
+    parser.add_argument('--requests', type=int, default=400, help='每个密钥数下的请求数')
+    parser.add_argument('--quota-rate', type=float, default=1.0, help='每个密钥每秒允许的请求数（未缩放）')
+    parser.add_argument('--quota-burst', type=float, default=1.0, help='每个密钥的突发请求数')
+    parser.add_argument('--time-scale', type=float, default=0.05, help='替身延迟和配额的整体缩放系数')
+    parser.add_argument('--retries', type=int, default=100, help='超出配额时的最大重试次数')
+    parser.add_argument('--pin-files', type=int, default=16, help='验证资源归属时上传的文件数（0表示跳过）')
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    args = parser.parse_args()
+
+    latency = fake_genai.LatencyModel.from_config()
+    latency.time_scale = args.time_scale
+    fake_genai.set_latency_model(latency)
+    fake_genai.set_fault_injector(fake_genai.FaultInjector())
+    fake_genai.set_key_resolver(key_pool.key_pool.current_secret)
+    # 只测量密钥配额的影响：关闭准入控制和熔断，请求在配额内重试到成功为止，
+    # 重试退避和密钥剔除时长与替身延迟同比缩放
+    admission.configure(enabled=False)
+    resilience.configure(breaker_failure_threshold=0, retry_count=args.retries, base_delay=0.5 * args.time_scale,
+                         max_delay=8.0 * args.time_scale)
+
+    workdir = tempfile.mkdtemp(prefix='gemini_bench_keys_')
+    key_pool.key_pool.db_path = os.path.join(workdir, 'key_pins.db')
+    key_pool.configure(eject_seconds=30 * args.time_scale)
+    results: List[Dict[str, Any]] = []
+    try:
+        print(f"{'keys':>5}{'reqs':>6}{'err':>5}{'429':>6}{'rps':>9}{'speedup':>9}  distribution")
+        baseline = None
+        for count in [int(n) for n in args.keys.split(',')]:
+            stats = run_keys(count, args.concurrency, args.requests,
+                             {'rate': args.quota_rate, 'burst': args.quota_burst})
+            baseline = baseline or stats['throughput_rps'] / count
+            stats['speedup'] = round(stats['throughput_rps'] / baseline, 2) if baseline else 0.0
+            results.append(stats)
+            print(f"{count:>5}{stats['requests']:>6}{stats['errors']:>5}{stats['quota_429']:>6}"
+                  f"{stats['throughput_rps']:>9}{stats['speedup']:>9}  {stats['distribution']}")
+        if args.pin_files:
+            fake_genai.set_key_quota(fake_genai.KeyQuota())
+            for count in [int(n) for n in args.keys.split(',')]:
+                pinning = check_pinning(count, args.pin_files)
+                results.append(pinning)
+                print(f"资源归属：{count} 个密钥，{pinning['files']} 个文件分布在 {pinning['owners']} 个密钥上，"
+                      f"403次数 {pinning['forbidden_403']}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
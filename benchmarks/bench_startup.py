@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+冷启动基准测试
+
+在全新的子进程中用 `python -X importtime` 导入各入口模块，统计导入总耗时和
+最慢的若干依赖，并与每个入口的冷启动预算比较，超出预算或导入失败（包括导入时阻塞、
+超过 --timeout 秒未结束）时以非零状态码退出，便于在CI中发现新引入的重量级依赖或导入期副作用。
+
+用法：
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --entries main,mange_filelist --runs 5 --top 10
+    python benchmarks/bench_startup.py --budget main=800 --output startup.json
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 各入口的冷启动预算（毫秒，取多次运行的中位数比较）
+DEFAULT_BUDGETS_MS: Dict[str, float] = {
+    'config': 300,
+    'main': 800,
+    'mange_filelist': 800,
+    'batch_image_analysis': 900,
+    'simple_chat': 4000,
+    'webui': 5000,
+    'streamlit_web': 4000,
+}
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int, int]]:
+    """解析 -X importtime 输出，返回 (模块, 自身耗时us, 累计耗时us, 嵌套层级) 列表"""
+    records = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            records.append((module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return records
+
+
+def measure_entry(entry: str, timeout: float) -> Dict[str, object]:
+    """在新进程中导入一次入口模块，超过timeout秒未结束时终止并记为失败"""
+    env = dict(os.environ)
+    # 使用本地替身，避免网络访问和对API密钥的依赖
+    env['GENAI_BACKEND'] = 'fake'
+    env.setdefault('GEMINI_API_KEY', 'fake-key')
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    try:
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {entry}'],
+                              cwd=ROOT, env=env, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'total_ms': None, 'records': [],
+                'error': f"导入超过 {timeout:g} 秒未结束（导入时有阻塞的副作用？）"}
+    records = parse_importtime(proc.stderr)
+    top = next((r for r in records if r[0] == entry and r[3] == 0), None)
+    error: Optional[str] = None
+    if proc.returncode != 0:
+        lines = [line for line in proc.stderr.splitlines() if not line.startswith('import time:')]
+        error = lines[-1] if lines else f"退出码 {proc.returncode}"
+    return {
+        'total_ms': round(top[2] / 1000, 1) if top else None,
+        'records': records,
+        'error': error,
+    }
+
+
+def slowest_imports(records: List[Tuple[str, int, int, int]], entry: str,
+                    top: int) -> List[Tuple[str, float]]:
+    """按累计耗时列出入口模块直接导入的最慢依赖"""
+    # importtime 先输出子模块再输出父模块，入口的直接依赖是其前面、上一个顶层模块之后的第1层记录
+    end = next((i for i, r in enumerate(records) if r[0] == entry and r[3] == 0), len(records))
+    start = max((i for i in range(end) if records[i][3] == 0), default=-1) + 1
+    children = [r for r in records[start:end] if r[3] == 1]
+    children.sort(key=lambda r: r[2], reverse=True)
+    return [(module, round(cumulative / 1000, 1)) for module, _, cumulative, _ in children[:top]]
+
+
+def run_entry(entry: str, runs: int, top: int, timeout: float) -> Dict[str, object]:
+    """多次测量一个入口，返回中位数和最慢依赖"""
+    totals = []
+    last = None
+    for _ in range(runs):
+        last = measure_entry(entry, timeout)
+        if last['error']:
+            break
+        totals.append(last['total_ms'])
+    return {
+        'entry': entry,
+        'median_ms': round(statistics.median(totals), 1) if totals else None,
+        'max_ms': max(totals) if totals else None,
+        'slowest': slowest_imports(last['records'], entry, top) if last else [],
+        'error': last['error'] if last else None,
+    }
+
+
+def parse_budgets(values: List[str]) -> Dict[str, float]:
+    budgets = dict(DEFAULT_BUDGETS_MS)
+    for value in values:
+        entry, _, ms = value.partition('=')
+        budgets[entry.strip()] = float(ms)
+    return budgets
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="基于 -X importtime 的入口模块冷启动基准测试")
+    parser.add_argument('--entries', default=','.join(DEFAULT_BUDGETS_MS), help='逗号分隔的入口模块列表')
+    parser.add_argument('--runs', type=int, default=3, help='每个入口的测量次数')
+    parser.add_argument('--top', type=int, default=5, help='列出最慢的依赖个数')
+    parser.add_argument('--budget', action='append', default=[], help='覆盖预算，格式 入口=毫秒，可重复')
+    parser.add_argument('--timeout', type=float, default=60, help='单次导入的最长时间（秒）')
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    args = parser.parse_args()
+
+    budgets = parse_budgets(args.budget)
+    results = []
+    failed = False
+    print(f"{'entry':<24}{'median(ms)':>12}{'max(ms)':>10}{'budget':>10}  status")
+    for entry in [e.strip() for e in args.entries.split(',') if e.strip()]:
+        result = run_entry(entry, max(1, args.runs), args.top, args.timeout)
+        budget = budgets.get(entry)
+        result['budget_ms'] = budget
+        if result['error']:
+            status = f"导入失败：{result['error']}"
+            failed = True
+        elif budget is not None and result['median_ms'] > budget:
+            status = "超出预算"
+            failed = True
+        else:
+            status = "OK"
+        results.append(result)
+        print(f"{entry:<24}{str(result['median_ms']):>12}{str(result['max_ms']):>10}{str(budget):>10}  {status}")
+        for module, ms in result['slowest']:
+            print(f"    {module:<40}{ms:>10}ms")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -1,136 +1,333 @@
 import json
 import os
 import logging
-from typing import Dict, Any, Optional
+import threading
+import time
+from typing import Dict, Any, FrozenSet, Optional
+
+from pydantic import BaseModel, ConfigDict
+
+from logging_setup import setup_logging
+
+# 各配置段缺省时使用的默认值
+DEFAULT_SECTIONS: Dict[str, Dict[str, Any]] = {
+    'proxy': {
+        'enabled': False,
+        'http': None,
+        'https': None,
+        'timeout': 30,
+        'retry_count': 3
+    },
+    # retention_period单位为小时，max_size为最多保留的条目数；
+    # cached_content_ttl、ttl_refresh_interval单位为秒
+    'cache_config': {
+        'format': 'json',
+        'retention_period': 24,
+        'max_size': 100,
+        'cached_content_ttl': 3600,
+        'ttl_refresh_interval': 300
+    },
+    # refresh_interval单位为秒
+    'file_inventory': {
+        'refresh_interval': 300,
+        'page_size': 50
+    },
+    # ttl单位为秒
+    'answer_cache': {
+        'enabled': False,
+        'ttl': 86400,
+        'max_entries': 500
+    },
+    'history_compaction': {
+        'enabled': True,
+        'token_budget': 16000,
+        'keep_last_turns': 4
+    },
+    # idle_timeout单位为秒
+    'session_config': {
+        'max_sessions': 500,
+        'max_history_bytes': 64 * 1024 * 1024,
+        'idle_timeout': 1800
+    },
+    'model_registry': {
+        'warmup': False
+    },
+    # json_path非空时在进程退出前把指标导出为JSON
+    'metrics': {
+        'enabled': True,
+        'host': '127.0.0.1',
+        'port': 9464,
+        'json_path': None
+    },
+}
+
+
+class ConfigSnapshot(BaseModel):
+    """
+    config.json 的不可变快照
+    加载时一次性完成解析：各配置段、路径（同时创建目录）、支持的文件类型、
+    提示词及各图片类型的预处理参数都预先计算好，getter只做属性读取。
+    """
+    model_config = ConfigDict(frozen=True)
+
+    raw: Dict[str, Any] = {}
+    models: Dict[str, Any] = {}
+    ui: Dict[str, Any] = {}
+    system: Dict[str, Any] = {}
+    sections: Dict[str, Dict[str, Any]] = {}
+    prompts: Dict[str, Any] = {}
+    image_types: Dict[str, Dict[str, Any]] = {}
+    # 键为图片类型，'' 为不区分类型的默认预处理参数
+    image_preprocess: Dict[str, Dict[str, Any]] = {}
+    upload_path: str = 'uploads/'
+    cache_path: str = 'cache/'
+    supported_image_types: FrozenSet[str] = frozenset()
+    supported_doc_types: FrozenSet[str] = frozenset()
+    streaming_enabled: bool = False
+    login_password: str = ''
+    mtime_ns: int = 0
+    version: int = 0
+
+    @classmethod
+    def build(cls, raw: Dict[str, Any], mtime_ns: int = 0, version: int = 0) -> 'ConfigSnapshot':
+        """由原始配置字典构建快照"""
+        system = raw.get('system_config', {})
+        prompts = raw.get('prompts', {})
+        image_types = prompts.get('analysis_prompts', {})
+
+        base_preprocess = dict(system.get('image_preprocess', {}))
+        image_preprocess = {'': base_preprocess}
+        for image_type, image_config in image_types.items():
+            options = dict(base_preprocess)
+            options.update((image_config or {}).get('preprocess', {}))
+            image_preprocess[image_type] = options
+
+        upload_path = system.get('upload_path', 'uploads/')
+        cache_path = system.get('cache_path', 'cache/')
+        os.makedirs(upload_path, exist_ok=True)
+        os.makedirs(cache_path, exist_ok=True)
+
+        return cls(
+            raw=raw,
+            models=raw.get('model_config', {}),
+            ui=raw.get('ui_config', {}),
+            system=system,
+            sections={name: system.get(name, default) for name, default in DEFAULT_SECTIONS.items()},
+            prompts=prompts,
+            image_types=image_types,
+            image_preprocess=image_preprocess,
+            upload_path=upload_path,
+            cache_path=cache_path,
+            supported_image_types=frozenset(system.get('supported_image_types', [])),
+            supported_doc_types=frozenset(system.get('supported_doc_types', [])),
+            streaming_enabled=bool(system.get('streaming', {}).get('enabled', False)),
+            login_password=system.get('login_config', {}).get('password', ''),
+            mtime_ns=mtime_ns,
+            version=version,
+        )
+
 
 class Config:
     """配置管理类"""
+
+    # 检查config.json修改时间的最小间隔（秒），避免每次读取配置都stat文件
+    RELOAD_CHECK_INTERVAL = 1.0
+
     def __init__(self):
         """初始化配置类"""
         self.config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-        self._setup_logging()  # 先设置日志
-        self.load_config()     # 再加载配置
+        self._reload_lock = threading.Lock()
+        self._last_check = 0.0
+        self._failed_mtime_ns = 0
+        self._snapshot = ConfigSnapshot()
+        self.logger = logging.getLogger(__name__)
+        self.load_config()     # 先加载配置
+        self._setup_logging()  # 再按配置初始化日志
 
     def _setup_logging(self) -> None:
-        """设置日志配置"""
-        log_dir = "logs"
-        os.makedirs(log_dir, exist_ok=True)
-        
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(os.path.join(log_dir, 'app.log'), encoding='utf-8'),
-                logging.StreamHandler()
-            ]
-        )
-        self.logger = logging.getLogger(__name__)
+        """按 system_config.logging 初始化非阻塞日志管道"""
+        log_file = setup_logging(self.get_logging_config())
+        self.logger.info(f"配置版本 {self._snapshot.version}，日志文件：{log_file}")
+
+    def load_config(self) -> bool:
+        """
+        从config.json加载配置并原子替换当前快照
+        加载失败时保留原快照（首次加载失败则为空配置）
+        :return: 是否加载成功
+        """
+        with self._reload_lock:
+            self._last_check = time.monotonic()
+            try:
+                mtime_ns = os.stat(self.config_path).st_mtime_ns
+                with open(self.config_path, 'r', encoding='utf-8') as f:
+                    raw = json.load(f)
+                snapshot = ConfigSnapshot.build(raw, mtime_ns, self._snapshot.version + 1)
+            except Exception as e:
+                self.logger.error(f"加载配置文件失败: {e}")
+                try:
+                    self._failed_mtime_ns = os.stat(self.config_path).st_mtime_ns
+                except OSError:
+                    self._failed_mtime_ns = 0
+                return False
+            # 单次引用赋值，读取方要么看到旧快照要么看到新快照
+            self._snapshot = snapshot
+            self._failed_mtime_ns = 0
+            self.logger.info(f"成功加载配置文件（版本 {snapshot.version}）")
+            return True
 
-    def load_config(self) -> None:
-        """从config.json加载配置"""
+    def _maybe_reload(self) -> None:
+        """config.json修改时间变化时重新加载（按RELOAD_CHECK_INTERVAL节流）"""
+        now = time.monotonic()
+        if now - self._last_check < self.RELOAD_CHECK_INTERVAL:
+            return
+        self._last_check = now
         try:
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                self.config = json.load(f)
-            self.logger.info("成功加载配置文件")
-        except Exception as e:
-            self.logger.error(f"加载配置文件失败: {e}")
-            self.config = {}
+            mtime_ns = os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime_ns != self._snapshot.mtime_ns and mtime_ns != self._failed_mtime_ns:
+            self.load_config()
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        """当前配置快照（文件修改后自动热更新）"""
+        self._maybe_reload()
+        return self._snapshot
+
+    @property
+    def config(self) -> Dict[str, Any]:
+        """原始配置字典"""
+        return self.snapshot.raw
 
     def get_model_config(self) -> Dict[str, Any]:
         """获取模型配置"""
-        return self.config.get('model_config', {})
+        return self.snapshot.models
 
     def get_ui_config(self) -> Dict[str, Any]:
         """获取UI配置"""
-        return self.config.get('ui_config', {})
+        return self.snapshot.ui
 
     def get_system_config(self) -> Dict[str, Any]:
         """获取系统配置"""
-        return self.config.get('system_config', {})
+        return self.snapshot.system
 
     def get_proxy_config(self) -> Dict[str, Any]:
         """获取代理配置"""
-        system_config = self.get_system_config()
-        return system_config.get('proxy', {
-            'enabled': False,
-            'http': None,
-            'https': None,
-            'timeout': 30,
-            'retry_count': 3
-        })
+        return self.snapshot.sections['proxy']
+
+    def get_cache_config(self) -> Dict[str, Any]:
+        """获取缓存配置（retention_period单位为小时，max_size为最多保留的条目数，CachedContent有效期单位为秒）"""
+        return self.snapshot.sections['cache_config']
+
+    def get_file_inventory_config(self) -> Dict[str, Any]:
+        """获取远程文件索引配置（refresh_interval单位为秒）"""
+        return self.snapshot.sections['file_inventory']
+
+    def get_answer_cache_config(self) -> Dict[str, Any]:
+        """获取普通对话答案缓存配置（ttl单位为秒）"""
+        return self.snapshot.sections['answer_cache']
+
+    def get_history_compaction_config(self) -> Dict[str, Any]:
+        """获取对话历史压缩配置"""
+        return self.snapshot.sections['history_compaction']
+
+    def get_session_config(self) -> Dict[str, Any]:
+        """获取会话管理配置（idle_timeout单位为秒）"""
+        return self.snapshot.sections['session_config']
+
+    def get_model_registry_config(self) -> Dict[str, Any]:
+        """获取模型注册表配置（warmup为是否在启动时预热模型）"""
+        return self.snapshot.sections['model_registry']
+
+    def get_resilience_config(self) -> Dict[str, Any]:
+        """获取调用容错配置（退避、总时限、熔断、对冲；超时与重试次数见 proxy）"""
+        return self.snapshot.system.get('resilience', {})
+
+    def get_pdf_text_config(self) -> Dict[str, Any]:
+        """获取PDF文本层提取配置（字符数阈值、整份发送的上限、相关页面数）"""
+        return self.snapshot.system.get('pdf_text', {})
+
+    def get_pdf_summary_config(self) -> Dict[str, Any]:
+        """获取大型PDF分块概要总结配置（触发页数、每块页数、并发度、概要字数上限）"""
+        return self.snapshot.system.get('pdf_summary', {})
+
+    def get_report_jobs_config(self) -> Dict[str, Any]:
+        """获取报告分析后台任务配置（线程数、保留的任务数和保留时长）"""
+        return self.snapshot.system.get('report_jobs', {})
+
+    def get_api_server_config(self) -> Dict[str, Any]:
+        """获取异步API服务配置（监听地址、worker数、连接池大小、上传和下载限制）"""
+        return self.snapshot.system.get('api_server', {})
+
+    def get_admission_config(self) -> Dict[str, Any]:
+        """获取准入控制配置（各模型和每个用户的令牌桶、等待队列长度和最长等待时间）"""
+        return self.snapshot.system.get('admission', {})
+
+    def get_key_pool_config(self) -> Dict[str, Any]:
+        """获取API密钥池配置（密钥所在的环境变量、剔除时长和每个密钥的请求速率上限）"""
+        return self.snapshot.system.get('key_pool', {})
+
+    def get_metrics_config(self) -> Dict[str, Any]:
+        """获取运行指标配置（HTTP端点地址和JSON导出路径）"""
+        return self.snapshot.sections['metrics']
+
+    def get_logging_config(self) -> Dict[str, Any]:
+        """获取日志配置（max_bytes为单个文件大小上限，max_age_days为日志保留天数）"""
+        return self.snapshot.system.get('logging', {})
+
+    def get_image_preprocess_config(self, image_type: Optional[str] = None) -> Dict[str, Any]:
+        """获取图片预处理配置，指定图片类型时合并该类型的覆盖项"""
+        image_preprocess = self.snapshot.image_preprocess
+        return dict(image_preprocess.get(image_type or '', image_preprocess.get('', {})))
+
+    def is_streaming_enabled(self) -> bool:
+        """是否启用流式输出"""
+        return self.snapshot.streaming_enabled
 
     def get_prompts(self) -> Dict[str, Any]:
         """获取提示词配置"""
-        return self.config.get('prompts', {})
+        return self.snapshot.prompts
 
     def get_image_types(self) -> Dict[str, Dict[str, str]]:
         """获取图片类型配置"""
-        prompts = self.get_prompts()
-        return prompts.get('analysis_prompts', {})
+        return self.snapshot.image_types
 
     def get_image_type_prompt(self, image_type: str) -> Optional[Dict[str, str]]:
-        """获取特定图片类型的提���词配置"""
-        image_types = self.get_image_types()
-        return image_types.get(image_type)
+        """获取特定图片类型的提示词配置"""
+        return self.snapshot.image_types.get(image_type)
 
     def get_upload_path(self) -> str:
-        """获取上传路径"""
-        system_config = self.get_system_config()
-        upload_path = system_config.get('upload_path', 'uploads/')
-        os.makedirs(upload_path, exist_ok=True)
-        return upload_path
+        """获取上传路径（目录在加载配置时已创建）"""
+        return self.snapshot.upload_path
 
     def get_cache_path(self) -> str:
-        """获取缓存路径"""
-        system_config = self.get_system_config()
-        cache_path = system_config.get('cache_path', 'cache/')
-        os.makedirs(cache_path, exist_ok=True)
-        return cache_path
+        """获取缓存路径（目录在加载配置时已创建）"""
+        return self.snapshot.cache_path
 
     def is_supported_image_type(self, mime_type: str) -> bool:
         """检查是否支持的图片类型"""
-        system_config = self.get_system_config()
-        return mime_type in system_config.get('supported_image_types', [])
+        return mime_type in self.snapshot.supported_image_types
 
     def is_supported_doc_type(self, mime_type: str) -> bool:
         """检查是否支持的文档类型"""
-        system_config = self.get_system_config()
-        return mime_type in system_config.get('supported_doc_types', [])
+        return mime_type in self.snapshot.supported_doc_types
 
     def save_uploaded_file(self, uploaded_file) -> str:
         """
         保存上传的文件并返回保存路径
+        按内容寻址分块写入 uploads/blobs/，相同内容的重复上传直接返回已有路径，见 upload_store.py
         :param uploaded_file: StreamlitUploadedFile对象
         :return: 保存后的文件路径
         """
-        # 获取上传路径
-        upload_path = self.get_upload_path()
-        
-        # 获取原始文件名
-        original_filename = uploaded_file.name
-        file_extension = original_filename.split('.')[-1].lower()
-        
-        # 构建保存路径
-        save_path = os.path.join(upload_path, original_filename)
-        
-        # 处理文件名冲突
-        if os.path.exists(save_path):
-            base_name = original_filename.rsplit('.', 1)[0]
-            counter = 1
-            while os.path.exists(save_path):
-                new_filename = f"{base_name}_{counter}.{file_extension}"
-                save_path = os.path.join(upload_path, new_filename)
-                counter += 1
-        
-        # 保存文件
-        with open(save_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        
-        return save_path
+        # upload_store 依赖本模块的全局配置，延迟导入以避免循环导入
+        from upload_store import upload_store
+        stored = upload_store.save_stream(uploaded_file, uploaded_file.name,
+                                          getattr(uploaded_file, 'type', None))
+        return stored.path
 
     def get_login_password(self):
         """获取登录密码"""
-        return self.config.get("system_config", {}).get("login_config", {}).get("password", "")
+        return self.snapshot.login_password
 
 # 创建全局配置实例
 config = Config()
@@ -0,0 +1,816 @@
+# -*- coding: utf-8 -*-
+"""
+本地Gemini替身
+
+模拟本项目用到的 google.generativeai 接口：GenerativeModel.generate_content、
+start_chat/send_message（及其 _async 协程版本）、upload_file、get_file、list_files、delete_file 以及
+caching.CachedContent。不访问网络、不消耗配额，延迟按可配置的模型模拟：
+
+    请求开销 + 输入token / 预填充速率 + 首字延迟 + 输出token / 生成速率
+
+参数来自 system_config.fake_backend，也可通过 set_latency_model 在运行时替换。
+fake_backend.faults 可注入上游故障（按比例返回429/503等错误、偶发慢请求或整体不可用），
+用于验证重试、熔断和对冲请求的效果，也可通过 set_fault_injector 在运行时替换。
+fake_backend.key_quota 模拟每个API密钥（项目）各自的请求配额，超出时返回429；文件和
+CachedContent 归属于创建它们的密钥，用其他密钥访问时返回403，用于验证多密钥池（key_pool.py）。
+通过环境变量 GENAI_BACKEND=fake 或 system_config.genai_backend 选择，见 genai_backend.py。
+"""
+import asyncio
+import datetime
+import io
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 每个图片分片、每个文件按固定token数估算（与Gemini的计费口径同量级）
+IMAGE_TOKENS = 258
+FILE_TOKENS_PER_KB = 2
+
+
+class LatencyModel:
+    """延迟与token速率模型"""
+
+    def __init__(self, request_overhead: float = 0.05, first_token_latency: float = 0.3,
+                 prefill_tokens_per_second: float = 20000, tokens_per_second: float = 80,
+                 upload_bytes_per_second: float = 5 * 1024 * 1024, output_tokens: int = 256,
+                 chunk_tokens: int = 16, jitter: float = 0.1, time_scale: float = 1.0):
+        """
+        :param request_overhead: 每次请求的固定开销（秒）
+        :param first_token_latency: 预填充完成后到首个token的延迟（秒）
+        :param prefill_tokens_per_second: 输入token处理速率
+        :param tokens_per_second: 输出token生成速率
+        :param upload_bytes_per_second: 文件上传带宽
+        :param output_tokens: 每次回复的默认输出token数（不超过max_output_tokens）
+        :param chunk_tokens: 流式输出时每个分块的token数
+        :param jitter: 延迟的随机抖动比例
+        :param time_scale: 整体时间缩放，基准测试中可调小以加快运行
+        """
+        self.request_overhead = request_overhead
+        self.first_token_latency = first_token_latency
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.tokens_per_second = tokens_per_second
+        self.upload_bytes_per_second = upload_bytes_per_second
+        self.output_tokens = output_tokens
+        self.chunk_tokens = chunk_tokens
+        self.jitter = jitter
+        self.time_scale = time_scale
+
+    @classmethod
+    def from_config(cls) -> "LatencyModel":
+        """从 system_config.fake_backend 创建"""
+        options = dict(config.get_system_config().get('fake_backend', {}))
+        options.pop('faults', None)
+        options.pop('key_quota', None)
+        return cls(**options)
+
+    def scaled(self, seconds: float) -> float:
+        """按抖动和时间缩放换算实际休眠时长"""
+        if seconds <= 0:
+            return 0.0
+        return seconds * (1 + random.uniform(-self.jitter, self.jitter)) * self.time_scale
+
+    def sleep(self, seconds: float) -> None:
+        """按抖动和时间缩放休眠"""
+        duration = self.scaled(seconds)
+        if duration > 0:
+            time.sleep(duration)
+
+    async def sleep_async(self, seconds: float) -> None:
+        """sleep() 的异步版本，不占用事件循环"""
+        duration = self.scaled(seconds)
+        if duration > 0:
+            await asyncio.sleep(duration)
+
+    def time_to_first_token(self, prompt_tokens: int) -> float:
+        return self.request_overhead + prompt_tokens / self.prefill_tokens_per_second + self.first_token_latency
+
+    def chunk_interval(self) -> float:
+        return self.chunk_tokens / self.tokens_per_second
+
+
+# --- 故障注入 ---
+
+class APIError(Exception):
+    """与 google.api_core.exceptions.GoogleAPICallError 对应的错误，code 为HTTP状态码"""
+
+    code = 500
+
+    def __init__(self, message: str = ''):
+        super().__init__(f"{self.code} {message or type(self).__name__}")
+        self.message = message
+
+
+class PermissionDenied(APIError):
+    code = 403
+
+
+class ResourceExhausted(APIError):
+    code = 429
+
+
+class InternalServerError(APIError):
+    code = 500
+
+
+class ServiceUnavailable(APIError):
+    code = 503
+
+
+class DeadlineExceeded(APIError):
+    code = 504
+
+
+_ERRORS_BY_CODE = {cls.code: cls for cls in
+                   (PermissionDenied, ResourceExhausted, InternalServerError, ServiceUnavailable, DeadlineExceeded)}
+
+exceptions = SimpleNamespace(APIError=APIError, PermissionDenied=PermissionDenied,
+                             ResourceExhausted=ResourceExhausted, InternalServerError=InternalServerError,
+                             ServiceUnavailable=ServiceUnavailable, DeadlineExceeded=DeadlineExceeded)
+
+
+class FaultInjector:
+    """按比例注入上游错误和慢请求"""
+
+    def __init__(self, error_rate: float = 0.0, error_codes: Optional[List[int]] = None,
+                 slow_rate: float = 0.0, slow_seconds: float = 5.0, outage: bool = False):
+        """
+        :param error_rate: 请求直接失败的比例
+        :param error_codes: 失败时随机选择的HTTP状态码
+        :param slow_rate: 请求额外变慢的比例（模拟长尾）
+        :param slow_seconds: 慢请求额外增加的延迟（秒，受time_scale缩放）
+        :param outage: 为True时所有请求返回503
+        """
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes or [429, 503])
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.outage = outage
+
+    @classmethod
+    def from_config(cls) -> "FaultInjector":
+        """从 system_config.fake_backend.faults 创建"""
+        return cls(**config.get_system_config().get('fake_backend', {}).get('faults', {}))
+
+    def maybe_fail(self, operation: str) -> None:
+        """按配置抛出模拟的上游错误"""
+        if self.outage:
+            raise ServiceUnavailable(f"{operation}: service unavailable")
+        if self.error_rate and random.random() < self.error_rate:
+            code = random.choice(self.error_codes)
+            raise _ERRORS_BY_CODE.get(code, APIError)(f"{operation}: injected fault")
+
+    def extra_delay(self) -> float:
+        """本次请求额外增加的延迟（秒）"""
+        if self.slow_rate and random.random() < self.slow_rate:
+            return self.slow_seconds
+        return 0.0
+
+
+# --- 按密钥的配额与资源归属 ---
+
+class KeyQuota:
+    """每个API密钥的生成请求配额（令牌桶，rate为每秒请求数，受time_scale缩放；0表示不限）"""
+
+    def __init__(self, rate: float = 0.0, burst: Optional[float] = None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(self.rate, 1.0))
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, List[float]] = {}
+
+    @classmethod
+    def from_config(cls) -> "KeyQuota":
+        """从 system_config.fake_backend.key_quota 创建"""
+        return cls(**config.get_system_config().get('fake_backend', {}).get('key_quota', {}))
+
+    def take(self, key: str) -> bool:
+        """消耗一次配额，超出时返回False"""
+        if self.rate <= 0:
+            return True
+        rate = self.rate / max(get_latency_model().time_scale, 1e-6)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = [tokens - 1 if allowed else tokens, now]
+            return allowed
+
+
+_latency_model: Optional[LatencyModel] = None
+_fault_injector: Optional[FaultInjector] = None
+_key_quota: Optional[KeyQuota] = None
+_key_resolver: Optional[Callable[[], Optional[str]]] = None
+_configured_key: Optional[str] = None
+_lock = threading.Lock()
+_files: Dict[str, "File"] = {}
+_caches: Dict[str, "_CachedContentRecord"] = {}
+_counter = itertools.count(1)
+
+
+def get_latency_model() -> LatencyModel:
+    """获取当前延迟模型"""
+    global _latency_model
+    if _latency_model is None:
+        _latency_model = LatencyModel.from_config()
+    return _latency_model
+
+
+def set_latency_model(model: LatencyModel) -> None:
+    """替换延迟模型"""
+    global _latency_model
+    _latency_model = model
+
+
+def get_fault_injector() -> FaultInjector:
+    """获取当前故障注入器"""
+    global _fault_injector
+    if _fault_injector is None:
+        _fault_injector = FaultInjector.from_config()
+    return _fault_injector
+
+
+def set_fault_injector(injector: FaultInjector) -> None:
+    """替换故障注入器"""
+    global _fault_injector
+    _fault_injector = injector
+
+
+def get_key_quota() -> KeyQuota:
+    """获取当前的按密钥配额"""
+    global _key_quota
+    if _key_quota is None:
+        _key_quota = KeyQuota.from_config()
+    return _key_quota
+
+
+def set_key_quota(quota: KeyQuota) -> None:
+    """替换按密钥配额"""
+    global _key_quota
+    _key_quota = quota
+
+
+def set_key_resolver(resolver: Optional[Callable[[], Optional[str]]]) -> None:
+    """设置返回当前请求所用密钥的函数（多密钥时由 genai_backend 安装）"""
+    global _key_resolver
+    _key_resolver = resolver
+
+
+def _current_key() -> str:
+    key = _key_resolver() if _key_resolver is not None else None
+    return key or _configured_key or 'default'
+
+
+def _check_owner(resource: Any) -> None:
+    """文件和缓存只能由创建它们的密钥访问"""
+    owner = getattr(resource, 'owner', None)
+    if owner is not None and owner != _current_key():
+        raise PermissionDenied(f"{resource.name}: permission denied (owned by another project)")
+
+
+def _check_parts(contents: Any, depth: int = 0) -> None:
+    """检查请求内容中引用的文件是否属于当前密钥"""
+    if depth > 4 or contents is None:
+        return
+    if isinstance(contents, File):
+        _check_owner(contents)
+    elif isinstance(contents, Content):
+        for part in contents.parts:
+            _check_parts(part.data, depth + 1)
+    elif isinstance(contents, dict):
+        _check_parts(contents.get('parts'), depth + 1)
+    elif isinstance(contents, (list, tuple)):
+        for item in contents:
+            _check_parts(item, depth + 1)
+
+
+def _plan_request(operation: str, base_delay: float, request_options: Any = None):
+    """
+    决定一次请求的结果：返回 (等待的未缩放秒数, 等待后抛出的异常或None)
+    超时按实际秒数计，以负数表示
+    """
+    latency = get_latency_model()
+    faults = get_fault_injector()
+    delay = base_delay + faults.extra_delay()
+    timeout = _config_value(request_options, 'timeout')
+    if timeout is not None and delay * latency.time_scale > timeout:
+        return -float(timeout), DeadlineExceeded(f"{operation}: deadline exceeded")
+    try:
+        faults.maybe_fail(operation)
+    except APIError as e:
+        return latency.request_overhead, e
+    if operation == 'generate_content' and not get_key_quota().take(_current_key()):
+        return latency.request_overhead, ResourceExhausted(f"{operation}: quota exceeded for this API key")
+    return delay, None
+
+
+def _begin_request(operation: str, base_delay: float, request_options: Any = None) -> None:
+    """
+    模拟一次请求的前半段：故障注入、请求延迟和超时
+    :param base_delay: 未缩放的正常延迟（秒）
+    :param request_options: 与SDK相同的 {'timeout': 秒}，模拟延迟超过超时则抛出 DeadlineExceeded
+    """
+    delay, error = _plan_request(operation, base_delay, request_options)
+    if delay < 0:
+        time.sleep(-delay)
+    else:
+        get_latency_model().sleep(delay)
+    if error is not None:
+        raise error
+
+
+async def _begin_request_async(operation: str, base_delay: float, request_options: Any = None) -> None:
+    """_begin_request() 的异步版本"""
+    delay, error = _plan_request(operation, base_delay, request_options)
+    if delay < 0:
+        await asyncio.sleep(-delay)
+    else:
+        await get_latency_model().sleep_async(delay)
+    if error is not None:
+        raise error
+
+
+def reset() -> None:
+    """清空所有模拟的文件和缓存"""
+    with _lock:
+        _files.clear()
+        _caches.clear()
+
+
+def configure(api_key: Optional[str] = None, **kwargs) -> None:
+    """与 genai.configure 兼容，替身无需密钥（记录密钥用于模拟按密钥的配额和资源归属）"""
+    global _configured_key
+    _configured_key = api_key
+    logger.info("使用本地Gemini替身（fake backend）")
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+# --- 内容与响应 ---
+
+def _count_tokens(contents: Any) -> int:
+    """粗略估算内容的token数：中文约每字1个token，英文约每4字符1个token"""
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        ascii_chars = sum(1 for c in contents if ord(c) < 128)
+        return max(1, (len(contents) - ascii_chars) + ascii_chars // 4)
+    if isinstance(contents, (bytes, bytearray)):
+        return max(1, len(contents) // 1024 * FILE_TOKENS_PER_KB)
+    if isinstance(contents, File):
+        return max(1, contents.size_bytes // 1024 * FILE_TOKENS_PER_KB)
+    if isinstance(contents, dict):
+        if 'parts' in contents:
+            return _count_tokens(contents['parts'])
+        if 'data' in contents:
+            return IMAGE_TOKENS
+        return _count_tokens(str(contents))
+    if isinstance(contents, (list, tuple)):
+        return sum(_count_tokens(item) for item in contents)
+    if isinstance(contents, Content):
+        return sum(_count_tokens(part.text) if part.text else IMAGE_TOKENS for part in contents.parts)
+    # PIL Image 等其它分片按图片计
+    return IMAGE_TOKENS
+
+
+class Part:
+    """内容分片"""
+
+    def __init__(self, text: Optional[str] = None, data: Any = None):
+        self.text = text
+        self.data = data
+
+
+class Content:
+    """一条对话内容"""
+
+    def __init__(self, role: str, parts: List[Part]):
+        self.role = role
+        self.parts = parts
+
+    @classmethod
+    def from_any(cls, content: Any, role: str = 'user') -> "Content":
+        """把字符串、列表、字典等输入统一转为Content"""
+        if isinstance(content, Content):
+            return content
+        if isinstance(content, dict) and 'parts' in content:
+            return cls(content.get('role', role), [cls._to_part(p) for p in content['parts']])
+        if isinstance(content, (list, tuple)):
+            return cls(role, [cls._to_part(p) for p in content])
+        return cls(role, [cls._to_part(content)])
+
+    @staticmethod
+    def _to_part(part: Any) -> Part:
+        if isinstance(part, Part):
+            return part
+        if isinstance(part, str):
+            return Part(text=part)
+        return Part(data=part)
+
+
+class UsageMetadata:
+    """token用量"""
+
+    def __init__(self, prompt_token_count: int, candidates_token_count: int,
+                 cached_content_token_count: int = 0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class Candidate:
+    """候选回复"""
+
+    def __init__(self, text: str):
+        self.content = Content('model', [Part(text=text)])
+        self.finish_reason = 1  # STOP
+
+
+class GenerateContentResponse:
+    """生成结果；流式模式下迭代时按延迟模型逐块产出"""
+
+    def __init__(self, text: str, usage_metadata: UsageMetadata, stream: bool = False,
+                 chunks: Optional[List[str]] = None, on_done=None):
+        self._text = text
+        self.usage_metadata = usage_metadata
+        self.candidates = [Candidate(text)]
+        self._stream = stream
+        self._chunks = chunks or [text]
+        self._on_done = on_done
+        self._done = not stream
+
+    @property
+    def text(self) -> str:
+        if not self._done:
+            self.resolve()
+        return self._text
+
+    def resolve(self) -> None:
+        """消费完整的流式响应"""
+        for _ in self:
+            pass
+
+    def __iter__(self) -> Iterator["GenerateContentResponse"]:
+        if not self._stream or self._done:
+            yield self
+            return
+        latency = get_latency_model()
+        for i, chunk in enumerate(self._chunks):
+            if i > 0:
+                latency.sleep(latency.chunk_interval())
+            yield GenerateContentResponse(chunk, self.usage_metadata)
+        self._done = True
+        if self._on_done is not None:
+            self._on_done(self)
+
+
+def _fake_reply(prompt_tokens: int, max_output_tokens: Optional[int]) -> List[str]:
+    """生成模拟回复，按chunk_tokens切分"""
+    latency = get_latency_model()
+    output_tokens = latency.output_tokens
+    if max_output_tokens:
+        output_tokens = min(output_tokens, int(max_output_tokens))
+    filler = "这是本地替身生成的模拟回复内容。"
+    text = "【模拟回复】" + (filler * (output_tokens // len(filler) + 1))[:max(0, output_tokens - 6)]
+    size = max(1, latency.chunk_tokens)
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _prepare_reply(contents: Any, generation_config: Any, extra_prompt_tokens: int):
+    """生成模拟回复：返回 (分块, 全文, 用量, 输入token数)"""
+    prompt_tokens = _count_tokens(contents) + extra_prompt_tokens
+    max_output_tokens = _config_value(generation_config, 'max_output_tokens')
+    chunks = _fake_reply(prompt_tokens, max_output_tokens)
+    text = "".join(chunks)
+    usage = UsageMetadata(prompt_tokens, _count_tokens(text), extra_prompt_tokens)
+    return chunks, text, usage, prompt_tokens
+
+
+def _generate(contents: Any, generation_config: Any, stream: bool, extra_prompt_tokens: int = 0,
+              on_done=None, request_options: Any = None) -> GenerateContentResponse:
+    """按延迟模型生成一次回复"""
+    latency = get_latency_model()
+    _check_parts(contents)
+    chunks, text, usage, prompt_tokens = _prepare_reply(contents, generation_config, extra_prompt_tokens)
+
+    _begin_request('generate_content', latency.time_to_first_token(prompt_tokens), request_options)
+    if stream:
+        return GenerateContentResponse(text, usage, stream=True, chunks=chunks, on_done=on_done)
+    latency.sleep(latency.chunk_interval() * (len(chunks) - 1))
+    response = GenerateContentResponse(text, usage)
+    if on_done is not None:
+        on_done(response)
+    return response
+
+
+async def _generate_async(contents: Any, generation_config: Any, extra_prompt_tokens: int = 0,
+                          on_done=None, request_options: Any = None) -> GenerateContentResponse:
+    """_generate() 的异步版本（非流式）"""
+    latency = get_latency_model()
+    _check_parts(contents)
+    chunks, text, usage, prompt_tokens = _prepare_reply(contents, generation_config, extra_prompt_tokens)
+
+    await _begin_request_async('generate_content', latency.time_to_first_token(prompt_tokens), request_options)
+    await latency.sleep_async(latency.chunk_interval() * (len(chunks) - 1))
+    response = GenerateContentResponse(text, usage)
+    if on_done is not None:
+        on_done(response)
+    return response
+
+
+def _config_value(generation_config: Any, key: str) -> Any:
+    if generation_config is None:
+        return None
+    if isinstance(generation_config, dict):
+        return generation_config.get(key)
+    return getattr(generation_config, key, None)
+
+
+# --- 模型与会话 ---
+
+class GenerationConfig:
+    """与 genai.GenerationConfig 兼容的生成参数"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+types = SimpleNamespace(GenerationConfig=GenerationConfig)
+
+
+class CountTokensResponse:
+    def __init__(self, total_tokens: int):
+        self.total_tokens = total_tokens
+
+
+class GenerativeModel:
+    """模拟的生成模型"""
+
+    def __init__(self, model_name: str = 'gemini-2.0-flash-exp', generation_config: Any = None,
+                 system_instruction: Any = None, **kwargs):
+        self._model_name = model_name if model_name.startswith('models/') else f'models/{model_name}'
+        self._generation_config = generation_config
+        self._system_instruction = system_instruction
+        self.cached_content: Optional[str] = None
+
+    @property
+    def model_name(self) -> str:
+        return self._model_name
+
+    @classmethod
+    def from_cached_content(cls, cached_content: Any, **kwargs) -> "GenerativeModel":
+        if isinstance(cached_content, str):
+            cached_content = caching.CachedContent.get(cached_content)
+        model = cls(model_name=cached_content.model, **kwargs)
+        model.cached_content = cached_content.name
+        return model
+
+    def _cached_tokens(self) -> int:
+        if not self.cached_content:
+            return 0
+        with _lock:
+            record = _caches.get(self.cached_content)
+        if record is None or record.expire_time <= _now():
+            raise RuntimeError(f"404 CachedContent not found (or expired): {self.cached_content}")
+        _check_owner(record)
+        return record.token_count
+
+    def generate_content(self, contents: Any, *, stream: bool = False, **kwargs) -> GenerateContentResponse:
+        system_tokens = _count_tokens(self._system_instruction)
+        return _generate(contents, kwargs.get('generation_config') or self._generation_config,
+                         stream, extra_prompt_tokens=system_tokens + self._cached_tokens(),
+                         request_options=kwargs.get('request_options'))
+
+    async def generate_content_async(self, contents: Any, **kwargs) -> GenerateContentResponse:
+        system_tokens = _count_tokens(self._system_instruction)
+        return await _generate_async(contents, kwargs.get('generation_config') or self._generation_config,
+                                     extra_prompt_tokens=system_tokens + self._cached_tokens(),
+                                     request_options=kwargs.get('request_options'))
+
+    def count_tokens(self, contents: Any) -> CountTokensResponse:
+        return CountTokensResponse(_count_tokens(contents) + _count_tokens(self._system_instruction))
+
+    def start_chat(self, history: Optional[list] = None) -> "ChatSession":
+        return ChatSession(self, history)
+
+
+class ChatSession:
+    """模拟的多轮会话，每轮都会重新发送完整历史"""
+
+    def __init__(self, model: GenerativeModel, history: Optional[list] = None):
+        self.model = model
+        self._history = [Content.from_any(c) for c in (history or [])]
+
+    @property
+    def history(self) -> List[Content]:
+        return self._history
+
+    @history.setter
+    def history(self, history: list) -> None:
+        self._history = [Content.from_any(c) for c in history]
+
+    def send_message(self, content: Any, *, stream: bool = False, **kwargs) -> GenerateContentResponse:
+        sent = Content.from_any(content)
+        contents = self._history + [sent]
+
+        def on_done(response):
+            self._history.extend([sent, response.candidates[0].content])
+
+        return _generate(contents, self.model._generation_config, stream,
+                         extra_prompt_tokens=_count_tokens(self.model._system_instruction),
+                         on_done=on_done, request_options=kwargs.get('request_options'))
+
+    async def send_message_async(self, content: Any, **kwargs) -> GenerateContentResponse:
+        sent = Content.from_any(content)
+        contents = self._history + [sent]
+
+        def on_done(response):
+            self._history.extend([sent, response.candidates[0].content])
+
+        return await _generate_async(contents, self.model._generation_config,
+                                     extra_prompt_tokens=_count_tokens(self.model._system_instruction),
+                                     on_done=on_done, request_options=kwargs.get('request_options'))
+
+
+# --- 文件 ---
+
+class File:
+    """模拟的远程文件"""
+
+    def __init__(self, display_name: str, mime_type: str, size_bytes: int):
+        file_id = uuid.uuid4().hex[:12]
+        self.name = f'files/{file_id}'
+        self.display_name = display_name
+        self.mime_type = mime_type
+        self.size_bytes = size_bytes
+        self.uri = f'https://fake.generativelanguage.local/v1beta/{self.name}'
+        self.create_time = _now()
+        self.expiration_time = self.create_time + datetime.timedelta(hours=48)
+        self.state = SimpleNamespace(name='ACTIVE')
+        self.owner = _current_key()
+
+
+def upload_file(path: Any, *, mime_type: Optional[str] = None, name: Optional[str] = None,
+                display_name: Optional[str] = None, **kwargs) -> File:
+    """模拟上传：按带宽休眠后登记文件"""
+    if isinstance(path, (str, os.PathLike)):
+        size = os.path.getsize(path)
+        display_name = display_name or os.path.basename(str(path))
+    elif isinstance(path, io.IOBase) or hasattr(path, 'read'):
+        size = len(path.read())
+    else:
+        raise TypeError(f"不支持的上传对象类型: {type(path)}")
+
+    latency = get_latency_model()
+    _begin_request('upload_file', latency.request_overhead + size / latency.upload_bytes_per_second)
+    file = File(display_name or f'upload_{next(_counter)}', mime_type or 'application/octet-stream', size)
+    with _lock:
+        _files[file.name] = file
+    return file
+
+
+def get_file(name: str) -> File:
+    _begin_request('get_file', get_latency_model().request_overhead)
+    with _lock:
+        file = _files.get(name)
+    if file is None:
+        raise RuntimeError(f"404 File not found: {name}")
+    _check_owner(file)
+    return file
+
+
+def list_files(page_size: int = 100) -> Iterator[File]:
+    """列出当前密钥的文件"""
+    latency = get_latency_model()
+    key = _current_key()
+    with _lock:
+        files = [f for f in _files.values() if f.owner == key]
+    for i in range(0, len(files), page_size):
+        latency.sleep(latency.request_overhead)
+        yield from files[i:i + page_size]
+
+
+def delete_file(name: Any) -> None:
+    latency = get_latency_model()
+    latency.sleep(latency.request_overhead)
+    name = getattr(name, 'name', name)
+    with _lock:
+        file = _files.get(name)
+        if file is None:
+            raise RuntimeError(f"404 File not found: {name}")
+        _check_owner(file)
+        del _files[name]
+
+
+# --- 缓存 ---
+
+class _CachedContentRecord:
+    def __init__(self, name: str, model: str, token_count: int, expire_time: datetime.datetime,
+                 display_name: Optional[str] = None):
+        self.name = name
+        self.model = model
+        self.token_count = token_count
+        self.expire_time = expire_time
+        self.display_name = display_name
+        self.create_time = _now()
+        self.owner = _current_key()
+
+
+class CachedContent:
+    """模拟的 genai.caching.CachedContent"""
+
+    def __init__(self, name: str):
+        self._record = self._lookup(name)
+
+    @staticmethod
+    def _lookup(name: str) -> _CachedContentRecord:
+        if 'cachedContents/' not in name:
+            name = 'cachedContents/' + name
+        get_latency_model().sleep(get_latency_model().request_overhead)
+        with _lock:
+            record = _caches.get(name)
+        if record is None or record.expire_time <= _now():
+            raise RuntimeError(f"404 CachedContent not found (or expired): {name}")
+        _check_owner(record)
+        return record
+
+    @classmethod
+    def _from_record(cls, record: _CachedContentRecord) -> "CachedContent":
+        obj = cls.__new__(cls)
+        obj._record = record
+        return obj
+
+    name = property(lambda self: self._record.name)
+    model = property(lambda self: self._record.model)
+    display_name = property(lambda self: self._record.display_name)
+    expire_time = property(lambda self: self._record.expire_time)
+    create_time = property(lambda self: self._record.create_time)
+    usage_metadata = property(lambda self: SimpleNamespace(total_token_count=self._record.token_count))
+
+    @classmethod
+    def create(cls, model: str, *, display_name: Optional[str] = None, system_instruction: Any = None,
+               contents: Any = None, ttl: Any = None, expire_time: Any = None, **kwargs) -> "CachedContent":
+        _check_parts(contents)
+        token_count = _count_tokens(contents) + _count_tokens(system_instruction)
+        latency = get_latency_model()
+        # 创建缓存需要完整处理一遍输入
+        _begin_request('create_cached_content',
+                       latency.request_overhead + token_count / latency.prefill_tokens_per_second)
+        if not model.startswith('models/'):
+            model = f'models/{model}'
+        record = _CachedContentRecord(f'cachedContents/{uuid.uuid4().hex[:12]}', model, token_count,
+                                      cls._expire_time(ttl, expire_time), display_name)
+        with _lock:
+            _caches[record.name] = record
+        return cls._from_record(record)
+
+    @classmethod
+    def get(cls, name: str) -> "CachedContent":
+        return cls._from_record(cls._lookup(name))
+
+    @classmethod
+    def list(cls, page_size: int = 1) -> Iterator["CachedContent"]:
+        key = _current_key()
+        with _lock:
+            records = [r for r in _caches.values() if r.owner == key]
+        for record in records:
+            yield cls._from_record(record)
+
+    def update(self, *, ttl: Any = None, expire_time: Any = None) -> None:
+        get_latency_model().sleep(get_latency_model().request_overhead)
+        _check_owner(self._record)
+        with _lock:
+            if self._record.name not in _caches:
+                raise RuntimeError(f"404 CachedContent not found: {self._record.name}")
+            self._record.expire_time = self._expire_time(ttl, expire_time)
+
+    def delete(self) -> None:
+        get_latency_model().sleep(get_latency_model().request_overhead)
+        _check_owner(self._record)
+        with _lock:
+            _caches.pop(self._record.name, None)
+
+    @staticmethod
+    def _expire_time(ttl: Any, expire_time: Any) -> datetime.datetime:
+        if expire_time is not None:
+            return expire_time
+        if ttl is None:
+            ttl = 3600
+        if isinstance(ttl, datetime.timedelta):
+            return _now() + ttl
+        return _now() + datetime.timedelta(seconds=float(ttl))
+
+
+caching = SimpleNamespace(CachedContent=CachedContent)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+远程文件本地索引
+
+用SQLite在缓存目录下维护 genai.list_files() 的本地副本，以 name 为主键、
+display_name 建索引：页面渲染只读本地索引，按显示名查找为索引查询；上传、删除时
+同步写入索引，只有索引过期（system_config.file_inventory.refresh_interval）或
+用户主动刷新时才重新拉取远程列表。配置了多个API密钥时，按密钥逐个拉取（文件只对上传它的
+密钥可见），并记录每个文件归属的密钥。
+"""
+import contextlib
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, List, NamedTuple, Optional
+
+from config import config
+from genai_backend import genai
+import gemini_gateway
+from key_pool import key_pool
+
+logger = logging.getLogger(__name__)
+
+
+class FileRecord(NamedTuple):
+    """索引中的文件记录，字段与genai的File对象同名"""
+    name: str
+    display_name: str
+    uri: str
+    mime_type: str
+    size_bytes: int
+    create_time: float
+    expiration_time: float
+
+
+def _timestamp(value: Any) -> float:
+    """把datetime或数字统一转为时间戳"""
+    if value is None:
+        return 0.0
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return float(value)
+
+
+class FileInventory:
+    """远程文件本地索引类"""
+
+    DB_FILENAME = 'file_inventory.db'
+
+    def __init__(self, db_path: Optional[str] = None, refresh_interval: Optional[float] = None):
+        """
+        初始化索引
+        :param db_path: SQLite文件路径，默认位于 config.get_cache_path() 下
+        :param refresh_interval: 索引过期时间（秒），过期后访问时自动全量刷新
+        """
+        inventory_config = config.get_file_inventory_config()
+        self.db_path = db_path or os.path.join(config.get_cache_path(), self.DB_FILENAME)
+        self.refresh_interval = float(refresh_interval if refresh_interval is not None
+                                      else inventory_config.get('refresh_interval', 300))
+        self._lock = threading.Lock()
+        # 同一时间只有一个线程拉取远程列表
+        self._refresh_lock = threading.Lock()
+        self._refreshed_from = 0.0
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """首次使用时才打开数据库，导入模块不产生文件"""
+        if self._db is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    name TEXT PRIMARY KEY,
+                    display_name TEXT,
+                    uri TEXT,
+                    mime_type TEXT,
+                    size_bytes INTEGER,
+                    create_time REAL,
+                    expiration_time REAL,
+                    seen_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_files_display_name ON files(display_name);
+                CREATE INDEX IF NOT EXISTS idx_files_create_time ON files(create_time);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+            """)
+            conn.commit()
+            self._db = conn
+        return self._db
+
+    def _last_refresh(self) -> float:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'last_refresh'").fetchone()
+        return row[0] if row else 0.0
+
+    def is_stale(self) -> bool:
+        """索引是否已过期"""
+        with self._lock:
+            return time.time() - self._last_refresh() >= self.refresh_interval
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        从远程拉取文件列表并更新索引
+        :param force: 为True时忽略过期时间强制刷新
+        :return: 是否实际执行了刷新
+        """
+        if not force and not self.is_stale():
+            return False
+        requested = time.time()
+        # 已有线程在刷新时等待它完成：调用之后才开始的刷新已满足本次请求，不再重复拉取
+        with self._refresh_lock:
+            if self._refreshed_from >= requested or (not force and not self.is_stale()):
+                return False
+            start = time.perf_counter()
+            now = time.time()
+            # 拉取远程列表时不持有 _lock，查询和上传后的写入不必等待网络请求
+            files = []
+            for key in key_pool.keys() if key_pool.enabled else [None]:
+                with gemini_gateway.track("files", "list_files"):
+                    files.extend(self._list_key(key))
+            with self._lock:
+                # 远程已不存在的记录统一删除（拉取期间通过 record_file 写入的记录 seen_at 更晚，会保留）
+                for file in files:
+                    self._upsert(file, now)
+                self._conn.execute("DELETE FROM files WHERE seen_at < ?", (now,))
+                self._conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('last_refresh', ?)", (now,))
+                self._conn.commit()
+            self._refreshed_from = now
+        logger.info(f"文件索引已刷新，共 {len(files)} 个文件，耗时 {(time.perf_counter() - start) * 1000:.1f}ms")
+        return True
+
+    def _list_key(self, key: Any) -> List[Any]:
+        """拉取一个密钥（key为None时为默认密钥）的文件列表"""
+        files = []
+        with key_pool.use(key) if key is not None else contextlib.nullcontext():
+            for file in genai.list_files():
+                if key is not None:
+                    key_pool.pin(file, key)
+                files.append(file)
+        return files
+
+    def record_file(self, file: Any) -> None:
+        """上传成功后把文件写入索引"""
+        with self._lock:
+            self._upsert(file, time.time())
+            self._conn.commit()
+
+    def remove(self, name: str) -> None:
+        """删除成功后从索引中移除"""
+        with self._lock:
+            self._conn.execute("DELETE FROM files WHERE name = ?", (name,))
+            self._conn.commit()
+
+    def count(self) -> int:
+        """未过期文件的数量"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM files WHERE expiration_time = 0 OR expiration_time > ?",
+                (time.time(),)).fetchone()[0]
+
+    def page(self, offset: int = 0, limit: Optional[int] = None) -> List[FileRecord]:
+        """按创建时间倒序分页获取未过期的文件"""
+        limit = -1 if limit is None else int(limit)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, display_name, uri, mime_type, size_bytes, create_time, expiration_time "
+                "FROM files WHERE expiration_time = 0 OR expiration_time > ? "
+                "ORDER BY create_time DESC LIMIT ? OFFSET ?",
+                (time.time(), limit, int(offset))).fetchall()
+        return [FileRecord(*row) for row in rows]
+
+    def find_by_display_name(self, display_name: str) -> Optional[FileRecord]:
+        """按显示名查找文件（同名时返回最新的一个）"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, display_name, uri, mime_type, size_bytes, create_time, expiration_time "
+                "FROM files WHERE display_name = ? ORDER BY create_time DESC LIMIT 1",
+                (display_name,)).fetchone()
+        return FileRecord(*row) if row else None
+
+    def _upsert(self, file: Any, seen_at: float) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO files(name, display_name, uri, mime_type, size_bytes, "
+            "create_time, expiration_time, seen_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (file.name, getattr(file, 'display_name', '') or '', getattr(file, 'uri', '') or '',
+             getattr(file, 'mime_type', '') or '', int(getattr(file, 'size_bytes', 0) or 0),
+             _timestamp(getattr(file, 'create_time', None)),
+             _timestamp(getattr(file, 'expiration_time', None)), seen_at))
+
+
+# 创建全局文件索引实例
+file_inventory = FileInventory()
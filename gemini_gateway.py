@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Gemini调用网关
+
+所有对Gemini的请求（generate_content、send_message、upload_file、CachedContent.create 等）
+统一经由本模块发出，生成请求先经 admission 准入控制（按用户和模型限流、排队），
+由 resilience 负责重试、超时、熔断和对冲请求，每次尝试经 key_pool 选择API密钥（配置了多个密钥时），
+并在这里集中记录延迟、错误类型、token用量和上传字节数（文件上传及请求中内联的图片数据），
+指标按业务流程（flow）、模型名称（model）和操作（op）打标签，见 metrics.py。
+
+用法：
+    response = gemini_gateway.call("chat", session.send_message, message)
+    document = gemini_gateway.upload("pdf", genai.upload_file, io.BytesIO(data), mime_type=...)
+    for chunk in gemini_gateway.stream("chat", session.send_message, message): ...
+    response = await gemini_gateway.call_async("chat", session.send_message_async, message)
+    with gemini_gateway.track("files", "list_files"):
+        files = list(genai.list_files())
+"""
+import io
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+import resilience
+from admission import admission_control
+from key_pool import key_pool
+from metrics import (CACHED_TOKENS, ERRORS, PROMPT_TOKENS, REQUEST_DURATION, REQUESTS, RESPONSE_TOKENS,
+                     STREAM_FIRST_TOKEN, UPLOAD_BYTES)
+
+
+def _strip_model_prefix(name: Optional[str]) -> str:
+    if not name:
+        return '-'
+    return name[len('models/'):] if name.startswith('models/') else name
+
+
+def describe(fn: Callable, kwargs: Optional[dict] = None) -> Tuple[str, str]:
+    """从被调用的方法推断 (操作名, 模型名)，异步方法（xxx_async）与同步方法使用相同的操作名"""
+    op = getattr(fn, '__name__', 'call')
+    if op.endswith('_async'):
+        op = op[:-len('_async')]
+    owner = getattr(fn, '__self__', None)
+    model_name = getattr(owner, 'model_name', None)
+    if model_name is None:
+        # ChatSession 通过 .model 持有模型
+        model_name = getattr(getattr(owner, 'model', None), 'model_name', None)
+    if model_name is None and kwargs:
+        # CachedContent.create(model=...)
+        model_name = kwargs.get('model')
+    return op, _strip_model_prefix(model_name if isinstance(model_name, str) else None)
+
+
+def _payload_size(source: Any) -> int:
+    """估算上传内容的字节数"""
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    if isinstance(source, io.BytesIO):
+        return len(source.getbuffer())
+    if isinstance(source, (str, os.PathLike)) and os.path.exists(source):
+        return os.path.getsize(source)
+    return 0
+
+
+def _inline_size(contents: Any, depth: int = 0) -> int:
+    """统计请求内容中内联数据（如预处理后的图片 {'mime_type', 'data'}）的字节数"""
+    if depth > 4:
+        return 0
+    if isinstance(contents, (bytes, bytearray)):
+        return len(contents)
+    if isinstance(contents, dict):
+        return sum(_inline_size(v, depth + 1) for k, v in contents.items() if k in ('data', 'parts'))
+    if isinstance(contents, (list, tuple)):
+        return sum(_inline_size(item, depth + 1) for item in contents)
+    return 0
+
+
+def record_usage(flow: str, model_name: str, response: Any) -> None:
+    """记录响应中的token用量"""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    labels = {'flow': flow, 'model': model_name}
+    prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+    response_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+    cached_tokens = getattr(usage, 'cached_content_token_count', 0) or 0
+    if prompt_tokens:
+        PROMPT_TOKENS.inc(prompt_tokens, **labels)
+    if response_tokens:
+        RESPONSE_TOKENS.inc(response_tokens, **labels)
+    if cached_tokens:
+        CACHED_TOKENS.inc(cached_tokens, **labels)
+
+
+def record_call(flow: str, op: str, model_name: str, seconds: float, error: Optional[BaseException] = None,
+                response: Any = None, upload_bytes: int = 0) -> None:
+    """记录一次调用的结果"""
+    labels = {'flow': flow, 'model': model_name, 'op': op}
+    REQUEST_DURATION.observe(seconds, **labels)
+    REQUESTS.inc(status='error' if error is not None else 'ok', **labels)
+    if error is not None:
+        ERRORS.inc(error=type(error).__name__, **labels)
+        return
+    if response is not None:
+        record_usage(flow, model_name, response)
+    if upload_bytes:
+        UPLOAD_BYTES.inc(upload_bytes, flow=flow, model=model_name)
+
+
+def record_first_token(flow: str, model_name: str, seconds: float) -> None:
+    """记录流式调用的首字延迟"""
+    STREAM_FIRST_TOKEN.observe(seconds, flow=flow, model=model_name)
+
+
+class CallRecord:
+    """track() 中由调用方补充的结果信息"""
+
+    def __init__(self):
+        self.response: Any = None
+        self.upload_bytes = 0
+
+
+@contextmanager
+def track(flow: str, op: str, model_name: Optional[str] = None) -> Iterator[CallRecord]:
+    """记录一段代码块内的调用（用于 list_files 等不便直接包装的请求）"""
+    record = CallRecord()
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record_call(flow, op, _strip_model_prefix(model_name), time.perf_counter() - start, error=e)
+        raise
+    record_call(flow, op, _strip_model_prefix(model_name), time.perf_counter() - start,
+                response=record.response, upload_bytes=record.upload_bytes)
+
+
+def call(flow: str, fn: Callable, *args, **kwargs) -> Any:
+    """
+    调用Gemini并记录指标
+    :param flow: 业务流程名称（chat、vision、pdf、report 等）
+    :param fn: 被调用的SDK方法，如 model.generate_content、session.send_message
+    :return: fn 的返回值
+    """
+    op, model_name = describe(fn, kwargs)
+    admission_control.admit(flow, op)
+    with track(flow, op, model_name) as record:
+        record.upload_bytes = _inline_size(args)
+        record.response = resilience.run(key_pool.route(fn), args, kwargs, flow, op, model_name)
+    return record.response
+
+
+async def call_async(flow: str, fn: Callable, *args, **kwargs) -> Any:
+    """
+    call() 的异步版本，用于SDK的协程方法，等待上游响应时不阻塞事件循环
+    :param fn: 如 model.generate_content_async、session.send_message_async
+    """
+    op, model_name = describe(fn, kwargs)
+    await admission_control.admit_async(flow, op)
+    with track(flow, op, model_name) as record:
+        record.upload_bytes = _inline_size(args)
+        record.response = await resilience.run_async(key_pool.route_async(fn), args, kwargs, flow, op, model_name)
+    return record.response
+
+
+def upload(flow: str, fn: Callable, source: Any, **kwargs) -> Any:
+    """上传文件并记录上传字节数"""
+    op, model_name = describe(fn, kwargs)
+
+    def attempt(*args, **kw):
+        # 重试时从头重新读取文件对象
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        return fn(*args, **kw)
+
+    with track(flow, op, model_name) as record:
+        record.upload_bytes = _payload_size(source)
+        record.response = resilience.run(key_pool.route(attempt), (source,), kwargs, flow, op, model_name)
+    return record.response
+
+
+def stream(flow: str, fn: Callable, *args, **kwargs) -> Iterator[Any]:
+    """
+    以 stream=True 调用Gemini并逐个产出响应分块，迭代结束后记录总耗时、首块延迟和token用量
+    （流式响应的 usage_metadata 在迭代完成后才完整）。流式调用不设单次超时（建立流之前的重试仍受总时限约束）
+    """
+    op, model_name = describe(fn, kwargs)
+    admission_control.admit(flow, op)
+    upload_bytes = _inline_size(args)
+    start = time.perf_counter()
+    first_chunk = True
+    try:
+        # 只有建立流之前的失败会重试（和换用密钥），已产出分块后不再重试
+        response = resilience.run(key_pool.route(fn), args, dict(kwargs, stream=True), flow, op, model_name)
+        for chunk in response:
+            if first_chunk:
+                record_first_token(flow, model_name, time.perf_counter() - start)
+                first_chunk = False
+            yield chunk
+    except Exception as e:
+        record_call(flow, op, model_name, time.perf_counter() - start, error=e)
+        raise
+    record_call(flow, op, model_name, time.perf_counter() - start, response=response, upload_bytes=upload_bytes)
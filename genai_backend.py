@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Gemini后端选择
+
+环境变量 GENAI_BACKEND 优先，其次是 system_config.genai_backend：
+- gemini（默认）：使用 google.generativeai
+- fake：使用 fake_genai 本地替身，不访问网络、无需API密钥
+
+各模块统一通过 `from genai_backend import genai` 获取后端。`genai` 是惰性代理，
+首次访问属性时才导入实际的SDK，导入本模块本身没有副作用；需要访问API前调用
+configure_genai() 完成密钥配置。配置了多个API密钥时（见 key_pool.py），configure_genai()
+同时安装按请求选择密钥的路由：SDK内部按服务名称获取客户端的入口被替换为路由客户端，
+每次调用时按 key_pool 为当前请求选定的密钥转发到对应密钥的客户端。
+"""
+import importlib
+import os
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from config import config
+
+_dotenv_loaded = False
+_configured = False
+_routing_installed = False
+_lock = threading.Lock()
+
+
+def _load_dotenv_once() -> None:
+    """首次需要时加载 .env（允许在 .env 中设置 GENAI_BACKEND 和 GEMINI_API_KEY）"""
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _dotenv_loaded = True
+
+
+def get_backend_name() -> str:
+    """获取当前选择的后端名称"""
+    _load_dotenv_once()
+    name = os.getenv('GENAI_BACKEND') or config.get_system_config().get('genai_backend', 'gemini')
+    return name.strip().lower()
+
+
+def is_fake_backend() -> bool:
+    """是否使用本地替身"""
+    return get_backend_name() == 'fake'
+
+
+class _LazyBackend:
+    """首次访问属性时才导入后端模块的代理"""
+
+    def __init__(self):
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    self._module = importlib.import_module(
+                        'fake_genai' if is_fake_backend() else 'google.generativeai')
+        return self._module
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._load(), name)
+
+    def __repr__(self) -> str:
+        return f"<genai backend {self._module.__name__ if self._module else get_backend_name() + ' (未加载)'}>"
+
+
+genai = _LazyBackend()
+
+
+def configure_genai(api_key: Optional[str] = None) -> None:
+    """
+    配置API密钥（幂等）
+    :param api_key: 默认读取环境变量 GEMINI_API_KEY
+    :raises ValueError: 使用真实后端但未设置密钥
+    """
+    global _configured
+    if _configured and api_key is None:
+        return
+    _load_dotenv_once()
+    from key_pool import key_pool
+    if api_key is None:
+        # .env 加载后重新读取密钥列表
+        key_pool.reload()
+    api_key = api_key or os.getenv('GEMINI_API_KEY') or next((k.secret for k in key_pool.keys()), None)
+    if not api_key and not is_fake_backend():
+        raise ValueError("未找到 GEMINI_API_KEY 环境变量，请确保已经创建 .env 文件并设置了正确的 API 密钥")
+    genai.configure(api_key=api_key)
+    _install_key_routing(key_pool)
+    _configured = True
+
+
+class _RoutingClient:
+    """按当前请求选定的密钥转发到对应密钥的客户端（未选定密钥时使用默认客户端）"""
+
+    def __init__(self, name: str, getters: Dict[str, Callable], default: Callable):
+        self._name = name
+        self._getters = getters
+        self._default = default
+
+    def __getattr__(self, attr: str) -> Any:
+        from key_pool import key_pool
+        key = key_pool.current()
+        getter = self._getters.get(key.id, self._default) if key is not None else self._default
+        return getattr(getter(self._name), attr)
+
+
+def _install_key_routing(key_pool) -> None:
+    """多密钥时安装请求级的密钥路由（只安装一次）"""
+    global _routing_installed
+    if _routing_installed or not key_pool.enabled:
+        return
+    if is_fake_backend():
+        genai.set_key_resolver(key_pool.current_secret)
+    else:
+        from google.generativeai import client as genai_client
+        manager = genai_client._client_manager
+        default = manager.get_default_client
+        getters = {}
+        for key in key_pool.keys():
+            key_manager = genai_client._ClientManager()
+            key_manager.configure(api_key=key.secret)
+            getters[key.id] = key_manager.get_default_client
+        clients: Dict[str, _RoutingClient] = {}
+
+        def get_default_client(name: str) -> Any:
+            name = name.lower()
+            if name == 'operations':
+                return default(name)
+            if name not in clients:
+                clients[name] = _RoutingClient(name, getters, default)
+            return clients[name]
+
+        manager.get_default_client = get_default_client
+    _routing_installed = True
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+对话历史压缩
+
+ChatSession 每轮都会重发完整历史，长时间问诊时延迟和费用随轮数线性增长。
+本模块在历史token数超过预算（system_config.history_compaction.token_budget）后，
+用模型把较早的轮次压缩为一段滚动摘要，只原样保留最近 keep_last_turns 轮，
+使每轮请求的输入规模保持稳定。
+"""
+import logging
+import time
+from typing import Any, Optional
+
+from config import config
+import gemini_gateway
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "请用中文把下面的医患对话压缩为一段不超过400字的摘要，保留患者的病情信息、检查指标、"
+    "用药与治疗情况、已经给出的关键结论和尚未解决的问题，不要添加新的内容。"
+)
+SUMMARY_PREFIX = "以下是此前对话的摘要，请在后续回答中参考：\n"
+SUMMARY_ACK = "好的，我会结合以上摘要继续回答。"
+
+
+def _content_role(content: Any) -> str:
+    if isinstance(content, dict):
+        return content.get('role', 'user')
+    return getattr(content, 'role', 'user') or 'user'
+
+
+def _content_texts(content: Any) -> list:
+    parts = content.get('parts', []) if isinstance(content, dict) else getattr(content, 'parts', [])
+    texts = []
+    for part in parts:
+        text = part if isinstance(part, str) else getattr(part, 'text', None)
+        texts.append(text if text else "[图片/文件]")
+    return texts
+
+
+def history_to_transcript(history) -> str:
+    """把对话历史转为纯文本记录"""
+    lines = []
+    for content in history:
+        speaker = "医生" if _content_role(content) == 'model' else "患者"
+        lines.append(f"{speaker}：{' '.join(_content_texts(content))}")
+    return "\n".join(lines)
+
+
+def estimate_tokens(history) -> int:
+    """本地粗略估算历史token数（中文约每字1个token），避免额外的count_tokens请求"""
+    total = 0
+    for content in history:
+        for text in _content_texts(content):
+            ascii_chars = sum(1 for c in text if ord(c) < 128)
+            total += (len(text) - ascii_chars) + ascii_chars // 4
+    return total
+
+
+class HistoryCompactor:
+    """对话历史压缩器"""
+
+    def __init__(self, enabled: Optional[bool] = None, token_budget: Optional[int] = None,
+                 keep_last_turns: Optional[int] = None):
+        """
+        初始化压缩器
+        :param enabled: 是否启用
+        :param token_budget: 历史token数超过该值时触发压缩
+        :param keep_last_turns: 压缩时原样保留的最近轮数（一问一答为一轮）
+        """
+        compaction_config = config.get_history_compaction_config()
+        self.enabled = bool(enabled if enabled is not None else compaction_config.get('enabled', True))
+        self.token_budget = int(token_budget if token_budget is not None
+                                else compaction_config.get('token_budget', 16000))
+        self.keep_last_turns = int(keep_last_turns if keep_last_turns is not None
+                                   else compaction_config.get('keep_last_turns', 4))
+
+    def history_tokens(self, session, response: Any = None) -> int:
+        """
+        获取会话当前的历史token数
+        优先使用最近一次响应的 usage_metadata（其输入+输出即为完整历史），否则本地估算
+        """
+        usage = getattr(response, 'usage_metadata', None) if response is not None else None
+        total = getattr(usage, 'total_token_count', 0) if usage is not None else 0
+        return total or estimate_tokens(session.history)
+
+    def maybe_compact(self, session, response: Any = None) -> bool:
+        """
+        历史超出预算时压缩较早的轮次
+        :param session: ChatSession对象
+        :param response: 本轮的响应，用于读取 usage_metadata
+        :return: 是否执行了压缩
+        """
+        if not self.enabled:
+            return False
+        tokens = self.history_tokens(session, response)
+        if tokens <= self.token_budget:
+            return False
+
+        history = list(session.history)
+        keep = self.keep_last_turns * 2
+        if len(history) <= keep + 2:
+            return False
+        older, recent = history[:-keep] if keep else history, history[-keep:] if keep else []
+
+        start = time.perf_counter()
+        # 较早的轮次中已包含上一次的摘要，因此新摘要是滚动累积的
+        summary = gemini_gateway.call("compaction", session.model.generate_content,
+                                      [SUMMARY_PROMPT, history_to_transcript(older)]).text
+        session.history = [
+            {'role': 'user', 'parts': [SUMMARY_PREFIX + summary]},
+            {'role': 'model', 'parts': [SUMMARY_ACK]},
+        ] + recent
+        logger.info(f"对话历史已压缩：{len(history)} 条 -> {len(session.history)} 条，"
+                    f"压缩前约 {tokens} tokens，耗时 {(time.perf_counter() - start) * 1000:.1f}ms")
+        return True
+
+
+# 创建全局历史压缩器实例
+history_compactor = HistoryCompactor()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+图片预处理
+
+在上传到Gemini之前按图片类型压缩图片：修正EXIF方向、去除元数据、限制最长边、
+可选转为灰度，并以JPEG/WebP重新编码。参数来自 system_config.image_preprocess，
+可在 analysis_prompts 各类型的 preprocess 字段中覆盖。
+"""
+import io
+import logging
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS = {
+    'enabled': True,
+    'max_edge': 2048,
+    'format': 'JPEG',
+    'quality': 85,
+    'grayscale': False,
+    'workers': 4,
+}
+
+_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+}
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_options(image_type: Optional[str] = None) -> Dict[str, Any]:
+    """获取合并默认值后的预处理参数"""
+    options = dict(DEFAULT_OPTIONS)
+    options.update(config.get_image_preprocess_config(image_type))
+    options['format'] = str(options['format']).upper()
+    if options['format'] not in _MIME_TYPES:
+        logger.warning(f"不支持的预处理输出格式 {options['format']}，改用JPEG")
+        options['format'] = 'JPEG'
+    return options
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """获取预处理线程池（按需创建）"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=int(get_options()['workers']),
+                                       thread_name_prefix='image-preprocess')
+    return _executor
+
+
+def preprocess_image(path: str, image_type: Optional[str] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    预处理图片
+    :param path: 本地图片路径
+    :param image_type: analysis_prompts 中的图片类型
+    :return: (可直接作为内容分片传给模型的 {'mime_type', 'data'}，统计信息)
+    """
+    stat = os.stat(path)
+    # 同一文件、同一类型的结果直接复用，避免多轮对话中重复编码
+    return _preprocess_cached(path, stat.st_mtime_ns, stat.st_size, image_type)
+
+
+@lru_cache(maxsize=32)
+def _preprocess_cached(path: str, mtime_ns: int, size: int,
+                       image_type: Optional[str]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """按 (路径, 修改时间, 大小, 类型) 缓存的预处理实现"""
+    from PIL import Image, ImageOps
+
+    options = get_options(image_type)
+    start = time.perf_counter()
+
+    with Image.open(path) as original:
+        # 修正EXIF方向；重新编码时不写入EXIF即去除了元数据
+        image = ImageOps.exif_transpose(original)
+        original_size = original.size
+        original_format = original.format
+        has_exif = bool(original.info.get('exif'))
+        if options['grayscale']:
+            image = image.convert('L')
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        max_edge = int(options['max_edge'])
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format=options['format'], quality=int(options['quality']), optimize=True)
+
+    data = buffer.getvalue()
+    if len(data) >= size and original_format == options['format'] and not has_exif \
+            and image.size == original_size and image.mode == original.mode:
+        # 原图无需缩放、转换且不含EXIF时，重新编码反而更大则直接使用原始字节
+        with open(path, 'rb') as f:
+            data = f.read()
+    stats = {
+        'bytes_before': size,
+        'bytes_after': len(data),
+        'size_before': original_size,
+        'size_after': image.size,
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 1),
+    }
+    logger.info(f"图片预处理完成：{path}，类型：{image_type}，"
+                f"{stats['size_before']} -> {stats['size_after']}，"
+                f"{stats['bytes_before']} -> {stats['bytes_after']} 字节，耗时 {stats['elapsed_ms']}ms")
+    return {'mime_type': _MIME_TYPES[options['format']], 'data': data}, stats
+
+
+def preprocess_async(path: str, image_type: Optional[str] = None) -> Future:
+    """在线程池中预处理图片，返回Future"""
+    return _get_executor().submit(preprocess_image, path, image_type)
+
+
+def preprocess_many(paths: List[str], image_type: Optional[str] = None) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """在线程池中并行预处理多张图片，按输入顺序返回结果"""
+    futures = [preprocess_async(path, image_type) for path in paths]
+    return [future.result() for future in futures]
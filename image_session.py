@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+图片多轮对话
+
+同一张图片（按内容SHA-256和图片类型区分）经预处理后只通过File API上传一次，远程文件
+在有效期内反复复用。每个浏览器会话持有一个视觉模型的ChatSession：首轮发送图片引用和
+分析提示词，之后只发送新问题的文本，图片和之前的分析都保留在会话上下文中，
+每轮请求的体积和延迟与纯文本对话相当。
+
+会话数量和空闲超时沿用 system_config.session_config。
+"""
+import io
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import gemini_gateway
+import image_preprocess
+from config import config
+from file_inventory import file_inventory
+from genai_backend import genai
+from streaming import stream_call
+from upload_store import file_digest
+
+logger = logging.getLogger(__name__)
+
+# 远程文件临近过期时视为失效（秒）
+EXPIRY_MARGIN = 300
+
+
+def _expire_timestamp(file: Any) -> float:
+    expiration_time = getattr(file, 'expiration_time', None)
+    if expiration_time is None:
+        return 0.0
+    return expiration_time.timestamp() if hasattr(expiration_time, 'timestamp') else float(expiration_time)
+
+
+class ImageFileCache:
+    """按 (内容哈希, 图片类型) 复用已上传的图片文件"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files: Dict[Tuple[str, str], Any] = {}
+
+    @staticmethod
+    def display_name(digest: str, image_type: str) -> str:
+        return f"image-{digest[:32]}-{image_type}"
+
+    def _lookup(self, key: Tuple[str, str]) -> Optional[Any]:
+        """先查进程内缓存，再查远程文件索引（进程重启后仍可复用）"""
+        now = time.time()
+        with self._lock:
+            file = self._files.get(key)
+        if file is not None and _expire_timestamp(file) - EXPIRY_MARGIN > now:
+            return file
+        record = file_inventory.find_by_display_name(self.display_name(*key))
+        if record is None or record.expiration_time - EXPIRY_MARGIN <= now:
+            return None
+        try:
+            file = gemini_gateway.call("vision", genai.get_file, record.name)
+        except Exception as e:
+            logger.warning(f"获取已上传的图片失败，将重新上传: {e}")
+            return None
+        with self._lock:
+            self._files[key] = file
+        return file
+
+    def get_or_upload(self, path: str, mime_type: str, image_type: str, digest: Optional[str] = None) -> Any:
+        """
+        获取图片对应的远程文件，未上传过时预处理并上传
+        :param path: 本地图片路径
+        :param mime_type: 关闭预处理时使用的MIME类型
+        :param image_type: analysis_prompts 中的图片类型（决定预处理参数）
+        """
+        key = (digest or file_digest(path), image_type)
+        file = self._lookup(key)
+        if file is not None:
+            logger.info(f"复用已上传的图片：{file.name}")
+            return file
+
+        if image_preprocess.get_options(image_type)['enabled']:
+            blob, _ = image_preprocess.preprocess_async(path, image_type).result()
+            data, mime_type = blob['data'], blob['mime_type']
+        else:
+            with open(path, 'rb') as f:
+                data = f.read()
+        file = gemini_gateway.upload("vision", genai.upload_file, io.BytesIO(data), mime_type=mime_type,
+                                     display_name=self.display_name(*key))
+        file_inventory.record_file(file)
+        with self._lock:
+            self._files[key] = file
+        logger.info(f"图片已上传：{file.name}（{len(data)} 字节）")
+        return file
+
+
+# 创建全局图片文件缓存实例
+image_files = ImageFileCache()
+
+
+class ImageConversation:
+    """一张图片的多轮对话"""
+
+    def __init__(self, model, path: str, image_type: str, digest: str):
+        self.model = model
+        self.path = path
+        self.image_type = image_type
+        self.digest = digest
+        self.session = None
+        self.last_access = time.time()
+
+    def _next_turn(self, message: str) -> Tuple[Any, Any]:
+        """
+        返回本轮使用的 (会话, 发送内容)：首轮新建会话并发送图片和提示词，之后只发送问题文本
+        新建的会话在首轮完整成功后才保存，首轮失败或流式回复中途放弃时，下一轮重新发送图片
+        """
+        if self.session is not None:
+            return self.session, message
+        image_config = config.get_image_type_prompt(self.image_type)
+        if image_config is None:
+            raise ValueError(f"不支持的图片类型: {self.image_type}")
+        file = image_files.get_or_upload(self.path, image_config['mime_type'], self.image_type, self.digest)
+        return self.model.start_chat(history=[]), [file, message or image_config['system_prompt']]
+
+    def send(self, message: str) -> str:
+        """发送一轮消息并返回回复文本"""
+        self.last_access = time.time()
+        session, content = self._next_turn(message)
+        text = gemini_gateway.call("vision", session.send_message, content).text
+        self.session = session
+        return text
+
+    def stream(self, message: str) -> Iterator[str]:
+        """以流式方式发送一轮消息，逐块产出文本"""
+        self.last_access = time.time()
+        session, content = self._next_turn(message)
+        yield from stream_call("vision", session.send_message, content)
+        self.session = session
+
+
+class ImageConversationStore:
+    """按会话ID保存图片对话，换图、换类型或重新分析时重新开始"""
+
+    def __init__(self, max_sessions: Optional[int] = None, idle_timeout: Optional[float] = None):
+        session_config = config.get_session_config()
+        self.max_sessions = int(max_sessions if max_sessions is not None
+                                else session_config.get('max_sessions', 500))
+        self.idle_timeout = float(idle_timeout if idle_timeout is not None
+                                  else session_config.get('idle_timeout', 1800))
+        self._lock = threading.Lock()
+        self._conversations: "OrderedDict[str, ImageConversation]" = OrderedDict()
+
+    def get(self, session_id: str, model, path: str, image_type: str, restart: bool = False) -> ImageConversation:
+        """
+        获取会话当前的图片对话
+        :param restart: 为True时（如再次点击“分析图片”）丢弃之前的上下文
+        """
+        digest = file_digest(path)
+        now = time.time()
+        with self._lock:
+            for key in [k for k, c in self._conversations.items() if now - c.last_access > self.idle_timeout]:
+                del self._conversations[key]
+            conversation = self._conversations.get(session_id)
+            if restart or conversation is None or conversation.digest != digest \
+                    or conversation.image_type != image_type or conversation.model is not model:
+                conversation = ImageConversation(model, path, image_type, digest)
+                self._conversations[session_id] = conversation
+            self._conversations.move_to_end(session_id)
+            while len(self._conversations) > self.max_sessions:
+                self._conversations.popitem(last=False)
+            return conversation
+
+    def reset(self, session_id: str) -> None:
+        """清除会话的图片对话"""
+        with self._lock:
+            self._conversations.pop(session_id, None)
+
+
+# 创建全局图片对话实例
+image_conversations = ImageConversationStore()
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+API密钥池
+
+单个密钥（项目）的配额决定了整体吞吐上限。配置多个密钥后，gemini_gateway 的每次请求
+（每次重试）都通过 route() 选择一个密钥：
+- 优先选择健康（未被暂时剔除）、未超过 max_rpm 的密钥中负载最低的一个
+  （进行中的请求数最少，其次是最近 rate_window 秒内的请求数最少）
+- 返回429（配额耗尽）的密钥暂时剔除 eject_seconds 秒，返回403的剔除 forbidden_eject_seconds 秒，
+  请求立即换用其他密钥重发
+- 上传的文件和创建的 CachedContent 只能由创建它们的密钥访问：创建时记录归属（持久化在
+  缓存目录的 key_pins.db 中，多个进程共享），之后引用这些资源的请求固定使用归属密钥
+
+密钥来源（按优先级）：环境变量 GEMINI_API_KEYS（逗号分隔）、system_config.key_pool.key_envs
+列出的环境变量、GEMINI_API_KEY。只有一个密钥时不启用路由，行为与之前相同。
+各密钥以SHA-256前缀作为ID出现在日志和运行指标中，不暴露密钥本身。
+"""
+import contextvars
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from config import config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    'key_envs': [],
+    # 暂时剔除的时长（秒）
+    'eject_seconds': 30,
+    'forbidden_eject_seconds': 600,
+    # 请求速率的统计窗口（秒）
+    'rate_window': 60,
+    # 每个密钥每分钟的请求上限（0表示不限，只按负载选择）
+    'max_rpm': 0,
+}
+
+# 属于某个密钥的远程资源名称前缀
+RESOURCE_PREFIXES = ('files/', 'cachedContents/')
+
+KEY_REQUESTS = metrics.counter('gemini_key_requests_total', '各API密钥的请求数（按结果）')
+KEY_IN_FLIGHT = metrics.gauge('gemini_key_in_flight', '各API密钥进行中的请求数')
+KEY_EJECTED = metrics.gauge('gemini_key_ejected', '各API密钥是否被暂时剔除（1为剔除）')
+
+_current: contextvars.ContextVar[Optional["ApiKey"]] = contextvars.ContextVar('api_key', default=None)
+_overrides: Dict[str, Any] = {}
+
+
+def configure(**overrides) -> None:
+    """在运行时覆盖配置项（如基准测试中指定密钥列表 keys=[...]），传入None表示恢复配置值"""
+    for key, value in overrides.items():
+        if value is None:
+            _overrides.pop(key, None)
+        else:
+            _overrides[key] = value
+    key_pool.reload()
+
+
+def get_options() -> Dict[str, Any]:
+    """获取合并默认值后的密钥池参数"""
+    options = dict(DEFAULT_OPTIONS)
+    options.update(config.get_key_pool_config())
+    options.update(_overrides)
+    return options
+
+
+def load_keys(options: Optional[Dict[str, Any]] = None) -> List[str]:
+    """按优先级读取密钥列表（去重，保持顺序）"""
+    options = options or get_options()
+    if options.get('keys'):
+        keys = list(options['keys'])
+    elif os.getenv('GEMINI_API_KEYS'):
+        keys = os.getenv('GEMINI_API_KEYS').split(',')
+    else:
+        keys = [os.getenv(name, '') for name in options.get('key_envs') or []] or [os.getenv('GEMINI_API_KEY', '')]
+    return list(dict.fromkeys(k.strip() for k in keys if k and k.strip()))
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    """从上游异常中取HTTP状态码（兼容 google.api_core.exceptions 与本地替身）"""
+    code = getattr(error, 'code', None)
+    try:
+        return int(getattr(code, 'value', code)) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def resource_name(value: Any) -> Optional[str]:
+    """从文件/缓存对象、资源名称或文件URI中取出资源名称（不是资源时返回None）"""
+    name = value if isinstance(value, str) else getattr(value, 'name', None)
+    if not isinstance(name, str):
+        return None
+    for prefix in RESOURCE_PREFIXES:
+        if name.startswith(prefix):
+            return name
+        index = name.find('/' + prefix) if name.startswith('https://') else -1
+        if index >= 0:
+            return name[index + 1:].split('?', 1)[0]
+    return None
+
+
+def find_resources(contents: Any, depth: int = 0) -> List[str]:
+    """找出请求内容中引用的文件和缓存（File对象、file_data.file_uri、Content.parts、会话历史等）"""
+    if contents is None or depth > 8 or isinstance(contents, (bytes, bytearray, int, float)):
+        return []
+    name = resource_name(contents)
+    if name is not None:
+        return [name]
+    if isinstance(contents, str):
+        return []
+    if isinstance(contents, dict):
+        return [n for key in ('parts', 'file_data', 'file_uri', 'contents') for n in
+                find_resources(contents.get(key), depth + 1)]
+    if isinstance(contents, (list, tuple)):
+        return [n for item in contents for n in find_resources(item, depth + 1)]
+    found = []
+    for attr in ('parts', 'file_data', 'data', 'file_uri'):
+        value = getattr(contents, attr, None)
+        if value is not None and value is not contents:
+            found.extend(find_resources(value, depth + 1))
+    return found
+
+
+def request_resources(fn: Callable, args: tuple, kwargs: dict) -> List[Any]:
+    """
+    一次SDK调用涉及的资源：参数中的文件和缓存、被调用对象本身（CachedContent.update 等）、
+    模型绑定的缓存（GenerativeModel.from_cached_content）以及会话历史中的文件
+    """
+    owner = getattr(fn, '__self__', None)
+    model = getattr(owner, 'model', None)
+    values = [args, kwargs.get('contents'), kwargs.get('name')]
+    if owner is not None and not isinstance(owner, type):
+        values += [owner, getattr(owner, 'cached_content', None), getattr(model, 'cached_content', None),
+                   getattr(owner, 'history', None)]
+    return values
+
+
+class ApiKey:
+    """池中的一个密钥及其负载和健康状态"""
+
+    def __init__(self, secret: str):
+        self.secret = secret
+        self.id = hashlib.sha256(secret.encode('utf-8')).hexdigest()[:8]
+        self.in_flight = 0
+        self.requests: deque = deque()
+        self.ejected_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def recent_requests(self, now: float, window: float) -> int:
+        while self.requests and self.requests[0] < now - window:
+            self.requests.popleft()
+        return len(self.requests)
+
+
+class KeyPool:
+    """API密钥池"""
+
+    def __init__(self, db_path: Optional[str] = None):
+        """
+        :param db_path: 资源归属记录的SQLite文件路径，默认位于 config.get_cache_path() 下
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._keys: List[ApiKey] = []
+        self._by_id: Dict[str, ApiKey] = {}
+        self._pins: Dict[str, str] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> None:
+        """重新读取密钥列表"""
+        self.options = get_options()
+        keys = [ApiKey(secret) for secret in load_keys(self.options)]
+        with self._lock:
+            self._keys = keys
+            self._by_id = {key.id: key for key in keys}
+        if len(keys) > 1:
+            logger.info(f"API密钥池：{len(keys)} 个密钥（{', '.join(k.id for k in keys)}）")
+
+    @property
+    def enabled(self) -> bool:
+        """配置了多个密钥时才启用路由"""
+        return len(self._keys) > 1
+
+    def keys(self) -> List[ApiKey]:
+        return list(self._keys)
+
+    def current(self) -> Optional[ApiKey]:
+        """当前上下文正在使用的密钥"""
+        return _current.get()
+
+    def current_secret(self) -> Optional[str]:
+        key = _current.get()
+        return key.secret if key is not None else None
+
+    @contextmanager
+    def use(self, key: ApiKey) -> Iterator[ApiKey]:
+        """在代码块内固定使用某个密钥（如按密钥逐个列出文件）"""
+        token = _current.set(key)
+        try:
+            yield key
+        finally:
+            _current.reset(token)
+
+    # --- 资源归属 ---
+
+    def _conn(self) -> sqlite3.Connection:
+        """首次使用时才打开数据库，导入模块不产生文件"""
+        if self._db is None:
+            db_path = self.db_path or os.path.join(config.get_cache_path(), 'key_pins.db')
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+            self._db.execute("CREATE TABLE IF NOT EXISTS pins (resource TEXT PRIMARY KEY, key_id TEXT NOT NULL, "
+                             "updated_at REAL NOT NULL)")
+            self._db.commit()
+        return self._db
+
+    def pin(self, resource: Any, key: ApiKey) -> None:
+        """记录资源归属的密钥"""
+        name = resource_name(resource)
+        if name is None or not self.enabled:
+            return
+        with self._db_lock:
+            self._pins[name] = key.id
+            conn = self._conn()
+            conn.execute("INSERT OR REPLACE INTO pins(resource, key_id, updated_at) VALUES (?, ?, ?)",
+                         (name, key.id, time.time()))
+            conn.commit()
+
+    def owner(self, resource: Any) -> Optional[ApiKey]:
+        """查询资源归属的密钥（未知时返回None）"""
+        name = resource_name(resource)
+        if name is None or not self.enabled:
+            return None
+        with self._db_lock:
+            key_id = self._pins.get(name)
+            if key_id is None:
+                row = self._conn().execute("SELECT key_id FROM pins WHERE resource = ?", (name,)).fetchone()
+                if row is None:
+                    return None
+                key_id = self._pins[name] = row[0]
+        return self._by_id.get(key_id)
+
+    def owner_of(self, *values: Any) -> Optional[ApiKey]:
+        """请求涉及的资源中第一个有归属的密钥"""
+        for value in values:
+            for name in find_resources(value):
+                key = self.owner(name)
+                if key is not None:
+                    return key
+        return None
+
+    # --- 选择与健康状态 ---
+
+    def _choose(self, exclude: List[ApiKey]) -> ApiKey:
+        now = time.monotonic()
+        window = float(self.options['rate_window'])
+        max_requests = float(self.options['max_rpm']) * window / 60
+        candidates = [k for k in self._keys if k not in exclude] or list(self._keys)
+        # 全部被剔除时仍按负载在全部密钥中选择，由上游返回的错误决定是否退避重试
+        healthy = [k for k in candidates if k.healthy(now)] or candidates
+        if max_requests > 0:
+            healthy = [k for k in healthy if k.recent_requests(now, window) < max_requests] or healthy
+        return min(healthy, key=lambda k: (k.in_flight, k.recent_requests(now, window)))
+
+    def acquire(self, owner: Optional[ApiKey] = None, exclude: Optional[List[ApiKey]] = None) -> ApiKey:
+        """选择密钥并计入负载；owner 不为None时固定使用该密钥"""
+        with self._lock:
+            key = owner if owner is not None else self._choose(exclude or [])
+            key.in_flight += 1
+            key.requests.append(time.monotonic())
+            KEY_IN_FLIGHT.set(key.in_flight, key=key.id)
+            return key
+
+    def release(self, key: ApiKey, error: Optional[BaseException] = None, pinned: bool = False) -> bool:
+        """
+        请求结束后更新负载和健康状态
+        :param pinned: 请求是否因资源归属固定使用该密钥（此时403视为资源权限问题，不剔除密钥）
+        :return: 是否因429/403剔除了该密钥（可以换用其他密钥重发）
+        """
+        status = error_status(error) if error is not None else None
+        ejected = False
+        with self._lock:
+            key.in_flight = max(0, key.in_flight - 1)
+            KEY_IN_FLIGHT.set(key.in_flight, key=key.id)
+            seconds = 0.0
+            if status == 429:
+                seconds = float(self.options['eject_seconds'])
+            elif status == 403 and not pinned:
+                seconds = float(self.options['forbidden_eject_seconds'])
+            if seconds > 0:
+                key.ejected_until = max(key.ejected_until, time.monotonic() + seconds)
+                ejected = True
+                KEY_EJECTED.set(1, key=key.id)
+            elif error is None and key.ejected_until:
+                # 请求成功说明密钥已恢复
+                key.ejected_until = 0.0
+                KEY_EJECTED.set(0, key=key.id)
+        KEY_REQUESTS.inc(key=key.id, status='ok' if error is None else str(status or type(error).__name__))
+        if ejected:
+            logger.warning(f"API密钥 {key.id} 返回 {status}，暂时剔除 {seconds:.0f} 秒")
+        return ejected
+
+    def has_healthy(self, exclude: List[ApiKey]) -> bool:
+        now = time.monotonic()
+        return any(k.healthy(now) for k in self._keys if k not in exclude)
+
+    def _failover(self, key: ApiKey, error: Exception, owner: Optional[ApiKey], tried: List[ApiKey]) -> bool:
+        """请求失败后释放密钥，返回是否应立即换用其他密钥重发（资源固定在某个密钥上时不换）"""
+        ejected = self.release(key, error, pinned=owner is not None)
+        tried.append(key)
+        return ejected and owner is None and self.has_healthy(tried)
+
+    def route(self, fn: Callable) -> Callable:
+        """
+        包装一次SDK调用：按请求涉及的资源或负载选择密钥，在该密钥下执行；429/403时剔除密钥并
+        立即换用其他健康密钥重发；返回的文件或缓存记录归属于所用的密钥
+        只有一个密钥时原样返回 fn
+        """
+        if not self.enabled:
+            return fn
+
+        def routed(*args, **kwargs):
+            owner = self.owner_of(*request_resources(fn, args, kwargs))
+            tried: List[ApiKey] = []
+            while True:
+                key = self.acquire(owner, tried)
+                try:
+                    with self.use(key):
+                        result = fn(*args, **kwargs)
+                except Exception as e:
+                    if self._failover(key, e, owner, tried):
+                        continue
+                    raise
+                self.release(key)
+                self.pin(result, key)
+                return result
+
+        return routed
+
+    def route_async(self, fn: Callable) -> Callable:
+        """route() 的异步版本，用于SDK的协程方法"""
+        if not self.enabled:
+            return fn
+
+        async def routed(*args, **kwargs):
+            owner = self.owner_of(*request_resources(fn, args, kwargs))
+            tried: List[ApiKey] = []
+            while True:
+                key = self.acquire(owner, tried)
+                try:
+                    with self.use(key):
+                        result = await fn(*args, **kwargs)
+                except Exception as e:
+                    if self._failover(key, e, owner, tried):
+                        continue
+                    raise
+                self.release(key)
+                self.pin(result, key)
+                return result
+
+        return routed
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        window = float(self.options['rate_window'])
+        with self._lock:
+            return [{'id': k.id, 'in_flight': k.in_flight, 'recent_requests': k.recent_requests(now, window),
+                     'healthy': k.healthy(now)} for k in self._keys]
+
+
+# 创建全局密钥池实例
+key_pool = KeyPool()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+非阻塞日志
+
+请求线程只把日志记录放入内存队列（QueueHandler），由后台线程（QueueListener）统一
+格式化并写入文件和控制台，磁盘IO不再占用请求延迟。每个进程只写一个按大小轮转的日志
+文件（logs/<入口名>-<pid>.log）。启动和轮转时清理超过 max_age_days 的旧日志，
+所有进程的日志总大小超过 max_total_bytes 时再从最旧的文件开始删除，频繁重启或多worker
+产生的日志文件也不会超出磁盘占用上限。超长的消息（如完整的模型回复）在入队前截断，可按比例采样。
+
+参数来自 system_config.logging，由 config.Config 在加载配置后调用 setup_logging()。
+本模块不依赖 config，避免循环导入。
+"""
+import atexit
+import glob
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+from typing import Any, Dict, Optional
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    'level': 'INFO',
+    'dir': 'logs',
+    'max_bytes': 10 * 1024 * 1024,
+    'backup_count': 5,
+    'max_age_days': 7,
+    # 日志目录中本模块生成的文件的总大小上限（0表示不限）
+    'max_total_bytes': 200 * 1024 * 1024,
+    'max_message_chars': 2000,
+    # 超长消息（DEBUG/INFO级别）的保留比例，1.0为全部保留（截断后）
+    'large_message_sample_rate': 1.0,
+    'console': True,
+    'queue_size': 10000,
+}
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# 本模块生成的日志文件名：<入口名>-<pid>.log 及其轮转备份 .1/.2...
+_LOG_FILE_PATTERN = re.compile(r'^.+-\d+\.log(\.\d+)?$')
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_log_file: Optional[str] = None
+
+
+def _process_name() -> str:
+    """以入口脚本名作为日志文件前缀"""
+    name = os.path.splitext(os.path.basename(sys.argv[0] if sys.argv else ''))[0]
+    return name if name and not name.startswith('-') else 'app'
+
+
+def prune_old_logs(log_dir: str, max_age_days: float, max_total_bytes: int = 0, keep: Optional[str] = None) -> int:
+    """
+    清理目录下本模块生成的日志文件，返回删除数量
+    :param max_age_days: 删除超过保留天数的文件（0表示不按时间清理）
+    :param max_total_bytes: 剩余文件总大小超过该值时从最旧的开始删除（0表示不限）
+    :param keep: 不删除的文件（当前进程正在写入的日志）
+    """
+    cutoff = time.time() - max_age_days * 86400 if max_age_days > 0 else None
+    removed = 0
+    remaining = []
+    for path in glob.glob(os.path.join(log_dir, '*.log*')):
+        if not _LOG_FILE_PATTERN.match(os.path.basename(path)):
+            continue
+        try:
+            stat = os.stat(path)
+            if cutoff is not None and stat.st_mtime < cutoff:
+                os.remove(path)
+                removed += 1
+            else:
+                remaining.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            continue
+    if max_total_bytes > 0:
+        total = sum(size for _, size, _ in remaining)
+        for _, size, path in sorted(remaining):
+            if total <= max_total_bytes:
+                break
+            if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+                total -= size
+            except OSError:
+                continue
+    return removed
+
+
+class AgeLimitedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """按大小轮转，并在轮转时清理过期日志、控制日志总大小"""
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, max_age_days: float,
+                 max_total_bytes: int = 0):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.max_age_days = max_age_days
+        self.max_total_bytes = max_total_bytes
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        prune_old_logs(os.path.dirname(self.baseFilename), self.max_age_days, self.max_total_bytes,
+                       keep=self.baseFilename)
+
+
+class TruncatingQueueHandler(logging.handlers.QueueHandler):
+    """入队前截断（或采样丢弃）超长消息；队列满时丢弃而不是阻塞请求线程"""
+
+    def __init__(self, log_queue: queue.Queue, max_message_chars: int, sample_rate: float):
+        super().__init__(log_queue)
+        self.max_message_chars = max_message_chars
+        self.sample_rate = sample_rate
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if self.max_message_chars and len(message) > self.max_message_chars:
+            message = f"{message[:self.max_message_chars]}...（共{len(message)}字，已截断）"
+        # 与QueueHandler.prepare一致：合并参数并去掉不可跨线程传递的异常对象
+        record = logging.makeLogRecord(record.__dict__)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if (self.sample_rate < 1.0 and record.levelno <= logging.INFO
+                and self.max_message_chars and len(record.getMessage()) > self.max_message_chars
+                and random.random() >= self.sample_rate):
+            return
+        try:
+            self.enqueue(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.queue.put_nowait(record)
+
+
+def setup_logging(options: Optional[Dict[str, Any]] = None) -> str:
+    """
+    初始化进程的日志管道（幂等，重复调用直接返回）
+    :param options: system_config.logging，缺省项使用 DEFAULT_OPTIONS
+    :return: 当前进程的日志文件路径
+    """
+    global _listener, _log_file
+    if _listener is not None:
+        return _log_file
+
+    opts = dict(DEFAULT_OPTIONS)
+    opts.update(options or {})
+    log_dir = opts['dir']
+    os.makedirs(log_dir, exist_ok=True)
+    prune_old_logs(log_dir, float(opts['max_age_days']), int(opts['max_total_bytes']))
+
+    _log_file = os.path.join(log_dir, f"{_process_name()}-{os.getpid()}.log")
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [AgeLimitedRotatingFileHandler(_log_file, int(opts['max_bytes']), int(opts['backup_count']),
+                                              float(opts['max_age_days']), int(opts['max_total_bytes']))]
+    if opts['console']:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(maxsize=int(opts['queue_size']))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(TruncatingQueueHandler(log_queue, int(opts['max_message_chars']),
+                                           float(opts['large_message_sample_rate'])))
+    root.setLevel(str(opts['level']).upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # 退出时把队列中剩余的日志写完
+    atexit.register(_listener.stop)
+    return _log_file
+
+
+def get_log_file() -> Optional[str]:
+    """当前进程的日志文件路径"""
+    return _log_file
@@ -1,24 +1,24 @@
 # -*- coding: utf-8 -*-
 import os
-import google.generativeai as genai
+import asyncio
+from genai_backend import genai, configure_genai
+import datetime
 import io
-import httpx
-from dotenv import load_dotenv
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import config
+import image_preprocess
+from pdf_cache import PdfCache, pdf_cache
+import pdf_text
+import pdf_summary
+from file_inventory import file_inventory
+from streaming import stream_call
+import gemini_gateway
+from history_compactor import history_compactor
+from model_registry import model_registry
+from metrics import register_json_dump
 
-# 设置日志记录
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-# 加载环境变量
-load_dotenv()
-
-# 初始化配置
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-if not os.getenv("GEMINI_API_KEY"):
-    print("错误：未找到 GEMINI_API_KEY 环境变量")
-    print("请确保已经创建 .env 文件并设置了正确的 API 密钥")
-    exit(1)
-    
 # 初始化对话历史
 chat_history = []
 
@@ -28,10 +28,18 @@ def clear_memory():
     chat_history = []  # 清空对话历史
     print("对话记忆已清除。")
 
-def upload_to_gemini(path, mime_type=None):
-    """Uploads the given file to Gemini."""
+def upload_to_gemini(path, mime_type=None, image_type=None):
+    """
+    Uploads the given file to Gemini.
+
+    图片会先在线程池中按 image_type 对应的参数预处理（缩放、重新编码、去除元数据），
+    返回可直接作为内容分片的 {'mime_type', 'data'}；关闭预处理时返回PIL Image对象。
+    """
     # 新版本API中直接使用PIL Image对象或文件路径
     if mime_type and mime_type.startswith('image/'):
+        if image_preprocess.get_options(image_type)['enabled']:
+            blob, _ = image_preprocess.preprocess_async(path, image_type).result()
+            return blob
         from PIL import Image
         image = Image.open(path)
         return image
@@ -39,50 +47,237 @@ def upload_to_gemini(path, mime_type=None):
         with open(path, 'rb') as f:
             return f.read()
 
-def upload_pdf_and_cache(pdf_url):
-    """上传PDF文档并创建缓存，并生成概要总结。"""
+def _read_pdf_bytes(pdf_url):
+    """读取PDF内容，支持URL和本地文件路径"""
+    if pdf_url.startswith(('http://', 'https://')):
+        import httpx
+        return httpx.get(pdf_url).content
+    with open(pdf_url, 'rb') as f:
+        return f.read()
+
+PDF_SUMMARY_PROMPT = "请用中文给我这份PDF文件的概要总结（不超过500字），结构清晰，条理分明，重点提示和结论优先呈现。"
+
+def _timed_stage(stage, timings, fn, *args, **kwargs):
+    """执行一个处理阶段并把耗时（毫秒）记录到timings中"""
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        timings[stage] = round((time.perf_counter() - start) * 1000, 1)
+
+def _generate_summary(model, document, timings=None, pdf_bytes=None, text_document=None):
+    """生成PDF概要总结，页数较多时分块并发总结后再合并（见 pdf_summary.py）"""
+    chunks = pdf_summary.split(pdf_bytes, text_document)
+    if chunks:
+        return pdf_summary.map_reduce(model, chunks, timings)
+    return gemini_gateway.call("pdf", model.generate_content, [PDF_SUMMARY_PROMPT, document]).text
+
+def _create_cache(model_name, document):
+    """为PDF文档创建缓存内容对象，有效期取自 cache_config.cached_content_ttl"""
+    return gemini_gateway.call(
+        "pdf", genai.caching.CachedContent.create,
+        model=model_name,
+        system_instruction="You are an expert analyzing transcripts.",
+        contents=[document],
+        ttl=datetime.timedelta(seconds=float(config.get_cache_config().get('cached_content_ttl', 3600))),
+    )
+
+def _discard_cache(cache):
+    """删除不再使用的CachedContent（失败时只记录日志，缓存到期后自动失效）"""
+    try:
+        gemini_gateway.call("pdf", cache.delete)
+        logging.info(f"已删除未使用的缓存: {cache.name}")
+    except Exception as e:
+        logging.warning(f"删除缓存 {cache.name} 失败，将在到期后自动失效: {e}")
+
+def _load_or_extract_text(pdf_bytes, digest, entry):
+    """读取已保存的文本提取结果，没有时在本地提取（已判定为扫描件的文档不再重复提取）"""
+    kind = entry.get('pdf_kind') if entry else None
+    if kind == pdf_text.SCANNED:
+        return pdf_text.PdfText([], kind, digest=digest)
+    if kind == pdf_text.TEXT:
+        document = pdf_text.load(digest)
+        if document is not None:
+            return document
+    document = pdf_text.extract(pdf_bytes, digest)
+    if document.is_text:
+        pdf_text.save(document)
+    return document
+
+def _prepare_text_report(text_document, digest, entry, timings, started, progress):
+    """电子版报告：以提取的紧凑文本生成概要，后续提问也只发送文本，不上传文件、不创建CachedContent"""
+    summary = entry.get('summary') if entry and entry.get('pdf_kind') == pdf_text.TEXT else None
+    if not summary:
+        model = model_registry.get('pdf')
+        summary = _timed_stage("summary", timings, _generate_summary, model, text_document.compact(),
+                               timings, text_document=text_document)
+    progress("summarized")
+    print("概要总结：")
+    print(summary)
+
+    pdf_cache.put(digest, {
+        'pdf_kind': pdf_text.TEXT,
+        'page_count': len(text_document.pages),
+        'text_chars': text_document.char_count,
+        'summary': summary,
+    })
+    progress("cached")
+    timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+    logging.info(f"PDF为电子版（{len(text_document.pages)} 页，{text_document.char_count} 字），"
+                 f"以文本方式处理。各阶段耗时(ms): {timings}")
+    return text_document, summary
+
+def _no_progress(stage):
+    pass
+
+def upload_pdf_and_cache(pdf_url, on_stage=None):
+    """
+    上传PDF文档并创建缓存，并生成概要总结。
+
+    以PDF内容的SHA-256查询本地去重缓存：CachedContent仍有效时直接返回其名称和概要，
+    不发起任何API请求；仅缓存过期时复用已上传的文件和概要，只重建CachedContent。
+    返回的缓存可能是CachedContent对象或其名称，二者均可传给 generate_content_from_cache。
+    文件就绪后，概要生成与CachedContent创建并发执行，各阶段耗时写入日志；概要生成失败时删除
+    刚创建的缓存，缓存创建失败时保留已生成的概要，重试时只重建缓存。
+
+    上传前先在本地提取文本层（见 pdf_text.py）：电子版报告返回 PdfText，以紧凑文本生成概要和
+    回答问题；扫描件或无法提取时走上传文件的原流程。判定结果记录在去重缓存条目的 pdf_kind 中。
+
+    on_stage 为可选的进度回调，依次以 uploaded（文档就绪）、summarized、cached 调用（见 report_jobs.py）。
+    """
+    progress = on_stage or _no_progress
     logging.info("开始上传PDF文档...")
     logging.info(f"PDF文档URL: {pdf_url}")
+    timings = {}
+    started = time.perf_counter()
     try:
-        # 检查是否是 URL 还是本地文件路径
-        if pdf_url.startswith(('http://', 'https://')):
-            # 从 URL 上传
-            doc_data = io.BytesIO(httpx.get(pdf_url).content)
+        pdf_bytes = _timed_stage("read", timings, _read_pdf_bytes, pdf_url)
+        digest = PdfCache.compute_hash(pdf_bytes)
+        entry = pdf_cache.get(digest)
+
+        if entry and PdfCache.is_cache_alive(entry):
+            logging.info(f"命中PDF去重缓存: {digest}")
+            print("概要总结：")
+            print(entry['summary'])
+            for stage in ("uploaded", "summarized", "cached"):
+                progress(stage)
+            return entry['cache_name'], entry['summary']
+
+        text_document = _timed_stage("extract", timings, _load_or_extract_text, pdf_bytes, digest, entry)
+        if text_document.is_text:
+            progress("uploaded")
+            return _prepare_text_report(text_document, digest, entry, timings, started, progress)
+
+        # 远程文件仍有效时直接复用，无需重新上传
+        document = None
+        if entry and PdfCache.is_file_alive(entry):
+            try:
+                document = gemini_gateway.call("pdf", genai.get_file, entry['file_name'])
+                logging.info(f"复用已上传的PDF文件: {entry['file_name']}")
+            except Exception as e:
+                logging.warning(f"获取已上传的PDF文件失败，将重新上传: {e}")
+        if document is None:
             # 使用 upload_file 上传 PDF
-            document = genai.upload_file(doc_data, mime_type='application/pdf')
-        else:
-            # 从本地文件上传
-            with open(pdf_url, 'rb') as f:
-                document = genai.upload_file(f, mime_type='application/pdf')
+            document = _timed_stage("upload", timings, gemini_gateway.upload, "pdf", genai.upload_file,
+                                    io.BytesIO(pdf_bytes), mime_type='application/pdf')
+            file_inventory.record_file(document)
+        progress("uploaded")
 
-        # 修正顺序：先创建模型，再获取模型名称
-        model = genai.GenerativeModel("gemini-1.5-flash-002")  # PDF处理专用模型
+        # PDF处理专用模型（来自注册表，进程内只构建一次）
+        model = model_registry.get('pdf')
         model_name = model.model_name
 
-        # 生成概要总结
-        summary_response = model.generate_content(["请用中文给我这份PDF文件的概要总结（不超过500字），结构清晰，条理分明，重点提示和结论优先呈现。", document])
+        # 概要总结与缓存创建互不依赖，并发执行（已有概要时直接复用）
+        summary = entry.get('summary') if entry else None
+        record = {
+            'file_name': document.name,
+            'file_expire_time': document.expiration_time.timestamp(),
+            'pdf_kind': text_document.kind,
+        }
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="pdf-stage") as pool:
+            cache_future = pool.submit(_timed_stage, "cache", timings, _create_cache, model_name, document)
+            summary_error = None
+            if not summary:
+                summary_future = pool.submit(_timed_stage, "summary", timings, _generate_summary, model, document,
+                                             timings, pdf_bytes=pdf_bytes)
+                try:
+                    summary = summary_future.result()
+                except Exception as e:
+                    summary_error = e
+            if summary_error is None:
+                progress("summarized")
+            try:
+                cache = cache_future.result()
+            except Exception:
+                if summary_error is None and not (entry and entry.get('summary')):
+                    # 保存已生成的概要和文件，重试时只需重建缓存
+                    pdf_cache.put(digest, dict(record, summary=summary))
+                raise
+            if summary_error is not None:
+                # 概要生成失败时删除刚创建的缓存，避免其在有效期内闲置计费
+                _discard_cache(cache)
+                raise summary_error
+            progress("cached")
         print("概要总结：")
-        print(summary_response.text)
+        print(summary)
 
-        # 创建缓存内容对象
-        cache = genai.caching.CachedContent.create(
-            model=model_name,
-            system_instruction="You are an expert analyzing transcripts.",
-            contents=[document],
-        )
+        pdf_cache.put(digest, dict(record, summary=summary, cache_name=cache.name,
+                                   cache_expire_time=cache.expire_time.timestamp()))
 
-        logging.info("PDF文档上传成功，并生成缓存。")
-        return cache, summary_response.text  # 返回缓存和概要总结
+        timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+        logging.info(f"PDF文档上传成功，并生成缓存。各阶段耗时(ms): {timings}")
+        return cache, summary  # 返回缓存和概要总结
     except Exception as e:
         print(f"上传PDF文档时出错: {e}")
         return None, None
 
+def resolve_cache(cache):
+    """
+    把缓存名称解析为CachedContent对象。
+    SDK的 from_cached_content 收到名称时会直接调用 CachedContent.get，绕过网关的密钥路由、重试和指标，
+    因此先经网关获取对象（固定使用创建该缓存的密钥）。
+    """
+    if isinstance(cache, str):
+        return gemini_gateway.call("report", genai.caching.CachedContent.get, cache)
+    return cache
+
 def generate_content_from_cache(cache, prompt):
-    """从缓存生成内容。"""
-    model = genai.GenerativeModel.from_cached_content(cache)
-    response = model.generate_content(prompt)
+    """
+    从缓存生成内容。cache 可以是CachedContent对象或其名称；
+    为 PdfText（电子版报告）时只发送提取的文本或与问题相关的页面。
+    """
+    if isinstance(cache, pdf_text.PdfText):
+        return gemini_gateway.call("report", model_registry.get('pdf').generate_content, cache.build_contents(prompt))
+    model = genai.GenerativeModel.from_cached_content(resolve_cache(cache))
+    response = gemini_gateway.call("report", model.generate_content, prompt)
     return response
 
+async def generate_content_from_cache_async(cache, prompt):
+    """generate_content_from_cache() 的异步版本（见 api_server.py），等待模型响应时不阻塞事件循环"""
+    if isinstance(cache, pdf_text.PdfText):
+        return await gemini_gateway.call_async("report", model_registry.get('pdf').generate_content_async,
+                                               cache.build_contents(prompt))
+    if isinstance(cache, str):
+        cache = await asyncio.to_thread(resolve_cache, cache)
+    model = genai.GenerativeModel.from_cached_content(cache)
+    return await gemini_gateway.call_async("report", model.generate_content_async, prompt)
+
+def stream_content_from_cache(cache, prompt):
+    """从缓存以流式方式生成内容，逐块产出文本。"""
+    if isinstance(cache, pdf_text.PdfText):
+        return stream_call("report", model_registry.get('pdf').generate_content, cache.build_contents(prompt))
+    model = genai.GenerativeModel.from_cached_content(resolve_cache(cache))
+    return stream_call("report", model.generate_content, prompt)
+
+def print_stream(chunks):
+    """边接收边打印流式响应，返回完整文本。"""
+    parts = []
+    for text in chunks:
+        print(text, end="", flush=True)
+        parts.append(text)
+    print()
+    return "".join(parts)
+
 def show_menu():
     """显示主菜单"""
     print("\n=== 医疗报告解读系统 ===")
@@ -103,8 +298,12 @@ def get_local_image():
             return path
         print("文件不存在，请重新输入")
 
-def analyze_image(image_path, image_type="病理"):
-    """处理图片分析的核心逻辑"""
+def analyze_image(image_path, image_type="病理", on_chunk=None, session=None):
+    """
+    处理图片分析的核心逻辑
+    :param on_chunk: 可选回调，提供时以流式方式调用模型，并在每个文本块到达时调用
+    :param session: 可选的ChatSession，默认使用全局 chat_session
+    """
     logging.info("开始处理图片...")
     logging.info(f"图片路径: {image_path}")
     # 添加文件类型检查
@@ -139,7 +338,7 @@ def analyze_image(image_path, image_type="病理"):
     try:
         logging.info("开始分析图片...")
         prompt_config = analysis_prompts.get(image_type, analysis_prompts["病理"])
-        image_file = upload_to_gemini(image_path, mime_type=prompt_config["mime_type"])
+        image_file = upload_to_gemini(image_path, mime_type=prompt_config["mime_type"], image_type=image_type)
         
         analysis_message = {
             "role": "user",
@@ -149,9 +348,17 @@ def analyze_image(image_path, image_type="病理"):
             ]
         }
         
-        response = chat_session.send_message(analysis_message)
-        logging.info(f"分析结果: {response.text}")
-        return {"success": True, "analysis": response.text}
+        session = session or chat_session
+        if on_chunk is None:
+            analysis = gemini_gateway.call("vision", session.send_message, analysis_message).text
+        else:
+            parts = []
+            for text in stream_call("vision", session.send_message, analysis_message):
+                on_chunk(text)
+                parts.append(text)
+            analysis = "".join(parts)
+        logging.info(f"分析结果: {analysis}")
+        return {"success": True, "analysis": analysis}
         
     except Exception as e:
         return {"success": False, "error": str(e)}
@@ -207,9 +414,11 @@ def handle_report_analysis():
                 question = input("\n请输入您的具体问题：").strip()
                 if question.lower() in ['退出', 'exit', 'quit']:
                     break
-                result = generate_content_from_cache(cache, question)
                 print("\n回答：")
-                print(result.text)
+                if config.is_streaming_enabled():
+                    print_stream(stream_content_from_cache(cache, question))
+                else:
+                    print(generate_content_from_cache(cache, question).text)
             elif chat_choice == "3":
                 break
             else:
@@ -241,19 +450,30 @@ def handle_image_analysis():
         return
     
     print(f"\n正在分析{image_type}图片...")
-    result = analyze_image(image_path, image_type)
-    if result["success"]:
+    if config.is_streaming_enabled():
         print("\n分析结果：")
-        print(result["analysis"])
+        result = analyze_image(image_path, image_type, on_chunk=lambda text: print(text, end="", flush=True))
+        print()
+    else:
+        result = analyze_image(image_path, image_type)
+        if result["success"]:
+            print("\n分析结果：")
+            print(result["analysis"])
+    if result["success"]:
         while True:
             continue_dialogue = input("是否继续围绕图片解析内容进行对话？（y/n 或 是/否）：").strip().lower()
             if continue_dialogue in ['否', 'n']:  # 支持输入否或n
                 break
             elif continue_dialogue in ['是', 'y']:
                 user_question = input("请输入您的问题：").strip()
-                response = chat_session.send_message(user_question)
                 print("\n回答：")
-                print(response.text)
+                response = None
+                if config.is_streaming_enabled():
+                    print_stream(stream_call("vision", chat_session.send_message, user_question))
+                else:
+                    response = gemini_gateway.call("vision", chat_session.send_message, user_question)
+                    print(response.text)
+                history_compactor.maybe_compact(chat_session, response)
             else:
                 print("无效的选择，请输入'是'或'否'。")
     else:
@@ -269,9 +489,15 @@ def main():
             handle_report_analysis()
         elif choice == "3":
             user_input = input("\n请输入您的问题：")
-            response = chat_session.send_message(f"{prompt}\n{user_input}")
             print("\n回答：")
-            print(response.text)
+            response = None
+            if config.is_streaming_enabled():
+                print_stream(stream_call("chat", chat_session.send_message, user_input))
+            else:
+                response = gemini_gateway.call("chat", chat_session.send_message, user_input)
+                print(response.text)
+            # 历史超出token预算时压缩为滚动摘要
+            history_compactor.maybe_compact(chat_session, response)
         elif choice == "4":
             from mange_filelist import manage_files  # 导入文件管理功能
             manage_files()
@@ -282,6 +508,16 @@ def main():
             print("无效的选择，请重试")
 
 if __name__ == "__main__":
+    # 配置API密钥
+    try:
+        configure_genai()
+    except ValueError as e:
+        print(f"错误：{e}")
+        exit(1)
+
+    # 配置了 metrics.json_path 时退出前导出运行指标
+    register_json_dump()
+
     # 清理缓存
     # genai.caching.clear_all()  # 清除所有缓存
     
@@ -294,9 +530,12 @@ if __name__ == "__main__":
         "response_mime_type": "text/plain",
     }
     
+    prompt = "你是一位专业的胰腺癌医生，可以解读报告，以通俗易懂的方式，帮助病人解释复杂的属于，提示关键信息，以及未来和治疗相关的内容提示.如果告有术语，请先解释下这个术语和指标的定义，意义，以及和病情相关的提示。"
+    
     model = genai.GenerativeModel(
         model_name="gemini-2.0-flash-exp",  # 主程序使用的模型
         generation_config=generation_config,
+        system_instruction=prompt,  # 提示词作为系统指令，不再随每条消息重复发送
     )
 
     # 定义初始聊天历史
@@ -306,7 +545,5 @@ if __name__ == "__main__":
     chat_session = model.start_chat(history=initial_history)
     logging.info("聊天会话已启动。")
     
-    prompt = "你是一位专业的胰腺癌医生，可以解读报告，以通俗易懂的方式，帮助病人解释复杂的属于，提示关键信息，以及未来和治疗相关的内容提示.如果告有术语，请先解释下这个术语和指标的定义，意义，以及和病情相关的提示。"
-    
     # 运行主程序
     main()
\ No newline at end of file
@@ -1,23 +1,36 @@
-import google.generativeai as genai
-from IPython.display import Markdown
+from genai_backend import genai, configure_genai
+import contextlib
 import logging
+from file_inventory import file_inventory
+import gemini_gateway
+from key_pool import key_pool
+from pdf_cache import pdf_cache
 
-def list_all_files():
-    """列出所有上传的文件"""
+def list_all_files(refresh=False, offset=0, limit=None, verbose=True):
+    """
+    列出所有上传的文件
+    :param refresh: 为True时强制从远程刷新本地索引，否则仅在索引过期时刷新
+    :param offset: 分页起始位置
+    :param limit: 每页数量，None表示全部
+    :param verbose: 是否打印文件列表
+    """
     try:
-        # 列出普通文件
-        files = list(genai.list_files())
+        file_inventory.refresh(force=refresh)
+        files = file_inventory.page(offset=offset, limit=limit)
         total_files = []
         
         if not files:
-            print("当前没有已上传的文件")
+            if verbose:
+                print("当前没有已上传的文件")
         else:
-            print("\n=== 已上传文件列表 ===")
-            for i, file in enumerate(files, 1):
-                print(f"{i}. 文件名: {file.display_name}")
-                print(f"   文件URI: {file.uri}")
-                print(f"   类型: 普通文件")
-                print("-" * 50)
+            if verbose:
+                print("\n=== 已上传文件列表 ===")
+            for i, file in enumerate(files, offset + 1):
+                if verbose:
+                    print(f"{i}. 文件名: {file.display_name}")
+                    print(f"   文件URI: {file.uri}")
+                    print(f"   类型: 普通文件")
+                    print("-" * 50)
                 total_files.append(("file", file))
 
         return total_files
@@ -25,11 +38,23 @@ def list_all_files():
         print(f"列出文件时发生错误: {e}")
         return []
 
+def count_files():
+    """已上传文件的数量（读取本地索引）"""
+    file_inventory.refresh()
+    return file_inventory.count()
+
+def find_file(display_name):
+    """按显示名查找文件，返回 (file_type, file) 或 None"""
+    file_inventory.refresh()
+    file = file_inventory.find_by_display_name(display_name)
+    return ("file", file) if file else None
+
 def delete_file(file_type, file_obj):
     """删除指定的文件"""
     try:
         if file_type == "file":
-            genai.delete_file(file_obj.name)
+            gemini_gateway.call("files", genai.delete_file, file_obj.name)
+            file_inventory.remove(file_obj.name)
             print(f'已成功删除文件: {file_obj.display_name}')
             return True
     except Exception as e:
@@ -37,10 +62,23 @@ def delete_file(file_type, file_obj):
         return False
 
 def clear_all_cache():
-    """清理所有缓存"""
+    """
+    清理所有缓存：SDK没有批量清理的接口，逐个密钥列出CachedContent后经网关逐个删除，
+    并让PDF去重缓存不再返回已删除的缓存（下次分析同一报告时重建）
+    """
     try:
-        genai.caching.clear_all()
-        print("已成功清理所有缓存")
+        caches = []
+        for key in key_pool.keys() if key_pool.enabled else [None]:
+            with gemini_gateway.track("pdf", "list_cached_contents"):
+                with key_pool.use(key) if key is not None else contextlib.nullcontext():
+                    for cache in genai.caching.CachedContent.list():
+                        if key is not None:
+                            key_pool.pin(cache, key)
+                        caches.append(cache)
+        for cache in caches:
+            gemini_gateway.call("pdf", cache.delete)
+            pdf_cache.update_cache_expiry(cache.name, 0)
+        print(f"已成功清理所有缓存，共 {len(caches)} 个")
         return True
     except Exception as e:
         print(f"清理缓存时发生错误: {e}")
@@ -58,7 +96,7 @@ def manage_files():
         choice = input("请选择操作 (1-4): ").strip()
         
         if choice == "1":
-            list_all_files()
+            list_all_files(refresh=True)
         elif choice == "2":
             files = list_all_files()
             if files:
@@ -86,4 +124,5 @@ def manage_files():
             print("无效的选择，请重试")
 
 if __name__ == "__main__":
+    configure_genai()
     manage_files()
\ No newline at end of file
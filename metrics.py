@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+运行指标
+
+进程内的计数器、仪表和直方图，按标签（flow、model 等）分别统计。可以通过
+start_metrics_server() 启动的HTTP端点以Prometheus文本格式导出（/metrics），
+也可以导出为JSON（/metrics.json 或 dump_json()），用于容量规划和发现性能回退。
+不依赖 prometheus_client。
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 延迟直方图的默认分桶（秒）
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Family:
+    """同名指标的一组带标签的时间序列"""
+
+    TYPE = ''
+
+    def __init__(self, name: str, help_text: str, lock: threading.Lock):
+        self.name = name
+        self.help = help_text
+        self._lock = lock
+        self._series: Dict[LabelKey, Any] = {}
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+
+
+class Counter(_Family):
+    """只增不减的计数器"""
+
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, value in sorted(self._series.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_format_number(value)}")
+        return lines
+
+    def to_dict(self) -> List[Dict[str, Any]]:
+        return [{'labels': dict(key), 'value': value} for key, value in sorted(self._series.items())]
+
+
+class Gauge(Counter):
+    """可增可减、可直接设置的仪表"""
+
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._series[_label_key(labels)] = float(value)
+
+
+class Histogram(_Family):
+    """累积分桶直方图"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help_text: str, lock: threading.Lock, buckets: Sequence[float]):
+        super().__init__(name, help_text, lock)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_number(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_number(series['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+    def to_dict(self) -> List[Dict[str, Any]]:
+        result = []
+        for key, series in sorted(self._series.items()):
+            cumulative, buckets = 0, {}
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                buckets[_format_number(bound)] = cumulative
+            result.append({'labels': dict(key), 'count': series['count'],
+                           'sum': round(series['sum'], 6), 'buckets': buckets})
+        return result
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families: Dict[str, _Family] = {}
+
+    def _get_or_create(self, cls, name: str, help_text: str, *args):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = cls(name, help_text, threading.Lock(), *args)
+            return family
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._get_or_create(Counter, name, help_text)
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, buckets)
+
+    def render_prometheus(self) -> str:
+        """Prometheus文本格式"""
+        with self._lock:
+            families = list(self._families.values())
+        lines: List[str] = []
+        for family in families:
+            with family._lock:
+                lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON可序列化的快照"""
+        with self._lock:
+            families = list(self._families.values())
+        result: Dict[str, Any] = {'timestamp': time.time()}
+        for family in families:
+            with family._lock:
+                result[family.name] = {'type': family.TYPE, 'help': family.help, 'series': family.to_dict()}
+        return result
+
+    def dump_json(self, path: str) -> None:
+        """把当前指标写入JSON文件"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+# 创建全局指标注册表实例
+metrics = MetricsRegistry()
+
+# Gemini调用相关指标
+REQUEST_DURATION = metrics.histogram('gemini_request_duration_seconds', 'Gemini API调用耗时')
+STREAM_FIRST_TOKEN = metrics.histogram('gemini_stream_first_token_seconds', '流式调用的首字延迟')
+REQUESTS = metrics.counter('gemini_requests_total', 'Gemini API调用次数（按结果）')
+ERRORS = metrics.counter('gemini_errors_total', 'Gemini API调用错误次数（按异常类型）')
+PROMPT_TOKENS = metrics.counter('gemini_prompt_tokens_total', '输入token数（usage_metadata）')
+RESPONSE_TOKENS = metrics.counter('gemini_response_tokens_total', '输出token数（usage_metadata）')
+CACHED_TOKENS = metrics.counter('gemini_cached_tokens_total', '命中上下文缓存的token数（usage_metadata）')
+UPLOAD_BYTES = metrics.counter('gemini_upload_bytes_total', '上传到Gemini的字节数')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body = metrics.render_prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body = json.dumps(metrics.to_dict(), ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # 抓取请求很频繁，不写入日志
+        pass
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_json_dump_registered = False
+
+
+def register_json_dump() -> None:
+    """配置了 system_config.metrics.json_path 时在进程退出前把指标导出为JSON（幂等，供命令行程序调用）"""
+    global _json_dump_registered
+    json_path = config.get_metrics_config().get('json_path')
+    if json_path and not _json_dump_registered:
+        atexit.register(metrics.dump_json, json_path)
+        _json_dump_registered = True
+
+
+def start_metrics_server(host: Optional[str] = None, port: Optional[int] = None) -> Optional[ThreadingHTTPServer]:
+    """
+    按 system_config.metrics 启动指标HTTP端点（幂等），并调用 register_json_dump()
+    端口被占用（如同一台机器上的多个进程）时只记录警告
+    """
+    global _server
+    metrics_config = config.get_metrics_config()
+    register_json_dump()
+    if _server is not None or not metrics_config.get('enabled', True):
+        return _server
+
+    host = host or metrics_config.get('host', '127.0.0.1')
+    port = int(port if port is not None else metrics_config.get('port', 9464))
+    try:
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning(f"指标端点启动失败（{host}:{port}）: {e}")
+        return None
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f"指标端点已启动：http://{host}:{port}/metrics")
+    return _server
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+进程级模型注册表
+
+按 model_config 中的每一项（chat/vision/pdf）构建一次 GenerativeModel 并在进程内复用，
+避免Streamlit每次重跑、每次报告对话都重新构建模型。配置热更新后，只有参数实际变化的
+模型才会重建。可选在启动时用一个极小的请求预热（system_config.model_registry.warmup），
+提前建立与API的连接；各模型的构建和预热耗时可通过 timings() 查看。
+
+Streamlit 中用 st.cache_resource 包装 init_models()，其他入口直接使用 `model_registry`。
+"""
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from config import config
+from genai_backend import genai, configure_genai
+import gemini_gateway
+
+logger = logging.getLogger(__name__)
+
+# 作为系统指令的提示词（模型类型 -> prompts 中的键）
+SYSTEM_INSTRUCTION_PROMPTS = {
+    'chat': 'chat',
+}
+
+# 未配置时使用的默认模型
+DEFAULT_MODEL_NAMES = {
+    'chat': 'gemini-2.0-flash-exp',
+    'vision': 'gemini-2.0-flash-exp',
+    'pdf': 'gemini-1.5-flash-002',
+}
+
+WARMUP_PROMPT = "ping"
+
+
+class ModelRegistry:
+    """GenerativeModel 注册表"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models: Dict[str, Tuple[Tuple, Any]] = {}
+        self._timings: Dict[str, Dict[str, Any]] = {}
+
+    @staticmethod
+    def _spec(kind: str) -> Tuple:
+        """当前配置下构建该模型所需的参数"""
+        model_config = config.get_model_config().get(kind, {})
+        prompt_key = SYSTEM_INSTRUCTION_PROMPTS.get(kind)
+        return (
+            model_config.get('model_name', DEFAULT_MODEL_NAMES.get(kind, 'gemini-2.0-flash-exp')),
+            model_config.get('temperature', 0.7),
+            model_config.get('max_output_tokens', 2048),
+            config.get_prompts().get(prompt_key) if prompt_key else None,
+        )
+
+    def get(self, kind: str):
+        """
+        获取某类模型，首次访问或配置变化时构建
+        :param kind: model_config 中的键，如 chat/vision/pdf
+        """
+        spec = self._spec(kind)
+        cached = self._models.get(kind)
+        if cached is not None and cached[0] == spec:
+            return cached[1]
+        with self._lock:
+            cached = self._models.get(kind)
+            if cached is not None and cached[0] == spec:
+                return cached[1]
+            model_name, temperature, max_output_tokens, system_instruction = spec
+            start = time.perf_counter()
+            model = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=genai.GenerationConfig(
+                    temperature=temperature,
+                    max_output_tokens=max_output_tokens,
+                ),
+                system_instruction=system_instruction,
+            )
+            build_ms = round((time.perf_counter() - start) * 1000, 2)
+            self._models[kind] = (spec, model)
+            self._timings[kind] = {'model_name': model_name, 'build_ms': build_ms, 'warmup_ms': None}
+            logger.info(f"模型 {kind}（{model_name}）{'重建' if cached else '构建'}完成，耗时 {build_ms}ms")
+            return model
+
+    def build_all(self) -> None:
+        """构建 model_config 中的全部模型"""
+        for kind in config.get_model_config():
+            self.get(kind)
+
+    def warmup(self, kinds: Optional[Iterable[str]] = None) -> None:
+        """
+        用极小的请求预热模型（失败只记录日志，不影响启动）
+        :param kinds: 需要预热的模型类型，默认全部
+        """
+        for kind in list(kinds or config.get_model_config()):
+            model = self.get(kind)
+            start = time.perf_counter()
+            try:
+                gemini_gateway.call("warmup", model.generate_content, WARMUP_PROMPT,
+                                    generation_config={'max_output_tokens': 1})
+            except Exception as e:
+                logger.warning(f"模型 {kind} 预热失败: {e}")
+                continue
+            warmup_ms = round((time.perf_counter() - start) * 1000, 1)
+            self._timings[kind]['warmup_ms'] = warmup_ms
+            logger.info(f"模型 {kind} 预热完成，耗时 {warmup_ms}ms")
+
+    def timings(self) -> Dict[str, Dict[str, Any]]:
+        """各模型的构建和预热耗时（毫秒）"""
+        return {kind: dict(values) for kind, values in self._timings.items()}
+
+
+# 创建全局模型注册表实例
+model_registry = ModelRegistry()
+
+
+def init_models(warmup: Optional[bool] = None) -> ModelRegistry:
+    """
+    配置API密钥并构建全部模型，按配置决定是否预热
+    :param warmup: 是否预热，默认读取 system_config.model_registry.warmup
+    """
+    configure_genai()
+    model_registry.build_all()
+    if warmup if warmup is not None else config.get_model_registry_config().get('warmup', False):
+        model_registry.warmup()
+    return model_registry
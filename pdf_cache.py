@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+PDF去重缓存
+
+以PDF内容的SHA-256为键，把远程文件名、CachedContent名称及其过期时间、概要总结
+持久化到 config.get_cache_path() 下。同一份报告重复上传时直接命中本地索引，
+不再调用任何API。条目数量和保留时长由 system_config.cache_config 控制。
+索引文件被其他进程（如多个API服务worker）更新后，下次读写前会重新加载。
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class PdfCache:
+    """PDF去重缓存类"""
+
+    INDEX_FILENAME = 'pdf_cache.json'
+    # 远程资源临近过期时视为失效，留出发起请求的余量（秒）
+    EXPIRY_MARGIN = 60
+    # 命中时 last_access 至少前进这么多秒才写回索引文件（只用于淘汰排序，不必每次读都整文件重写）
+    ACCESS_WRITE_INTERVAL = 300
+
+    def __init__(self, cache_path: Optional[str] = None,
+                 retention_hours: Optional[float] = None,
+                 max_size: Optional[int] = None):
+        """
+        初始化缓存
+        :param cache_path: 索引文件所在目录，默认使用 config.get_cache_path()
+        :param retention_hours: 条目保留时长（小时），默认读取 cache_config.retention_period
+        :param max_size: 最多保留的条目数，默认读取 cache_config.max_size
+        """
+        cache_config = config.get_cache_config()
+        if retention_hours is None:
+            retention_hours = cache_config.get('retention_period', 24)
+        if max_size is None:
+            max_size = cache_config.get('max_size', 100)
+
+        self.cache_path = cache_path or config.get_cache_path()
+        self.index_path = os.path.join(self.cache_path, self.INDEX_FILENAME)
+        self.retention_seconds = float(retention_hours) * 3600
+        self.max_size = int(max_size)
+        self._lock = threading.Lock()
+        self._loaded_mtime = self._index_mtime()
+        self._entries = self._load()
+
+    @staticmethod
+    def compute_hash(data: bytes) -> str:
+        """计算PDF内容的SHA-256摘要"""
+        return hashlib.sha256(data).hexdigest()
+
+    @classmethod
+    def is_cache_alive(cls, entry: Dict[str, Any], now: Optional[float] = None) -> bool:
+        """检查条目中的CachedContent是否仍然可用"""
+        now = time.time() if now is None else now
+        expire_time = entry.get('cache_expire_time')
+        return bool(entry.get('cache_name')) and expire_time is not None \
+            and expire_time - cls.EXPIRY_MARGIN > now
+
+    @classmethod
+    def is_file_alive(cls, entry: Dict[str, Any], now: Optional[float] = None) -> bool:
+        """检查条目中的远程文件是否仍然可用"""
+        now = time.time() if now is None else now
+        expire_time = entry.get('file_expire_time')
+        return bool(entry.get('file_name')) and expire_time is not None \
+            and expire_time - cls.EXPIRY_MARGIN > now
+
+    def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        """
+        查询缓存条目
+        :param digest: PDF内容的SHA-256摘要
+        :return: 条目副本；不存在或已超过保留时长时返回None
+        """
+        now = time.time()
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if self._is_expired(entry, now):
+                del self._entries[digest]
+                self._save()
+                return None
+            if now - entry.get('last_access', 0) >= self.ACCESS_WRITE_INTERVAL:
+                entry['last_access'] = now
+                self._save()
+            return dict(entry)
+
+    def put(self, digest: str, entry: Dict[str, Any]) -> None:
+        """
+        写入或覆盖缓存条目
+        :param digest: PDF内容的SHA-256摘要
+        :param entry: 包含 file_name、file_expire_time、cache_name、cache_expire_time、summary 等字段
+        """
+        now = time.time()
+        with self._lock:
+            self._sync()
+            previous = self._entries.get(digest, {})
+            record = dict(entry)
+            record['created_at'] = previous.get('created_at', now)
+            record['last_access'] = now
+            self._entries[digest] = record
+            self._prune(now)
+            self._save()
+
+    def update_cache_expiry(self, cache_name: str, expire_time: float) -> None:
+        """
+        更新某个CachedContent的过期时间（延长有效期后调用；传入0表示缓存已失效，下次需重建）
+        :param cache_name: CachedContent名称
+        :param expire_time: 新的过期时间戳
+        """
+        with self._lock:
+            self._sync()
+            changed = False
+            for entry in self._entries.values():
+                if entry.get('cache_name') == cache_name:
+                    entry['cache_expire_time'] = expire_time
+                    changed = True
+            if changed:
+                self._save()
+
+    def remove(self, digest: str) -> None:
+        """删除缓存条目"""
+        with self._lock:
+            self._sync()
+            if self._entries.pop(digest, None) is not None:
+                self._save()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _is_expired(self, entry: Dict[str, Any], now: float) -> bool:
+        """条目是否超过保留时长"""
+        return entry.get('created_at', 0) + self.retention_seconds <= now
+
+    def _prune(self, now: float) -> None:
+        """清除过期条目，并按最近访问时间淘汰超出 max_size 的条目"""
+        for digest in [d for d, e in self._entries.items() if self._is_expired(e, now)]:
+            del self._entries[digest]
+
+        overflow = len(self._entries) - self.max_size
+        if overflow > 0:
+            oldest = sorted(self._entries, key=lambda d: self._entries[d].get('last_access', 0))
+            for digest in oldest[:overflow]:
+                del self._entries[digest]
+
+    def _index_mtime(self) -> float:
+        try:
+            return os.path.getmtime(self.index_path)
+        except OSError:
+            return 0.0
+
+    def _sync(self) -> None:
+        """索引文件已被其他进程更新时重新加载"""
+        mtime = self._index_mtime()
+        if mtime != self._loaded_mtime:
+            self._entries = self._load()
+            self._loaded_mtime = mtime
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        """从索引文件加载条目"""
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            logger.info(f"已加载PDF去重缓存，共 {len(entries)} 条")
+            return entries
+        except Exception as e:
+            logger.error(f"加载PDF去重缓存失败: {e}")
+            return {}
+
+    def _save(self) -> None:
+        """原子写入索引文件"""
+        # 每个进程使用各自的临时文件，多个worker同时保存时互不覆盖
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+            self._loaded_mtime = self._index_mtime()
+        except Exception as e:
+            logger.error(f"保存PDF去重缓存失败: {e}")
+
+
+# 创建全局PDF去重缓存实例
+pdf_cache = PdfCache()
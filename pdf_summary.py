@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+大型PDF的分块概要总结（map-reduce）
+
+80～150页的基因检测、病理报告合集用一次调用总结整份文档时很慢，有时还会超出输出上限。
+页数达到 min_pages 时把文档按 pages_per_chunk 页切分，以不超过 concurrency 的并发度分别
+总结各部分（map），再把各部分摘要合并为最终不超过 max_chars 字的概要总结（reduce）。
+
+电子版报告按页切分提取出的文本；扫描件用 pypdf 拆分为若干小PDF，以内联数据发送。
+参数来自 system_config.pdf_summary，各阶段耗时写入日志。
+"""
+import io
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import gemini_gateway
+from config import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    'enabled': True,
+    # 页数达到该值时才分块总结
+    'min_pages': 80,
+    'pages_per_chunk': 20,
+    'concurrency': 8,
+    'max_chars': 500,
+}
+
+CHUNK_PROMPT = ("请用中文总结这份PDF报告第{start}-{end}页的内容（不超过{chars}字），"
+                "保留关键指标、异常结果和结论，不要遗漏重要发现。")
+REDUCE_PROMPT = ("以下是一份PDF报告按页分段的摘要，请合并为整份报告的中文概要总结（不超过{chars}字），"
+                 "结构清晰，条理分明，重点提示和结论优先呈现。")
+
+# (起始页, 结束页, 该部分的内容)，页码从1开始
+Chunk = Tuple[int, int, Any]
+
+_overrides: Dict[str, Any] = {}
+
+
+def configure(**overrides) -> None:
+    """在运行时覆盖配置项（如基准测试中比较分块前后），传入None表示恢复配置值"""
+    for key, value in overrides.items():
+        if value is None:
+            _overrides.pop(key, None)
+        else:
+            _overrides[key] = value
+
+
+def get_options() -> Dict[str, Any]:
+    """获取合并默认值后的分块总结参数"""
+    options = dict(DEFAULT_OPTIONS)
+    options.update(config.get_pdf_summary_config())
+    options.update(_overrides)
+    return options
+
+
+def _page_ranges(page_count: int, pages_per_chunk: int) -> List[Tuple[int, int]]:
+    size = max(int(pages_per_chunk), 1)
+    return [(start, min(start + size - 1, page_count)) for start in range(1, page_count + 1, size)]
+
+
+def _split_pdf(pdf_bytes: bytes, pages_per_chunk: int, min_pages: int) -> Optional[List[Chunk]]:
+    """用 pypdf 把扫描件拆分为若干小PDF（未安装 pypdf 或页数不足时返回None）"""
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        return None
+    try:
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        page_count = len(reader.pages)
+        if page_count < min_pages:
+            return None
+        chunks = []
+        for start, end in _page_ranges(page_count, pages_per_chunk):
+            writer = PdfWriter()
+            for index in range(start - 1, end):
+                writer.add_page(reader.pages[index])
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            chunks.append((start, end, {'mime_type': 'application/pdf', 'data': buffer.getvalue()}))
+        return chunks
+    except Exception as e:
+        logger.warning(f"拆分PDF失败，改为整份总结: {e}")
+        return None
+
+
+def split(pdf_bytes: Optional[bytes] = None, text_document=None) -> Optional[List[Chunk]]:
+    """
+    按页切分文档
+    :param pdf_bytes: PDF文件内容（扫描件时使用）
+    :param text_document: pdf_text.PdfText（电子版时使用）
+    :return: 各部分的列表；未启用或页数未达到 min_pages 时返回None，表示整份总结
+    """
+    options = get_options()
+    if not options['enabled']:
+        return None
+    min_pages = int(options['min_pages'])
+    pages_per_chunk = int(options['pages_per_chunk'])
+    if text_document is not None and text_document.is_text:
+        if len(text_document.pages) < min_pages:
+            return None
+        return [(start, end, text_document.compact(list(range(start, end + 1))))
+                for start, end in _page_ranges(len(text_document.pages), pages_per_chunk)]
+    if pdf_bytes:
+        return _split_pdf(pdf_bytes, pages_per_chunk, min_pages)
+    return None
+
+
+def _summarize_chunk(model, chunk: Chunk, chars: int) -> str:
+    start, end, content = chunk
+    prompt = CHUNK_PROMPT.format(start=start, end=end, chars=chars)
+    # 限制各部分的输出长度（中文约每字1～2个token），避免个别部分生成过长拖慢整体
+    return gemini_gateway.call("pdf", model.generate_content, [prompt, content],
+                               generation_config={'max_output_tokens': chars * 2}).text
+
+
+def map_reduce(model, chunks: List[Chunk], timings: Optional[Dict[str, float]] = None) -> str:
+    """
+    并发总结各部分后合并为最终概要
+    :param model: PDF处理模型
+    :param chunks: split() 的结果
+    :param timings: 可选，写入 summary_map / summary_reduce 阶段耗时（毫秒）
+    """
+    options = get_options()
+    max_chars = int(options['max_chars'])
+    # 各部分摘要的总长度控制在最终概要的数倍以内，合并时不至于过长
+    chunk_chars = max(max_chars * 3 // len(chunks), 150)
+    workers = max(1, min(int(options['concurrency']), len(chunks)))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pdf-summary') as pool:
+        partials = list(pool.map(lambda chunk: _summarize_chunk(model, chunk, chunk_chars), chunks))
+    map_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    start = time.perf_counter()
+    merged = '\n\n'.join(f"[第{s}-{e}页]\n{text}" for (s, e, _), text in zip(chunks, partials))
+    summary = gemini_gateway.call("pdf", model.generate_content,
+                                  [REDUCE_PROMPT.format(chars=max_chars), merged]).text
+    reduce_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    if timings is not None:
+        timings['summary_map'] = map_ms
+        timings['summary_reduce'] = reduce_ms
+    logger.info(f"分块概要总结完成：{len(chunks)} 个部分（并发 {workers}），"
+                f"map {map_ms}ms，reduce {reduce_ms}ms")
+    return summary
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+PDF文本层提取
+
+在上传到Gemini之前先在本地提取PDF每一页的文本（及表格），判断文档是电子版（有文本层）
+还是扫描件。电子版报告以紧凑文本发送给模型，问题较多涉及少数几页时只发送相关页面，
+请求体积、费用和延迟都远小于上传整个PDF文件；扫描件仍走上传文件的原有流程。
+
+依赖 pdfplumber（可提取表格）或 pypdf，均为可选，都未安装时所有文档按原流程处理。
+参数来自 system_config.pdf_text，提取结果按PDF内容的SHA-256保存在缓存目录下。
+"""
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    'enabled': True,
+    # auto：优先pdfplumber（含表格），未安装时使用pypdf
+    'engine': 'auto',
+    # 一页至少有这么多字符才算有文本层
+    'min_chars_per_page': 50,
+    # 有文本层的页面占比达到该值时按电子版处理
+    'text_page_ratio': 0.8,
+    # 全文不超过该字符数时整份发送，否则只发送与问题相关的页面
+    'inline_max_chars': 30000,
+    'max_relevant_pages': 5,
+}
+
+TEXT = 'text'
+SCANNED = 'scanned'
+UNKNOWN = 'unknown'
+
+TEXT_DIR = 'pdf_text'
+
+
+def get_options() -> Dict[str, Any]:
+    """获取合并默认值后的提取参数"""
+    options = dict(DEFAULT_OPTIONS)
+    options.update(config.get_pdf_text_config())
+    return options
+
+
+def _compact(text: str) -> str:
+    """压缩多余的空白和空行"""
+    text = re.sub(r'[ \t　\xa0]+', ' ', text or '')
+    return '\n'.join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def _bigrams(text: str) -> set:
+    """字符二元组（中文不分词也能比较相关度）"""
+    text = re.sub(r'\s+', '', text.lower())
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class PdfText:
+    """一份PDF的本地提取结果"""
+
+    def __init__(self, pages: List[str], kind: str, engine: Optional[str] = None, digest: Optional[str] = None):
+        self.pages = pages
+        self.kind = kind
+        self.engine = engine
+        self.digest = digest
+
+    @property
+    def is_text(self) -> bool:
+        return self.kind == TEXT
+
+    @property
+    def char_count(self) -> int:
+        return sum(len(page) for page in self.pages)
+
+    def compact(self, page_numbers: Optional[List[int]] = None) -> str:
+        """按页拼接的紧凑文本，page_numbers 从1开始"""
+        numbers = page_numbers or range(1, len(self.pages) + 1)
+        return '\n\n'.join(f"[第{n}页]\n{self.pages[n - 1]}" for n in numbers if self.pages[n - 1])
+
+    def relevant_pages(self, question: str, limit: int) -> List[int]:
+        """按与问题的字符二元组重合度选出最相关的页面（按页码排序返回）"""
+        query = _bigrams(question)
+        scores = [(len(query & _bigrams(page)), n) for n, page in enumerate(self.pages, 1) if page]
+        ranked = [n for score, n in sorted(scores, key=lambda item: (-item[0], item[1])) if score > 0]
+        if not ranked:
+            # 没有明显相关的页面时退回到开头几页（通常是结论和摘要）
+            ranked = [n for _, n in scores]
+        return sorted(ranked[:max(int(limit), 1)])
+
+    def build_contents(self, question: str) -> List[str]:
+        """
+        构造回答问题所需的请求内容
+        全文较短时整份发送，否则只发送相关页面
+        """
+        options = get_options()
+        if self.char_count <= int(options['inline_max_chars']):
+            context = self.compact()
+        else:
+            pages = self.relevant_pages(question, options['max_relevant_pages'])
+            logger.info(f"报告共 {len(self.pages)} 页，仅发送相关页面：{pages}")
+            context = self.compact(pages)
+        return [f"以下是一份PDF报告中提取的文字内容：\n\n{context}", question]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'kind': self.kind, 'engine': self.engine, 'pages': self.pages}
+
+
+def _detect_engine(preferred: str) -> Optional[str]:
+    """选择可用的提取库"""
+    candidates = ['pdfplumber', 'pypdf'] if preferred == 'auto' else [preferred]
+    for name in candidates:
+        try:
+            __import__(name)
+            return name
+        except ImportError:
+            continue
+    return None
+
+
+def _extract_pdfplumber(data: bytes) -> List[str]:
+    import pdfplumber
+    pages = []
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        for page in pdf.pages:
+            parts = [page.extract_text() or '']
+            for table in page.extract_tables() or []:
+                rows = [' | '.join(cell or '' for cell in row) for row in table if row]
+                parts.append('\n'.join(rows))
+            pages.append(_compact('\n'.join(parts)))
+    return pages
+
+
+def _extract_pypdf(data: bytes) -> List[str]:
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    return [_compact(page.extract_text() or '') for page in reader.pages]
+
+
+def extract(data: bytes, digest: Optional[str] = None) -> PdfText:
+    """
+    提取PDF每一页的文本并判断文档类型
+    :param data: PDF文件内容
+    :param digest: PDF内容的SHA-256，用于保存提取结果
+    :return: PdfText，kind 为 text（电子版）、scanned（扫描件）或 unknown（未启用/无法提取）
+    """
+    options = get_options()
+    engine = _detect_engine(options['engine']) if options['enabled'] else None
+    if engine is None:
+        return PdfText([], UNKNOWN, digest=digest)
+
+    start = time.perf_counter()
+    try:
+        pages = _extract_pdfplumber(data) if engine == 'pdfplumber' else _extract_pypdf(data)
+    except Exception as e:
+        logger.warning(f"提取PDF文本失败，按原流程处理: {e}")
+        return PdfText([], UNKNOWN, engine, digest)
+
+    text_pages = sum(1 for page in pages if len(page) >= int(options['min_chars_per_page']))
+    is_text = bool(pages) and text_pages / len(pages) >= float(options['text_page_ratio'])
+    document = PdfText(pages, TEXT if is_text else SCANNED, engine, digest)
+    logger.info(f"PDF文本提取完成（{engine}）：{len(pages)} 页，其中 {text_pages} 页有文本层，"
+                f"共 {document.char_count} 字，判定为{'电子版' if is_text else '扫描件'}，"
+                f"耗时 {(time.perf_counter() - start) * 1000:.1f}ms")
+    return document
+
+
+def _text_path(digest: str) -> str:
+    return os.path.join(config.get_cache_path(), TEXT_DIR, f"{digest}.json")
+
+
+def save(document: PdfText) -> None:
+    """按内容哈希保存提取结果，供重复上传和后续提问使用"""
+    if not document.digest:
+        return
+    path = _text_path(document.digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 每次保存使用独立的临时文件，多个worker或线程同时保存同一份报告时互不覆盖
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(document.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.error(f"保存PDF文本失败: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load(digest: str) -> Optional[PdfText]:
+    """读取已保存的提取结果"""
+    path = _text_path(digest)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return PdfText(data.get('pages', []), data.get('kind', UNKNOWN), data.get('engine'), digest)
+    except Exception as e:
+        logger.error(f"读取PDF文本失败: {e}")
+        return None
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+报告分析后台任务
+
+报告分析（upload_pdf_and_cache）不再在页面脚本中同步执行，而是提交到有界的后台线程池：
+提交后立即返回任务ID，页面只需轮询任务状态和阶段进度（uploaded / summarized / cached），
+完成后取回 ReportSession。页面重跑或刷新不会中断或重复执行任务——同一份报告（按内容
+SHA-256）正在处理或已处理完成时，再次提交直接返回已有任务。
+
+排队和执行中的任务数达到 max_jobs 时拒绝新任务（ReportQueueFull，API服务返回429），
+保留的任务总数也不超过 max_jobs。线程数、任务数上限和已结束任务的保留时长来自
+system_config.report_jobs。
+"""
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from admission import AdmissionRejected
+from config import config
+from metrics import metrics
+from report_session import ReportSession
+from upload_store import file_digest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    'workers': 4,
+    'max_jobs': 200,
+    # 已结束的任务保留时长（秒）
+    'retention': 3600,
+    # 任务已满时建议的重试间隔（秒）
+    'retry_after': 30,
+}
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# 按完成顺序排列的阶段及其显示名称
+STAGES = ('uploaded', 'summarized', 'cached')
+STAGE_LABELS = {
+    'uploaded': '文档已就绪',
+    'summarized': '概要已生成',
+    'cached': '缓存已创建',
+}
+
+JOBS = metrics.gauge('report_jobs', '报告分析任务数（按状态）')
+JOB_DURATION = metrics.histogram('report_job_duration_seconds', '报告分析任务从开始执行到结束的耗时')
+
+
+class ReportQueueFull(AdmissionRejected):
+    """排队和执行中的报告任务已达上限"""
+
+    def __init__(self, retry_after: float):
+        super().__init__('report', 'queue_full', retry_after)
+
+
+def get_options() -> Dict[str, Any]:
+    """获取合并默认值后的任务参数"""
+    options = dict(DEFAULT_OPTIONS)
+    options.update(config.get_report_jobs_config())
+    return options
+
+
+class ReportJob:
+    """一个报告分析任务"""
+
+    def __init__(self, pdf_path: str, digest: str):
+        self.id = uuid.uuid4().hex
+        self.pdf_path = pdf_path
+        self.digest = digest
+        self.state = QUEUED
+        self.stages: Dict[str, float] = {}
+        self.report: Optional[ReportSession] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (DONE, FAILED)
+
+    @property
+    def summary(self) -> Optional[str]:
+        return self.report.summary if self.report is not None else None
+
+    def progress_text(self) -> str:
+        """当前进度的简短描述"""
+        if self.state == QUEUED:
+            return "排队中..."
+        if self.state == FAILED:
+            return f"报告处理失败：{self.error}"
+        done = [STAGE_LABELS[stage] for stage in STAGES if stage in self.stages]
+        if self.state == DONE:
+            return "分析完成"
+        return f"分析中（{'，'.join(done) if done else '正在读取报告'}）..."
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON可序列化的状态快照"""
+        return {
+            'id': self.id,
+            'state': self.state,
+            'stages': dict(self.stages),
+            'progress': self.progress_text(),
+            'summary': self.summary,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class ReportJobQueue:
+    """报告分析任务队列"""
+
+    def __init__(self, workers: Optional[int] = None):
+        options = get_options()
+        self.workers = int(workers if workers is not None else options['workers'])
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, ReportJob]" = OrderedDict()
+        self._by_digest: Dict[str, str] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """首次提交任务时才创建线程池"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='report-job')
+        return self._executor
+
+    def submit(self, pdf_path: str) -> ReportJob:
+        """
+        提交报告分析任务
+        同一份报告正在处理或已成功处理（且仍在保留期内）时直接返回已有任务；失败的任务会重新提交
+        :raises ReportQueueFull: 排队和执行中的任务数已达 max_jobs
+        """
+        digest = file_digest(pdf_path)
+        options = get_options()
+        with self._lock:
+            self._prune(time.time())
+            existing = self._jobs.get(self._by_digest.get(digest, ''))
+            if existing is not None and existing.state != FAILED:
+                logger.info(f"报告已有任务：{existing.id}（{existing.state}）")
+                return existing
+            pending = sum(1 for job in self._jobs.values() if not job.finished)
+            if pending >= int(options['max_jobs']):
+                logger.warning(f"报告分析任务已满（{pending} 个未完成），拒绝新任务：{pdf_path}")
+                raise ReportQueueFull(float(options['retry_after']))
+            job = ReportJob(pdf_path, digest)
+            self._jobs[job.id] = job
+            self._by_digest[digest] = job.id
+            self._update_gauges()
+            executor = self._get_executor()
+        # 任务中的请求沿用提交者的上下文（如准入控制的当前用户）
+        executor.submit(contextvars.copy_context().run, self._run, job)
+        logger.info(f"已提交报告分析任务：{job.id}，报告：{pdf_path}")
+        return job
+
+    def get(self, job_id: Optional[str]) -> Optional[ReportJob]:
+        """按任务ID查询"""
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def find(self, digest: str) -> Optional[ReportJob]:
+        """按报告内容的SHA-256查询最近的任务"""
+        with self._lock:
+            return self._jobs.get(self._by_digest.get(digest, ''))
+
+    def list(self) -> List[ReportJob]:
+        """全部保留中的任务（按提交顺序）"""
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(self, job: ReportJob) -> None:
+        job.started_at = time.time()
+        self._set_state(job, RUNNING)
+
+        def on_stage(stage: str) -> None:
+            job.stages[stage] = time.time()
+            logger.info(f"报告分析任务 {job.id} 进度：{stage}")
+
+        try:
+            report = ReportSession.open(job.pdf_path, on_stage=on_stage)
+            if report is None:
+                raise RuntimeError("报告处理失败，请稍后重试")
+            job.report = report
+            state = DONE
+        except Exception as e:
+            logger.error(f"报告分析任务 {job.id} 失败: {e}", exc_info=True)
+            job.error = str(e)
+            state = FAILED
+        job.finished_at = time.time()
+        JOB_DURATION.observe(job.finished_at - job.started_at)
+        self._set_state(job, state)
+
+    def _set_state(self, job: ReportJob, state: str) -> None:
+        with self._lock:
+            job.state = state
+            self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for job in self._jobs.values():
+            counts[job.state] += 1
+        for state, count in counts.items():
+            JOBS.set(count, state=state)
+
+    def _prune(self, now: float) -> None:
+        """清除超过保留时长的已结束任务，并按提交顺序淘汰超出 max_jobs 的已结束任务"""
+        options = get_options()
+        retention = float(options['retention'])
+        finished = [job for job in self._jobs.values() if job.finished]
+        overflow = len(self._jobs) - int(options['max_jobs'])
+        for job in finished:
+            if job.finished_at + retention <= now or overflow > 0:
+                overflow -= 1
+                del self._jobs[job.id]
+                if self._by_digest.get(job.digest) == job.id:
+                    del self._by_digest[job.digest]
+
+
+# 创建全局报告任务队列实例
+report_jobs = ReportJobQueue()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+报告对话句柄
+
+保存一份报告在当前会话中的缓存句柄（CachedContent对象/名称，或电子版报告的 PdfText），
+后续提问通过 main.generate_content_from_cache 只发送问题本身，费用与问题长度成正比，
+不再把整份报告拼进每条消息。
+
+对话期间按 cache_config.ttl_refresh_interval 定期延长CachedContent的有效期
+（延长到 cache_config.cached_content_ttl 秒之后）；缓存已过期或被删除时，
+通过 upload_pdf_and_cache 重建（远程文件仍有效时只重建缓存，不重新上传）。
+"""
+import asyncio
+import datetime
+import logging
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional
+
+import gemini_gateway
+import main
+import pdf_text
+from config import config
+from pdf_cache import pdf_cache
+
+logger = logging.getLogger(__name__)
+
+
+def _is_cache_missing(error: BaseException) -> bool:
+    """是否为缓存不存在或已过期的错误"""
+    code = getattr(error, 'code', None)
+    try:
+        if code is not None and int(getattr(code, 'value', code)) in (403, 404):
+            return True
+    except (TypeError, ValueError):
+        pass
+    message = str(error).lower()
+    return 'not found' in message or 'expired' in message or '404' in message
+
+
+class ReportSession:
+    """一份报告的对话句柄"""
+
+    def __init__(self, pdf_path: str, cache: Any, summary: str):
+        """
+        :param pdf_path: 本地PDF路径，缓存过期时用于重建
+        :param cache: upload_pdf_and_cache 返回的缓存
+        :param summary: 概要总结
+        """
+        self.pdf_path = pdf_path
+        self.cache = cache
+        self.summary = summary
+        self._lock = threading.Lock()
+        # 去重缓存命中时拿到的是缓存名称，首次提问时先刷新有效期
+        self._refreshed_at = time.time() if hasattr(cache, 'expire_time') else 0.0
+        self._expire_at = self._expire_timestamp(cache)
+
+    @classmethod
+    def open(cls, pdf_path: str, on_stage: Optional[Callable[[str], None]] = None) -> Optional["ReportSession"]:
+        """
+        分析报告并创建句柄，失败时返回None
+        :param on_stage: 进度回调，见 main.upload_pdf_and_cache
+        """
+        cache, summary = main.upload_pdf_and_cache(pdf_path, on_stage=on_stage)
+        if cache is None:
+            return None
+        return cls(pdf_path, cache, summary)
+
+    @staticmethod
+    def _expire_timestamp(cache: Any) -> Optional[float]:
+        expire_time = getattr(cache, 'expire_time', None)
+        return expire_time.timestamp() if expire_time is not None else None
+
+    @property
+    def uses_cache(self) -> bool:
+        """是否依赖远端CachedContent（电子版报告只发送本地提取的文本）"""
+        return not isinstance(self.cache, pdf_text.PdfText)
+
+    def _recreate(self) -> None:
+        """缓存已失效，重新创建"""
+        logger.info(f"报告缓存已失效，重新创建：{self.pdf_path}")
+        # 让去重缓存不再返回失效的缓存名称
+        pdf_cache.update_cache_expiry(getattr(self.cache, 'name', self.cache), 0)
+        cache, summary = main.upload_pdf_and_cache(self.pdf_path)
+        if cache is None:
+            raise RuntimeError("重新创建报告缓存失败")
+        # 去重缓存命中时返回的是名称，在这里解析为对象，后续提问不再在事件循环中查询缓存
+        cache = main.resolve_cache(cache)
+        self.cache = cache
+        self.summary = summary or self.summary
+        self._refreshed_at = time.time() if hasattr(cache, 'expire_time') else 0.0
+        self._expire_at = self._expire_timestamp(cache)
+
+    def _refresh(self) -> None:
+        """延长缓存有效期，并同步到PDF去重缓存"""
+        cache_config = config.get_cache_config()
+        ttl = datetime.timedelta(seconds=float(cache_config.get('cached_content_ttl', 3600)))
+        cached = main.resolve_cache(self.cache)
+        gemini_gateway.call("report", cached.update, ttl=ttl)
+        self.cache = cached
+        self._refreshed_at = time.time()
+        self._expire_at = self._expire_timestamp(cached) or time.time() + ttl.total_seconds()
+        pdf_cache.update_cache_expiry(cached.name, self._expire_at)
+        logger.info(f"已延长报告缓存有效期：{cached.name}")
+
+    def ensure_alive(self) -> None:
+        """
+        提问前检查缓存：即将过期或已过期时重建，到达刷新间隔时延长有效期。
+        返回后 self.cache 总是CachedContent对象（或 PdfText），不再是名称
+        """
+        if not self.uses_cache:
+            return
+        with self._lock:
+            now = time.time()
+            if self._expire_at is not None and self._expire_at - pdf_cache.EXPIRY_MARGIN <= now:
+                self._recreate()
+                return
+            interval = float(config.get_cache_config().get('ttl_refresh_interval', 300))
+            if now - self._refreshed_at < interval:
+                return
+            try:
+                self._refresh()
+            except Exception as e:
+                if not _is_cache_missing(e):
+                    raise
+                self._recreate()
+
+    def ask(self, question: str) -> str:
+        """回答后续问题，缓存在请求时才发现失效的，重建后重试一次"""
+        self.ensure_alive()
+        try:
+            return main.generate_content_from_cache(self.cache, question).text
+        except Exception as e:
+            if not self.uses_cache or not _is_cache_missing(e):
+                raise
+            self._recreate_locked()
+            return main.generate_content_from_cache(self.cache, question).text
+
+    async def ask_async(self, question: str) -> str:
+        """ask() 的异步版本：缓存检查和重建在线程池中执行，生成请求不阻塞事件循环"""
+        await asyncio.to_thread(self.ensure_alive)
+        try:
+            return (await main.generate_content_from_cache_async(self.cache, question)).text
+        except Exception as e:
+            if not self.uses_cache or not _is_cache_missing(e):
+                raise
+            await asyncio.to_thread(self._recreate_locked)
+            return (await main.generate_content_from_cache_async(self.cache, question)).text
+
+    def _recreate_locked(self) -> None:
+        with self._lock:
+            self._recreate()
+
+    def stream(self, question: str) -> Iterator[str]:
+        """以流式方式回答后续问题"""
+        self.ensure_alive()
+        return main.stream_content_from_cache(self.cache, question)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+调用容错
+
+为 gemini_gateway 提供重试、退避、超时、熔断和对冲请求：
+- 429/5xx/超时等可重试错误按带抖动的指数退避重试，次数来自 system_config.proxy.retry_count
+- 每次尝试的超时来自 system_config.proxy.timeout（可按flow覆盖），整次调用另有总时限；
+  流式调用（stream=True）不设单次超时——gRPC流的超时是整个流的截止时间，会截断较长的回复
+- 每个模型一个熔断器，连续失败达到阈值后在冷却期内直接失败，冷却后放行一个探测请求
+- 可选的对冲请求：无状态的 generate_content 在 hedge_after 秒内未返回时并发发出第二个请求，
+  取先返回的结果，用于削减长尾延迟
+- run_async() 以相同的重试、超时和熔断策略执行SDK的异步方法（generate_content_async 等），
+  退避等待不占用事件循环（异步调用不做对冲）
+
+其余参数来自 system_config.resilience。
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional
+
+from config import config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    'base_delay': 0.5,
+    'max_delay': 8.0,
+    'deadline': 120,
+    'flow_timeouts': {},
+    'breaker_failure_threshold': 5,
+    'breaker_reset_timeout': 30,
+    'hedge_after': 0,
+}
+
+# 可重试的HTTP状态码和异常类名（兼容 google.api_core.exceptions 与本地替身）
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_NAMES = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'InternalServerError',
+    'DeadlineExceeded', 'GatewayTimeout', 'RetryError', 'ConnectionError', 'TimeoutError',
+    'ConnectTimeout', 'ReadTimeout', 'RemoteDisconnected',
+}
+
+# 支持 request_options={'timeout': ...} 的SDK方法
+TIMEOUT_OPS = {'generate_content', 'send_message', 'count_tokens'}
+# 无副作用、可以安全对冲的SDK方法
+HEDGE_OPS = {'generate_content', 'count_tokens'}
+
+RETRIES = metrics.counter('gemini_retries_total', '因可重试错误而重试的次数')
+HEDGES = metrics.counter('gemini_hedged_requests_total', '发出的对冲请求次数（按胜出方）')
+CIRCUIT_REJECTIONS = metrics.counter('gemini_circuit_rejections_total', '熔断期间被直接拒绝的调用次数')
+CIRCUIT_STATE = metrics.gauge('gemini_circuit_open', '熔断器状态（1为打开）')
+
+_overrides: Dict[str, Any] = {}
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+_hedge_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，调用被直接拒绝"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"上游服务暂时不可用（{name}），请 {retry_after:.0f} 秒后重试")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def configure(**overrides) -> None:
+    """在运行时覆盖配置项（如基准测试中关闭重试），传入None表示恢复配置值"""
+    for key, value in overrides.items():
+        if value is None:
+            _overrides.pop(key, None)
+        else:
+            _overrides[key] = value
+
+
+def get_options() -> Dict[str, Any]:
+    """合并默认值、system_config.resilience、proxy 中的超时/重试次数以及运行时覆盖"""
+    options = dict(DEFAULT_OPTIONS)
+    options.update(config.get_resilience_config())
+    proxy_config = config.get_proxy_config()
+    options['timeout'] = proxy_config.get('timeout', 30)
+    options['retry_count'] = proxy_config.get('retry_count', 3)
+    options.update(_overrides)
+    return options
+
+
+def is_retryable(error: BaseException) -> bool:
+    """是否为可重试的上游错误"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    code = getattr(error, 'code', None)
+    try:
+        if code is not None and int(getattr(code, 'value', code)) in RETRYABLE_CODES:
+            return True
+    except (TypeError, ValueError):
+        pass
+    return any(cls.__name__ in RETRYABLE_NAMES for cls in type(error).__mro__)
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """带完全抖动的指数退避（attempt从1开始）"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+
+
+class CircuitBreaker:
+    """单个上游（模型）的熔断器"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    def before_call(self, failure_threshold: int, reset_timeout: float) -> None:
+        """调用前检查，熔断期间抛出 CircuitOpenError"""
+        if failure_threshold <= 0:
+            return
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + reset_timeout - time.monotonic()
+            if remaining <= 0 and not self._probing:
+                # 冷却结束，放行一个探测请求（半开）
+                self._probing = True
+                return
+        CIRCUIT_REJECTIONS.inc(model=self.name)
+        raise CircuitOpenError(self.name, max(remaining, 1.0))
+
+    def on_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"熔断器已恢复：{self.name}")
+                CIRCUIT_STATE.set(0, model=self.name)
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def on_failure(self, failure_threshold: int) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and 0 < failure_threshold <= self._failures):
+                if self._opened_at is None:
+                    logger.warning(f"熔断器打开：{self.name}，连续失败 {self._failures} 次")
+                self._opened_at = time.monotonic()
+                self._probing = False
+                CIRCUIT_STATE.set(1, model=self.name)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """获取（或创建）某个上游的熔断器"""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def _hedged(fn: Callable, args: tuple, kwargs: dict, hedge_after: float, labels: Dict[str, str]) -> Any:
+    """先发出主请求，hedge_after 秒内未完成则再发一个，返回先成功的结果"""
+    global _hedge_executor
+    with _hedge_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='gemini-hedge')
+    primary = _hedge_executor.submit(fn, *args, **kwargs)
+    done, _ = wait([primary], timeout=hedge_after)
+    if done:
+        return primary.result()
+
+    hedge = _hedge_executor.submit(fn, *args, **kwargs)
+    pending = {primary, hedge}
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                HEDGES.inc(winner='hedge' if future is hedge else 'primary', **labels)
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def run(fn: Callable, args: tuple, kwargs: dict, flow: str, op: str, model_name: str) -> Any:
+    """
+    带重试、超时、熔断（及可选对冲）地执行一次SDK调用
+    :raises CircuitOpenError: 熔断期间直接失败
+    """
+    options = get_options()
+    timeout = float(options.get('flow_timeouts', {}).get(flow, options['timeout']))
+    max_attempts = int(options['retry_count']) + 1
+    deadline = time.monotonic() + float(options['deadline'])
+    threshold = int(options['breaker_failure_threshold'])
+    breaker = get_breaker(model_name if model_name != '-' else op)
+    labels = {'flow': flow, 'model': model_name, 'op': op}
+    hedge_after = float(options['hedge_after'])
+    streaming = bool(kwargs.get('stream'))
+    can_hedge = hedge_after > 0 and op in HEDGE_OPS and not streaming
+
+    attempt = 0
+    while True:
+        breaker.before_call(threshold, float(options['breaker_reset_timeout']))
+        attempt += 1
+        call_kwargs = kwargs
+        if op in TIMEOUT_OPS and timeout > 0 and not streaming and 'request_options' not in kwargs:
+            remaining = max(deadline - time.monotonic(), 0.1)
+            call_kwargs = dict(kwargs, request_options={'timeout': min(timeout, remaining)})
+        try:
+            if can_hedge:
+                result = _hedged(fn, args, call_kwargs, hedge_after, labels)
+            else:
+                result = fn(*args, **call_kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                # 上游正常响应（如参数错误），不计入熔断
+                breaker.on_success()
+                raise
+            breaker.on_failure(threshold)
+            delay = backoff_delay(attempt, float(options['base_delay']), float(options['max_delay']))
+            if attempt >= max_attempts or time.monotonic() + delay >= deadline:
+                raise
+            RETRIES.inc(error=type(e).__name__, **labels)
+            logger.warning(f"调用失败（{flow}/{op}，第{attempt}次）：{type(e).__name__}: {e}，{delay:.2f}秒后重试")
+            time.sleep(delay)
+            continue
+        breaker.on_success()
+        return result
+
+
+async def run_async(fn: Callable, args: tuple, kwargs: dict, flow: str, op: str, model_name: str) -> Any:
+    """
+    run() 的异步版本，fn 为SDK的协程方法（如 model.generate_content_async）
+    :raises CircuitOpenError: 熔断期间直接失败
+    """
+    options = get_options()
+    timeout = float(options.get('flow_timeouts', {}).get(flow, options['timeout']))
+    max_attempts = int(options['retry_count']) + 1
+    deadline = time.monotonic() + float(options['deadline'])
+    threshold = int(options['breaker_failure_threshold'])
+    breaker = get_breaker(model_name if model_name != '-' else op)
+    labels = {'flow': flow, 'model': model_name, 'op': op}
+
+    attempt = 0
+    while True:
+        breaker.before_call(threshold, float(options['breaker_reset_timeout']))
+        attempt += 1
+        call_kwargs = kwargs
+        if op in TIMEOUT_OPS and timeout > 0 and 'request_options' not in kwargs:
+            remaining = max(deadline - time.monotonic(), 0.1)
+            call_kwargs = dict(kwargs, request_options={'timeout': min(timeout, remaining)})
+        try:
+            result = await fn(*args, **call_kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.on_success()
+                raise
+            breaker.on_failure(threshold)
+            delay = backoff_delay(attempt, float(options['base_delay']), float(options['max_delay']))
+            if attempt >= max_attempts or time.monotonic() + delay >= deadline:
+                raise
+            RETRIES.inc(error=type(e).__name__, **labels)
+            logger.warning(f"调用失败（{flow}/{op}，第{attempt}次）：{type(e).__name__}: {e}，{delay:.2f}秒后重试")
+            await asyncio.sleep(delay)
+            continue
+        breaker.on_success()
+        return result
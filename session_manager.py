@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+聊天会话管理
+
+按用户/会话ID为每个用户维护独立的ChatSession，避免所有用户共用一个全局会话。
+会话总数和历史总字节数受 system_config.session_config 限制，超出上限或空闲超时
+的会话按最近最少使用（LRU）顺序淘汰；单个会话的历史超出token预算时由
+history_compactor 压缩为滚动摘要。
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from config import config
+from history_compactor import history_compactor
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_history_bytes(history) -> int:
+    """估算对话历史占用的字节数"""
+    total = 0
+    for content in history:
+        try:
+            total += type(content).pb(content).ByteSize()
+        except Exception:
+            for part in getattr(content, 'parts', []):
+                total += len(str(getattr(part, 'text', part)).encode('utf-8'))
+    return total
+
+
+class _SessionEntry:
+    """会话条目"""
+    __slots__ = ('session', 'last_access', 'history_bytes')
+
+    def __init__(self, session):
+        self.session = session
+        self.last_access = time.time()
+        self.history_bytes = 0
+
+
+class ChatSessionManager:
+    """按会话ID管理ChatSession，支持LRU淘汰"""
+
+    def __init__(self, model, max_sessions: Optional[int] = None,
+                 max_history_bytes: Optional[int] = None,
+                 idle_timeout: Optional[float] = None,
+                 compactor=None):
+        """
+        初始化会话管理器
+        :param model: 用于创建会话的GenerativeModel
+        :param max_sessions: 最多同时保留的会话数
+        :param max_history_bytes: 所有会话历史的总字节上限
+        :param idle_timeout: 会话空闲超过该秒数后被淘汰
+        :param compactor: 历史压缩器，默认使用全局 history_compactor
+        """
+        session_config = config.get_session_config()
+        self.model = model
+        self.compactor = compactor or history_compactor
+        self.max_sessions = int(max_sessions if max_sessions is not None
+                                else session_config.get('max_sessions', 500))
+        self.max_history_bytes = int(max_history_bytes if max_history_bytes is not None
+                                     else session_config.get('max_history_bytes', 64 * 1024 * 1024))
+        self.idle_timeout = float(idle_timeout if idle_timeout is not None
+                                  else session_config.get('idle_timeout', 1800))
+        self._sessions: "OrderedDict[str, _SessionEntry]" = OrderedDict()
+        self._history_bytes = 0
+        self._evictions = 0
+        self._lock = threading.RLock()
+
+    def get_session(self, session_id: str):
+        """
+        获取会话，不存在时创建
+        :param session_id: 用户/会话ID
+        :return: ChatSession对象
+        """
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = _SessionEntry(self.model.start_chat(history=[]))
+                self._sessions[session_id] = entry
+                logger.info(f"创建聊天会话：{session_id}，当前会话数：{len(self._sessions)}")
+            else:
+                self._sessions.move_to_end(session_id)
+            entry.last_access = now
+            self._evict_overflow(keep=session_id)
+            return entry.session
+
+    def update_usage(self, session_id: str, response=None) -> None:
+        """
+        在一轮对话结束后按需压缩该会话的历史、重新统计字节数，并按上限淘汰其他会话
+        :param response: 本轮的响应，用于读取 usage_metadata 中的token数
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+        if entry is None:
+            return
+        # 压缩需要调用模型，在锁外执行，避免阻塞其他会话
+        try:
+            self.compactor.maybe_compact(entry.session, response)
+        except Exception as e:
+            logger.error(f"压缩会话历史失败：{session_id}，{e}")
+        with self._lock:
+            if self._sessions.get(session_id) is not entry:
+                return
+            history_bytes = estimate_history_bytes(entry.session.history)
+            self._history_bytes += history_bytes - entry.history_bytes
+            entry.history_bytes = history_bytes
+            entry.last_access = time.time()
+            self._evict_overflow(keep=session_id)
+
+    def append_turn(self, session_id: str, user_text: str, model_text: str) -> None:
+        """把未经模型生成的一轮问答（如缓存命中的答案）追加到会话历史，保持上下文连贯"""
+        session = self.get_session(session_id)
+        session.history = list(session.history) + [
+            {'role': 'user', 'parts': [user_text]},
+            {'role': 'model', 'parts': [model_text]},
+        ]
+        self.update_usage(session_id)
+
+    def reset_session(self, session_id: str) -> None:
+        """清除指定会话"""
+        with self._lock:
+            self._remove(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回会话数量和内存占用统计"""
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'history_bytes': self._history_bytes,
+                'max_sessions': self.max_sessions,
+                'max_history_bytes': self.max_history_bytes,
+                'evictions': self._evictions,
+            }
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _remove(self, session_id: str) -> bool:
+        """移除会话并扣减字节统计"""
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            return False
+        self._history_bytes -= entry.history_bytes
+        return True
+
+    def _evict_idle(self, now: float) -> None:
+        """淘汰空闲超时的会话（OrderedDict按最近访问排序，遇到未超时的即可停止）"""
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if now - entry.last_access < self.idle_timeout:
+                break
+            self._remove(session_id)
+            self._evictions += 1
+            logger.info(f"会话空闲超时已淘汰：{session_id}")
+
+    def _evict_overflow(self, keep: Optional[str] = None) -> None:
+        """会话数或历史字节数超限时，按LRU顺序淘汰（不淘汰当前会话）"""
+        while len(self._sessions) > self.max_sessions or self._history_bytes > self.max_history_bytes:
+            victim = next((sid for sid in self._sessions if sid != keep), None)
+            if victim is None:
+                break
+            self._remove(victim)
+            self._evictions += 1
+            logger.info(f"会话超出上限已淘汰：{victim}，当前统计：{self.stats()}")
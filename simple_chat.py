@@ -1,44 +1,40 @@
 import gradio as gr
-import os
 import logging
 import sys
-import google.generativeai as genai
-from dotenv import load_dotenv
+from genai_backend import genai, configure_genai
+from session_manager import ChatSessionManager
+import gemini_gateway
 
-# 加载环境变量
-load_dotenv()
-
-# 配置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# 日志由 config 初始化的进程级日志管道统一处理
 logger = logging.getLogger(__name__)
 
-# 检查 API 密钥
-api_key = os.getenv('GEMINI_API_KEY')
-if not api_key:
-    logger.error("未找到 GEMINI_API_KEY 环境变量，请设置 .env 文件")
-    sys.exit(1)
-else:
+# 检查并配置 API 密钥
+try:
+    configure_genai()
     logger.info("成功读取 GEMINI_API_KEY")
-
-# 配置 Gemini
-genai.configure(api_key=api_key)
+except ValueError as e:
+    logger.error(f"{e}")
+    sys.exit(1)
 
 # 初始化模型和会话
 try:
     model = genai.GenerativeModel(model_name="gemini-2.0-flash-experimental")
-    chat_session = model.start_chat(history=[])
-    logger.info("模型和会话初始化成功")
+    session_manager = ChatSessionManager(model)
+    logger.info("模型和会话管理器初始化成功")
 except Exception as e:
     logger.error(f"模型初始化失败: {e}", exc_info=True)
     sys.exit(1)
 
-def chat(message: str, history: list) -> list:
+def chat(message: str, history: list, request: gr.Request) -> list:
     """处理对话"""
     try:
-        logger.info(f"收到用户消息: {message}")
+        session_id = request.session_hash
+        logger.info(f"收到用户消息（会话 {session_id}）: {message}")
         if not message:
             return history
-        response = chat_session.send_message(message)
+        chat_session = session_manager.get_session(session_id)
+        response = gemini_gateway.call("chat", chat_session.send_message, message)
+        session_manager.update_usage(session_id, response)
         if not response or not response.text:
             logger.error("模型没有返回响应")
             history.append({"role":"assistant", "content":"模型没有返回响应，请重试。"})
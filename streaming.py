@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+流式响应工具
+
+以 stream=True 调用Gemini，逐块产出响应文本，供 st.write_stream、Gradio 生成器
+和命令行 print 直接使用；同时记录每次请求的首字延迟（TTFT）和总耗时。
+请求经由 gemini_gateway 发出，延迟和token用量同时计入运行指标。
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, List
+
+import gemini_gateway
+
+logger = logging.getLogger(__name__)
+
+# 最近请求的延迟记录
+_records = deque(maxlen=1000)
+_records_lock = threading.Lock()
+
+
+def stream_call(flow: str, fn: Callable, *args, **kwargs) -> Iterator[str]:
+    """
+    以流式方式调用Gemini并逐块产出文本
+    :param flow: 业务流程名称（如 chat、vision、report），用于日志和统计
+    :param fn: send_message 或 generate_content 等支持 stream 参数的方法
+    :return: 文本块生成器
+    """
+    start = time.perf_counter()
+    first_token_at = None
+    chars = 0
+
+    for chunk in gemini_gateway.stream(flow, fn, *args, **kwargs):
+        try:
+            text = chunk.text
+        except ValueError:
+            # 没有文本的分块（如仅包含结束原因）直接跳过
+            continue
+        if not text:
+            continue
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        chars += len(text)
+        yield text
+
+    end = time.perf_counter()
+    record = {
+        'flow': flow,
+        'ttft_ms': round(((first_token_at or end) - start) * 1000, 1),
+        'total_ms': round((end - start) * 1000, 1),
+        'chars': chars,
+        'timestamp': time.time(),
+    }
+    with _records_lock:
+        _records.append(record)
+    logger.info(f"流式响应完成：{flow}，首字延迟 {record['ttft_ms']}ms，总耗时 {record['total_ms']}ms，共 {chars} 字")
+
+
+def get_latency_records(flow: str = None) -> List[Dict[str, Any]]:
+    """获取最近的延迟记录，可按流程过滤"""
+    with _records_lock:
+        records = list(_records)
+    if flow is not None:
+        records = [r for r in records if r['flow'] == flow]
+    return records
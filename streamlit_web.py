@@ -1,97 +1,59 @@
 import streamlit as st
-import os
 import logging
 import sys
-from datetime import datetime
+import uuid
 from config import config
-import main
-from mange_filelist import list_all_files, delete_file, clear_all_cache
-import google.generativeai as genai
-from dotenv import load_dotenv
-from PIL import Image
-
-# 设置日志文件路径
-log_dir = "logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"webui_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-
-# 配置日志
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file, encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+from mange_filelist import list_all_files, count_files, find_file, delete_file, clear_all_cache
+from session_manager import ChatSessionManager
+from streaming import stream_call
+import gemini_gateway
+import admission
+from metrics import start_metrics_server
+from answer_cache import answer_cache
+from model_registry import ModelRegistry, init_models
+from report_jobs import report_jobs
+from image_session import image_conversations
+
+# 日志由 config 初始化的进程级日志管道统一处理（不再每次重跑创建日志文件）
 logger = logging.getLogger(__name__)
-logger.info(f"日志文件路径：{log_file}")
-
-# 加载环境变量
-load_dotenv()
 
 # 初始化模型
-def setup_gemini():
-    """初始化Gemini配置"""
+@st.cache_resource
+def setup_gemini() -> ModelRegistry:
+    """配置Gemini并构建全部模型（进程内只执行一次，跨Streamlit重跑复用）"""
     try:
-        # 获取API密钥
-        api_key = os.getenv('GEMINI_API_KEY')
-        if not api_key:
-            logger.error("未找到GEMINI_API_KEY环境变量")
-            raise ValueError("请设置GEMINI_API_KEY环境变量")
-
-        # 配置Gemini
-        genai.configure(api_key=api_key)
-        
-        # 获取模型配置
-        model_config = config.get_model_config()
-        
-        # 初始化聊天模型
-        global chat_model  # 确保使用全局变量
-        chat_config = model_config.get('chat', {}) # 获取聊天模型配置
-        chat_model = genai.GenerativeModel(  # 创建聊天模型
-            model_name=chat_config.get('model_name', 'gemini-2.0-flash-exp'),  # 也可以使用gemini-pro模型
-            generation_config=genai.GenerationConfig(
-                temperature=chat_config.get('temperature', 0.7),
-                max_output_tokens=chat_config.get('max_output_tokens', 2048),
-            )
-        )
-        logger.info("聊天模型初始化成功")
-        
-        # 初始化视觉模型
-        global vision_model  # 确保使用全局变量
-        vision_config = model_config.get('vision', {})
-        vision_model = genai.GenerativeModel(
-            model_name=vision_config.get('model_name', 'gemini-pro-vision'),  # 使用gemini-pro-vision模型
-            generation_config=genai.GenerationConfig(
-                temperature=vision_config.get('temperature', 0.7),
-                max_output_tokens=vision_config.get('max_output_tokens', 2048),
-            )
-        )
-        logger.info("视觉模型初始化成功")
-        
-        return chat_model, vision_model
-        
+        registry = init_models()
+        logger.info(f"模型初始化成功，耗时(ms): {registry.timings()}")
+        start_metrics_server()
+        return registry
     except Exception as e:
         error_msg = f"初始化Gemini时发生错误: {str(e)}"
         logger.error(error_msg, exc_info=True)
         raise Exception(error_msg)
 
 
-# 初始化全局变量
-chat_model = None
-vision_model = None
-chat_session = None  # 添加chat_session
-
-# 初始化模型
+# 初始化模型（重跑时直接从注册表读取）
 try:
-    chat_model, vision_model = setup_gemini()
-    # 初始化聊天会话
-    chat_session = chat_model.start_chat(history=[])
-    logger.info("模型和聊天会话初始化成功")
+    models = setup_gemini()
+    chat_model = models.get('chat')
+    vision_model = models.get('vision')
 except Exception as e:
     logger.error(f"模型初始化失败: {e}")
     sys.exit(1)
+
+@st.cache_resource
+def get_session_manager() -> ChatSessionManager:
+    """获取进程级会话管理器，跨Streamlit重跑和浏览器会话共享"""
+    return ChatSessionManager(chat_model)
+
+def get_session_id() -> str:
+    """获取当前浏览器会话的ID"""
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+# 本次重跑中发出的请求按当前浏览器会话限流（见 admission.py）
+admission.set_user(get_session_id())
     
 # 从配置中获取 UI 设置
 ui_config = config.get_ui_config()
@@ -99,28 +61,47 @@ prompts = config.get_prompts()
 
 # --- 定义功能函数 ---
 
-def chat_function(message: str, history: list) -> list:
+def chat_function(message: str, history: list, session_id: str) -> list:
     """处理普通对话"""
     try:
-        logger.info(f"开始处理普通对话，输入消息：{message}")
+        logger.info(f"开始处理普通对话，会话：{session_id}，输入消息：{message}")
         if not message:
             return history
-            
-        if not chat_session:
-            error_msg = "聊天会话未初始化"
-            logger.error(error_msg)
-            history.append({"role": "assistant", "content": error_msg})
+
+        session_manager = get_session_manager()
+        chat_session = session_manager.get_session(session_id)
+        # 会话首轮的常见问题优先查询答案缓存，命中时不调用模型；
+        # 后续提问依赖上下文，既不查询也不写入缓存
+        first_turn = not chat_session.history
+        fingerprint = answer_cache.fingerprint(prompts['chat'], config.get_model_config().get('chat', {}))
+        cached_answer = answer_cache.get(message, fingerprint) if first_turn else None
+        if cached_answer is not None:
+            logger.info(f"命中答案缓存，统计：{answer_cache.stats()}")
+            session_manager.append_turn(session_id, message, cached_answer)
+            if config.is_streaming_enabled():
+                with st.chat_message("assistant"):
+                    st.markdown(cached_answer)
+            history.append({"role":"user", "content":message})
+            history.append({"role":"assistant", "content":cached_answer})
             return history
 
-        response = chat_session.send_message(prompts['chat'] + "\n\n用户问题：" + message)
+        if config.is_streaming_enabled():
+            # 流式模式下边接收边显示
+            with st.chat_message("assistant"):
+                response_text = st.write_stream(stream_call("chat", chat_session.send_message, message))
+        else:
+            response = gemini_gateway.call("chat", chat_session.send_message, message)
+            response_text = response.text if response else ""
+        session_manager.update_usage(session_id, None if config.is_streaming_enabled() else response)
 
-        if not response or not response.text:
+        if not response_text:
             logger.error("模型没有返回响应")
             history.append({"role":"assistant", "content":"模型没有返回响应，请重试。"})
             return history
             
-        response_text = response.text
         logger.info(f"收到回复：{response_text}")
+        if first_turn:
+            answer_cache.put(message, fingerprint, response_text)
         history.append({"role":"user", "content":message})
         history.append({"role":"assistant", "content":response_text})
         return history
@@ -128,23 +109,23 @@ def chat_function(message: str, history: list) -> list:
         error_msg = f"处理对话时发生错误: {str(e)}"
         logger.error(error_msg, exc_info=True)
         history.append({"role":"assistant", "content":f"对话过程中发生错误：{e}，请查看后台日志"})
+        if config.is_streaming_enabled():
+            st.error(history[-1]["content"])
         return history
 
-def analyze_image_chat(image, image_file, image_type: str, message: str, history: list) -> list:
+def analyze_image_chat(image_file, image_type: str, message: str, history: list) -> list:
     """处理图片分析和对话"""
     try:
         logger.info(f"开始处理图片分析，类型：{image_type}，消息：{message}")
-        if not image:
+        if not image_file:
             history.append({"role": "assistant", "content": "请先上传图片"})
             return history
         
-        # 保存图片到临时文件,,使用原始文件名
-        original_filename = image_file.name
-        temp_path = os.path.join(config.get_upload_path(), original_filename)
-        image.save(temp_path)
+        # 按内容寻址保存原始图片，同一图片重复上传时不再写盘
+        temp_path = config.save_uploaded_file(image_file)
         logger.info(f"图片已保存到：{temp_path}")
 
-         # 获取图片类型的配置
+        # 获取图片类型的配置
         image_config = config.get_image_type_prompt(image_type)
         if image_config is None:
             error_msg = f"不支持的图片类型: {image_type}"
@@ -152,17 +133,16 @@ def analyze_image_chat(image, image_file, image_type: str, message: str, history
             history.append({"role": "assistant", "content": error_msg})
             return history
         
-         # 上传图片到Gemini
-        image_file = main.upload_to_gemini(temp_path, mime_type=image_config['mime_type'])
-        logger.info("图片已上传到Gemini")
-
-        if not message:
-            prompt = image_config['system_prompt']
-            response = vision_model.generate_content([image_file, prompt])
+        # 同一会话、同一图片的后续提问复用带图片上下文的对话，只发送问题文本；
+        # 点击“分析图片”（无问题）时重新开始
+        conversation = image_conversations.get(get_session_id(), vision_model, temp_path, image_type,
+                                               restart=not message)
+        if config.is_streaming_enabled():
+            # 流式模式下边接收边显示
+            with st.chat_message("assistant"):
+                response_text = st.write_stream(conversation.stream(message))
         else:
-            response = vision_model.generate_content([image_file, message])
-            
-        response_text = response.text
+            response_text = conversation.send(message)
         logger.info(f"收到回复：{response_text}")
         
         if not message:
@@ -178,58 +158,78 @@ def analyze_image_chat(image, image_file, image_type: str, message: str, history
         history.append({"role": "assistant", "content": error_msg})
         return history
 
+def get_report_job():
+    """
+    获取当前会话的报告分析任务
+    任务ID同时保存在 st.session_state 和URL参数中，刷新页面后仍能接上进行中的任务
+    """
+    job_id = st.session_state.get('report_job_id') or st.query_params.get('report_job')
+    return report_jobs.get(job_id)
+
+def adopt_report_job(job, history: list) -> bool:
+    """
+    任务结束时取回结果：成功则保存报告句柄并把概要总结加入对话历史，失败则提示错误
+    :return: 任务是否已结束
+    """
+    if not job.finished:
+        return False
+    if job.state == 'done':
+        if st.session_state.get('report_session') is not job.report:
+            st.session_state.report_session = job.report
+            logger.info(f"获取到的概要总结：{job.summary}")
+            history.append({"role": "assistant", "content": job.summary})
+    else:
+        history.append({"role": "assistant", "content": job.progress_text()})
+    st.session_state.pop('report_job_id', None)
+    st.query_params.pop('report_job', None)
+    return True
+
 def analyze_report_chat(pdf_file, message: str, history: list) -> list:
-    """处理报告分析和对话"""
+    """
+    处理报告分析和对话
+    报告分析提交为后台任务（见 report_jobs），由 poll_report_job 轮询进度；
+    报告的缓存句柄保存在 st.session_state.report_session 中，后续提问只发送问题本身
+    """
     try:
         logger.info(f"开始处理报告分析，消息：{message}")
         if pdf_file is None and not message:
             history.append({"role": "assistant", "content": "请先上传报告"})
             return history
         
+        report = st.session_state.get('report_session')
         if pdf_file is not None:
-            # 保存PDF到临时文件
-            temp_path = os.path.join(config.get_upload_path(), "temp_report.pdf")
-            with open(temp_path, "wb") as f:
-                f.write(pdf_file.read())
+            # 按内容寻址保存PDF，不同会话的报告互不覆盖；同一份报告的路径不变
+            temp_path = config.save_uploaded_file(pdf_file)
             logger.info(f"报告已保存到：{temp_path}")
             
-            # 分析报告
-            cache = main.upload_pdf_and_cache(temp_path)
-            
-            # 获取概要总结和缓存内容
-            if isinstance(cache, tuple):
-                cached_content = cache[0]  # 第一个元素是缓存的内容
-                summary = cache[1]  # 第二个元素是概要总结
-            else:
-                cached_content = cache
-                summary = str(cache)
-                
-            logger.info(f"获取到的概要总结：{summary}")
-            
-            # 将概要总结添加到对话历史
-            history.append({"role": "assistant", "content": summary})
-            
-            # 保存报告内容到session_state
-            st.session_state.report_content = report_content
-            
-        elif message and hasattr(st.session_state, 'report_content'):
-            # 继续对话，使用保存的报告内容构建上下文
+            # 新报告（或尚未分析）时提交分析任务，已分析过的报告直接进入对话；
+            # 同一份报告已有进行中或已完成的任务时直接复用
+            if report is None or report.pdf_path != temp_path or not message:
+                if not message:
+                    # 再次点击“分析报告”时重新显示概要总结
+                    st.session_state.pop('report_session', None)
+                job = report_jobs.submit(temp_path)
+                st.session_state.report_job_id = job.id
+                st.query_params['report_job'] = job.id
+                adopt_report_job(job, history)
+                report = st.session_state.get('report_session')
+                if report is not None and report.pdf_path != temp_path:
+                    report = None
+        
+        if message and report is not None:
+            # 继续对话，只发送问题本身，报告内容由缓存提供
             logger.info(f"继续对话，消息：{message}")
-            
-            prompt = f"""基于以下报告内容回答问题：
-
-{st.session_state.report_content}
-
-用户问题：{message}
-
-请根据报告内容准确回答，如果问题超出报告范围，请明确说明。"""
-            
-            response = chat_model.generate_content(prompt)
-            response_text = response.text
+            if config.is_streaming_enabled():
+                with st.chat_message("assistant"):
+                    response_text = st.write_stream(report.stream(message))
+            else:
+                response_text = report.ask(message)
             logger.info(f"收到回复：{response_text}")
             history.append({"role": "user", "content": message})
             history.append({"role": "assistant", "content": response_text})
-        else:
+        elif message and get_report_job() is not None:
+            history.append({"role": "assistant", "content": "报告仍在分析中，请稍候再提问"})
+        elif message:
             logger.warning("没有上传报告或保存的报告内容")
             history.append({"role": "assistant", "content": "请先上传报告再进行对话"})
         
@@ -240,15 +240,28 @@ def analyze_report_chat(pdf_file, message: str, history: list) -> list:
         history.append({"role": "assistant", "content": error_msg})
         return history
 
-def manage_files_ui() -> str:
-    """文件管理界面"""
+@st.fragment(run_every=1)
+def poll_report_job() -> None:
+    """每秒只重跑本片段查询任务进度，任务结束后整页重跑以显示概要总结"""
+    job = get_report_job()
+    if job is None:
+        return
+    if adopt_report_job(job, st.session_state.report_chat_messages):
+        st.rerun()
+    st.info(job.progress_text())
+
+def manage_files_ui(page: int = 1, refresh: bool = False) -> str:
+    """文件管理界面（读取本地文件索引，按页显示）"""
     try:
         logger.info("开始获取文件列表")
-        files = list_all_files()
+        page_size = config.get_file_inventory_config().get('page_size', 50)
+        page = max(1, int(page))
+        files = list_all_files(refresh=refresh, offset=(page - 1) * page_size, limit=page_size, verbose=False)
         if not files:
             return "当前没有已上传的文件"
-        result = "=== 已上传文件列表 ===\n"
-        for i, (file_type, file) in enumerate(files, 1):
+        total = count_files()
+        result = f"=== 已上传文件列表（共 {total} 个，第 {page}/{max(1, -(-total // page_size))} 页）===\n"
+        for i, (file_type, file) in enumerate(files, (page - 1) * page_size + 1):
             result += f"{i}. 文件名: {file.display_name}\n"
             result += f"   文件URI: {file.uri}\n"
             result += f"   类型: {file_type}\n"
@@ -263,17 +276,17 @@ def delete_file_ui(file_name: str) -> str:
     """删除文件"""
     try:
         logger.info(f"开始删除文件：{file_name}")
-        files = list_all_files()
-        for file_type, file in files:
-            if file.display_name == file_name:
-                if delete_file(file_type, file):
-                    logger.info(f"删除成功：{file_name}")
-                    return f"成功删除文件: {file_name}"
-                else:
-                    logger.error(f"删除失败：{file_name}")
-                    return f"删除文件失败: {file_name}"
-        logger.info(f"文件不存在：{file_name}")
-        return f"未找到文件: {file_name}"
+        found = find_file(file_name)
+        if found is None:
+            logger.info(f"文件不存在：{file_name}")
+            return f"未找到文件: {file_name}"
+        file_type, file = found
+        if delete_file(file_type, file):
+            logger.info(f"删除成功：{file_name}")
+            return f"成功删除文件: {file_name}"
+        else:
+            logger.error(f"删除失败：{file_name}")
+            return f"删除文件失败: {file_name}"
     except Exception as e:
         error_msg = f"删除文件时发生错误: {str(e)}"
         logger.error(error_msg, exc_info=True)
@@ -309,10 +322,6 @@ st.markdown(
 )
 st.title(ui_config.get('title', '小胰宝助手'))
 
-# 确保目录存在
-os.makedirs(config.get_upload_path(), exist_ok=True)
-os.makedirs(config.get_cache_path(), exist_ok=True)
-
 # 添加自定义 CSS 样式
 st.markdown("""
 <style>
@@ -431,11 +440,11 @@ with tabs[0]:
             st.markdown(query)
         
         # 调用聊天函数，更新会话状态
-        updated_history = chat_function(query, st.session_state.chat_messages)
+        updated_history = chat_function(query, st.session_state.chat_messages, get_session_id())
         st.session_state.chat_messages = updated_history
         
-        # 显示助手消息
-        if st.session_state.chat_messages and st.session_state.chat_messages[-1]["role"] == "assistant":
+        # 显示助手消息（流式模式下已在chat_function中逐块显示）
+        if not config.is_streaming_enabled() and st.session_state.chat_messages and st.session_state.chat_messages[-1]["role"] == "assistant":
             with st.chat_message("assistant"):
                 st.markdown(st.session_state.chat_messages[-1]["content"])
 
@@ -463,8 +472,8 @@ with tabs[1]:
 
 
 
-                image = Image.open(image_file)
-                st.image(image, caption="上传的图片", use_container_width=True)
+                # st.image 直接接收上传文件，无需先用PIL解码
+                st.image(image_file, caption="上传的图片", use_container_width=True)
                 image_type = st.selectbox("图片类型", list(prompts["analysis_prompts"].keys()))
                 
                 # 分析按钮组
@@ -473,16 +482,19 @@ with tabs[1]:
                     if st.button("分析图片", key="analyze_image_btn", use_container_width=True):
                         with st.spinner("分析中..."):
                             updated_history = analyze_image_chat(
-                                image,
                                 image_file,
                                 image_type,
                                 "",
                                 st.session_state.image_chat_messages
                             )
                             st.session_state.image_chat_messages = updated_history
+                        if config.is_streaming_enabled():
+                            # 流式输出已临时显示，重跑后统一在对话历史中展示
+                            st.rerun()
                 with col_clear:
                     if st.button("清除图片", key="clear_image_btn", use_container_width=True):
                         st.session_state.image_chat_messages = []
+                        image_conversations.reset(get_session_id())
                         st.rerun()
 
     # 右侧列：对话历史
@@ -516,10 +528,9 @@ with tabs[1]:
         
         # 检查是否按下回车键或点击发送按钮
         if (image_msg and image_msg != st.session_state.get('previous_msg', '')) or send_clicked:
-            if image and image_msg:
+            if image_file and image_msg:
                 with st.spinner("处理中..."):
                     updated_history = analyze_image_chat(
-                        image,
                         image_file,
                         image_type,
                         image_msg,
@@ -617,14 +628,20 @@ with tabs[2]:
                 col_analyze, col_clear = st.columns([1, 1])
                 with col_analyze:
                     if st.button("分析报告", key="analyze_report_btn", use_container_width=True):
-                        with st.spinner("分析中..."):
-                            updated_history = analyze_report_chat(pdf_file, "", st.session_state.report_chat_messages)
-                            st.session_state.report_chat_messages = updated_history
+                        updated_history = analyze_report_chat(pdf_file, "", st.session_state.report_chat_messages)
+                        st.session_state.report_chat_messages = updated_history
                 with col_clear:
                     if st.button("清除报告", key="clear_report_btn", use_container_width=True):
                         st.session_state.report_chat_messages = []
+                        st.session_state.pop('report_session', None)
+                        st.session_state.pop('report_job_id', None)
+                        st.query_params.pop('report_job', None)
                         st.rerun()
 
+            # 分析任务进行中时轮询进度（刷新页面后通过URL参数接上）
+            if get_report_job() is not None:
+                poll_report_job()
+
     # 右侧列：对话历史
     with col2:
         st.markdown("### 对话历史")
@@ -756,7 +773,8 @@ with tabs[3]:
     with st.container(): 
         # 标题和文件列表
         st.markdown("### 文件列表")
-        file_list_str = manage_files_ui()
+        file_page = st.number_input("页码", min_value=1, value=1, step=1, key="file_list_page")
+        file_list_str = manage_files_ui(file_page, refresh=st.session_state.pop("refresh_file_list", False))
         st.text_area("当前文件", value=file_list_str, height=300, key="file_list_display")
         
         # 操作区域
@@ -786,6 +804,8 @@ with tabs[3]:
             with col3:
                 st.write("")  # 添加空行以对齐
                 if st.button("刷新", key="refresh_list_btn", use_container_width=True):
+                    # 下次渲染时强制从远程刷新本地文件索引
+                    st.session_state.refresh_file_list = True
                     st.rerun()
             
             # 第四列：清理缓存按钮
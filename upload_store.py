@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+上传文件存储
+
+按内容寻址保存用户上传的文件：边分块读取边计算SHA-256，写入临时文件后原子地移动到
+uploads/blobs/<哈希前2位>/<哈希第3-4位>/<哈希>。存储路径只取决于内容，相同内容以不同
+扩展名（如 .jpg 与 .JPG/.jpeg）上传时也只保存一份，重复上传不再写盘；文件名（含扩展名）、
+类型、大小等元数据记录在 uploads/uploads.db（SQLite）中。
+保存耗时只与文件大小有关，与目录中已有文件的数量无关。
+"""
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import BinaryIO, NamedTuple, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path: str) -> str:
+    """分块计算本地文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StoredUpload(NamedTuple):
+    """一次保存的结果"""
+    sha256: str
+    path: str
+    size: int
+    original_name: str
+    mime_type: str
+    deduplicated: bool
+
+
+class UploadStore:
+    """内容寻址的上传存储类"""
+
+    DB_FILENAME = 'uploads.db'
+    BLOB_DIR = 'blobs'
+
+    def __init__(self, root: Optional[str] = None):
+        """
+        初始化存储
+        :param root: 存储根目录，默认使用 config.get_upload_path()
+        """
+        self.root = root or config.get_upload_path()
+        self.blob_root = os.path.join(self.root, self.BLOB_DIR)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """首次使用时才打开数据库"""
+        if self._db is None:
+            os.makedirs(self.blob_root, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.root, self.DB_FILENAME), check_same_thread=False)
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    path TEXT,
+                    size INTEGER,
+                    original_name TEXT,
+                    mime_type TEXT,
+                    created_at REAL,
+                    last_seen REAL,
+                    upload_count INTEGER
+                );
+            """)
+            conn.commit()
+            self._db = conn
+        return self._db
+
+    def blob_path(self, sha256: str) -> str:
+        """内容哈希对应的分片存储路径"""
+        return os.path.join(self.blob_root, sha256[:2], sha256[2:4], sha256)
+
+    def _existing_path(self, sha256: str) -> Optional[str]:
+        """已保存的内容的路径（兼容之前带扩展名保存、记录在数据库中的文件），不存在时返回None"""
+        path = self.blob_path(sha256)
+        if os.path.exists(path):
+            return path
+        stored = self.get(sha256)
+        return stored.path if stored is not None else None
+
+    def save_stream(self, stream: BinaryIO, original_name: str, mime_type: Optional[str] = None) -> StoredUpload:
+        """
+        分块读取文件对象并保存
+        :param stream: 可读的二进制文件对象（如Streamlit的UploadedFile）
+        :param original_name: 原始文件名，记录在元数据中
+        :param mime_type: 文件类型
+        """
+        start = time.perf_counter()
+        seekable = hasattr(stream, 'seek')
+        path = None
+        if seekable:
+            # 可回退的文件对象先只计算哈希，重复内容完全不写盘
+            stream.seek(0)
+            sha256, size = self._hash_stream(stream)
+            path = self._existing_path(sha256)
+        deduplicated = path is not None
+        if not deduplicated:
+            if seekable:
+                stream.seek(0)
+            sha256, size, path, deduplicated = self._write_blob(stream)
+
+        if seekable:
+            # 便于调用方（如st.image）继续读取同一个文件对象
+            stream.seek(0)
+        self._record(sha256, path, size, original_name, mime_type or '')
+        logger.info(f"上传文件已保存：{original_name} -> {path}（{size} 字节，"
+                    f"{'重复内容，未写盘' if deduplicated else '新内容'}，耗时 {(time.perf_counter() - start) * 1000:.1f}ms）")
+        return StoredUpload(sha256, path, size, original_name, mime_type or '', deduplicated)
+
+    @staticmethod
+    def _hash_stream(stream: BinaryIO):
+        """分块计算内容哈希，返回 (sha256, 字节数)"""
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+        return digest.hexdigest(), size
+
+    def _write_blob(self, stream: BinaryIO):
+        """边读取边计算哈希写入临时文件，再原子地移动到分片路径，返回 (sha256, 字节数, 路径, 是否已存在)"""
+        digest = hashlib.sha256()
+        size = 0
+        os.makedirs(self.blob_root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            path = self._existing_path(sha256)
+            exists = path is not None
+            if exists:
+                os.remove(tmp_path)
+            else:
+                path = self.blob_path(sha256)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return sha256, size, path, exists
+
+    def save_bytes(self, data: bytes, original_name: str, mime_type: Optional[str] = None) -> StoredUpload:
+        """保存内存中的字节"""
+        return self.save_stream(io.BytesIO(data), original_name, mime_type)
+
+    def save_file(self, source_path: str, original_name: Optional[str] = None,
+                  mime_type: Optional[str] = None) -> StoredUpload:
+        """保存本地文件（如Gradio提供的临时文件路径）"""
+        with open(source_path, 'rb') as f:
+            return self.save_stream(f, original_name or os.path.basename(source_path), mime_type)
+
+    def get(self, sha256: str) -> Optional[StoredUpload]:
+        """按内容哈希查询已保存的文件"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256, path, size, original_name, mime_type FROM blobs WHERE sha256 = ?",
+                (sha256,)).fetchone()
+        if row is None or not os.path.exists(row[1]):
+            return None
+        return StoredUpload(*row, deduplicated=True)
+
+    def _record(self, sha256: str, path: str, size: int, original_name: str, mime_type: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO blobs(sha256, path, size, original_name, mime_type, created_at, last_seen, upload_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT(sha256) DO UPDATE SET path = excluded.path, original_name = excluded.original_name, "
+                "last_seen = excluded.last_seen, upload_count = upload_count + 1",
+                (sha256, path, size, original_name, mime_type, now, now))
+            self._conn.commit()
+
+
+# 创建全局上传存储实例
+upload_store = UploadStore()
@@ -2,44 +2,24 @@ import gradio as gr
 import os
 import logging
 import sys
-from datetime import datetime
+import time
 from config import config
-import main
-from mange_filelist import list_all_files, delete_file, clear_all_cache
-import google.generativeai as genai
-from dotenv import load_dotenv
-import matplotlib
-# 设置matplotlib的日志级别为INFO，隐藏DEBUG信息
+from mange_filelist import list_all_files, count_files, find_file, delete_file, clear_all_cache
+from session_manager import ChatSessionManager
+from streaming import stream_call
+import gemini_gateway
+import admission
+from metrics import start_metrics_server
+from answer_cache import answer_cache
+from model_registry import init_models
+from upload_store import upload_store
+from image_session import image_conversations
+from report_jobs import report_jobs
+# 设置matplotlib（由gradio间接使用）的日志级别为INFO，隐藏DEBUG信息
 logging.getLogger('matplotlib').setLevel(logging.INFO)
 
-# 设置日志文件路径
-log_dir = "logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"webui_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-
-# 配置根日志记录器
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-
-# 创建文件处理器
-file_handler = logging.FileHandler(log_file, encoding='utf-8')
-file_handler.setLevel(logging.DEBUG)
-file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
-
-# 创建控制台处理器
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.DEBUG)
-console_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
-
-logger.info(f"日志文件路径：{log_file}")
-
-# 加载环境变量
-load_dotenv()
+# 日志由 config 初始化的进程级日志管道统一处理
+logger = logging.getLogger(__name__)
 
 def check_proxy(proxy_url: str, timeout: int = 5) -> bool:
     """检查代理是否可用"""
@@ -60,12 +40,6 @@ def check_proxy(proxy_url: str, timeout: int = 5) -> bool:
 def setup_gemini():
     """初始化Gemini配置"""
     try:
-        # 获取API密钥
-        api_key = os.getenv('GEMINI_API_KEY')
-        if not api_key:
-            logger.error("未找到GEMINI_API_KEY环境变量")
-            raise ValueError("请设置GEMINI_API_KEY环境变量")
-
         # 获取代理配置
         proxy_config = config.get_proxy_config()
         if proxy_config.get('enabled'):
@@ -79,35 +53,14 @@ def setup_gemini():
                 os.environ.pop('HTTP_PROXY', None)
                 os.environ.pop('HTTPS_PROXY', None)
 
-        # 配置Gemini
-        genai.configure(api_key=api_key)
+        # 配置Gemini并构建全部模型（进程级注册表，只构建一次）
+        models = init_models()
+        logger.info(f"模型初始化成功，耗时(ms): {models.timings()}")
+        start_metrics_server()
         
-        # 获取模型配置
-        model_config = config.get_model_config()
-        
-        # 初始化聊天模型
-        global chat_model  # 确保使用全局变量
-        chat_config = model_config.get('chat', {})
-        chat_model = genai.GenerativeModel(
-            model_name=chat_config.get('model_name', 'gemini-pro'),  # 使用gemini-pro模型
-            generation_config=genai.GenerationConfig(
-                temperature=chat_config.get('temperature', 0.7),
-                max_output_tokens=chat_config.get('max_output_tokens', 2048),
-            )
-        )
-        logger.info("聊天模型初始化成功")
-        
-        # 初始化视觉模型
-        global vision_model  # 确保使用全局变量
-        vision_config = model_config.get('vision', {})
-        vision_model = genai.GenerativeModel(
-            model_name=vision_config.get('model_name', 'gemini-pro-vision'),  # 使用gemini-pro-vision模型
-            generation_config=genai.GenerationConfig(
-                temperature=vision_config.get('temperature', 0.7),
-                max_output_tokens=vision_config.get('max_output_tokens', 2048),
-            )
-        )
-        logger.info("视觉模型初始化成功")
+        global chat_model, vision_model  # 确保使用全局变量
+        chat_model = models.get('chat')
+        vision_model = models.get('vision')
         
         return chat_model, vision_model
         
@@ -123,53 +76,70 @@ prompts = config.get_prompts()
 # 初始化全局变量
 chat_model = None
 vision_model = None
-chat_session = None  # 添加chat_session
+session_manager = None  # 按浏览器会话管理ChatSession
 
 # 初始化模型
 try:
     chat_model, vision_model = setup_gemini()
-    # 初始化聊天会话
-    chat_session = chat_model.start_chat(history=[])
-    logger.info("模型和聊天会话初始化成功")
+    session_manager = ChatSessionManager(chat_model)
+    logger.info("模型和会话管理器初始化成功")
 except Exception as e:
     logger.error(f"模型初始化失败: {e}")
     sys.exit(1)
 
-def chat(message: str, history: list) -> str:
-    """处理普通对话"""
+def chat(message: str, history: list, request: gr.Request):
+    """处理普通对话（生成器，流式模式下逐块产出累计的回复文本）"""
     try:
         logger.debug(f"chat函数被调用")
-        logger.info(f"开始处理普通对话，输入消息：{message}")
+        session_id = request.session_hash
+        logger.info(f"开始处理普通对话，会话：{session_id}，输入消息：{message}")
         
         if not message:
             logger.warning("输入消息为空")
-            return ""
-        
-        if not chat_session:
-            error_msg = "聊天会话未初始化"
-            logger.error(error_msg)
-            return error_msg
+            yield ""
+            return
             
-        # 使用chat_session发送消息
-        response = chat_session.send_message(prompts['chat'] + "\n\n用户问题：" + message)
+        # 使用当前浏览器会话对应的chat_session发送消息
+        chat_session = session_manager.get_session(session_id)
+        # 会话首轮的常见问题优先查询答案缓存，命中时不调用模型；
+        # 后续提问依赖上下文，既不查询也不写入缓存
+        first_turn = not chat_session.history
+        fingerprint = answer_cache.fingerprint(config.get_prompts()['chat'], config.get_model_config().get('chat', {}))
+        cached_answer = answer_cache.get(message, fingerprint) if first_turn else None
+        if cached_answer is not None:
+            logger.info(f"命中答案缓存，统计：{answer_cache.stats()}")
+            session_manager.append_turn(session_id, message, cached_answer)
+            yield cached_answer
+            return
+
+        if config.is_streaming_enabled():
+            response_text = ""
+            for text in stream_call("chat", chat_session.send_message, message):
+                response_text += text
+                yield response_text
+        else:
+            response = gemini_gateway.call("chat", chat_session.send_message, message)
+            response_text = response.text if response else ""
+            yield response_text
+        session_manager.update_usage(session_id, None if config.is_streaming_enabled() else response)
         
-        if not response:
+        if not response_text:
             error_msg = "模型未返回响应"
             logger.error(error_msg)
-            return error_msg
+            yield error_msg
+            return
             
-        response_text = response.text
         logger.info(f"收到回复：{response_text}")
-        
-        return response_text
+        if first_turn:
+            answer_cache.put(message, fingerprint, response_text)
         
     except Exception as e:
         error_msg = f"处理对话时发生错误: {str(e)}"
         logger.error(error_msg, exc_info=True)
-        return error_msg
+        yield error_msg
 
-def analyze_image_chat(image, image_type: str, message: str, history: list) -> list:
-    """处理图片分析和对话"""
+def analyze_image_chat(image, image_type: str, message: str, history: list, session_id: str = ""):
+    """处理图片分析和对话（生成器，流式模式下逐块更新对话历史）"""
     try:
         logger.debug(f"analyze_image_chat函数被调用")
         logger.info(f"开始处理图片分析，类型：{image_type}，消息：{message}")
@@ -177,12 +147,12 @@ def analyze_image_chat(image, image_type: str, message: str, history: list) -> l
         if image is None:
             logger.warning("未上传图片")
             history.append({"role": "assistant", "content": "请先上传图片"})
-            return history
+            yield history
+            return
         
-        # 保存图片到临时文件
-        temp_path = os.path.join(config.get_upload_path(), "temp_image.jpg")
-        image.save(temp_path)
-        logger.info(f"图片已保存到：{temp_path}")
+        # gr.Image(type="filepath") 提供的是Gradio的临时文件，按内容寻址转存到上传目录
+        temp_path = upload_store.save_file(image).path
+        logger.info(f"图片路径：{temp_path}")
         
         # 获取图片类型的配置
         image_config = config.get_image_type_prompt(image_type)
@@ -190,42 +160,40 @@ def analyze_image_chat(image, image_type: str, message: str, history: list) -> l
             error_msg = f"不支持的图片类型: {image_type}"
             logger.error(error_msg)
             history.append({"role": "assistant", "content": error_msg})
-            return history
-        
-        # 使用初始化好的视觉模型
-        # 上传图片到Gemini
-        image_file = main.upload_to_gemini(temp_path, mime_type=image_config['mime_type'])
-        logger.info("图片已上传到Gemini")
+            yield history
+            return
         
-        # 分析图片
-        if not message:
-            # 首次分析图片，使用特定类型的提示词
-            prompt = image_config['system_prompt']
-            logger.info(f"使用图片分析提示词：{prompt}")
-            response = vision_model.generate_content([image_file, prompt])
-        else:
-            # 继续对话，保持图片上下文
+        # 同一浏览器会话、同一图片的后续提问复用带图片上下文的对话，只发送问题文本；
+        # 点击“分析图片”（无问题）时重新开始
+        conversation = image_conversations.get(session_id, vision_model, temp_path, image_type,
+                                               restart=not message)
+        if message:
             logger.info(f"继续对话，消息：{message}")
-            response = vision_model.generate_content([image_file, message])
-        
-        response_text = response.text
-        logger.info(f"收到回复：{response_text}")
+            history.append({"role": "user", "content": message})
         
-        if not message:
-            history.append({"role": "assistant", "content": response_text})
+        if config.is_streaming_enabled():
+            reply = {"role": "assistant", "content": ""}
+            history.append(reply)
+            for text in conversation.stream(message):
+                reply["content"] += text
+                yield history
         else:
-            history.append({"role": "user", "content": message})
-            history.append({"role": "assistant", "content": response_text})
-        return history
+            history.append({"role": "assistant", "content": conversation.send(message)})
+            yield history
+        logger.info(f"收到回复：{history[-1]['content']}")
             
     except Exception as e:
         error_msg = f"分析图片时发生错误: {str(e)}"
         logger.error(error_msg, exc_info=True)
         history.append({"role": "assistant", "content": error_msg})
-        return history
+        yield history
 
-def analyze_report_chat(pdf_file, message: str, history: list) -> list:
-    """处理报告分析和对话"""
+def analyze_report_chat(pdf_file, message: str, history: list, job_id: str = ""):
+    """
+    处理报告分析和对话（生成器，逐步产出 (对话历史, 任务ID)）
+    报告分析在后台任务中执行（见 report_jobs），这里每秒查询一次进度；
+    后续提问通过任务得到的 ReportSession 只发送问题本身
+    """
     try:
         logger.debug(f"analyze_report_chat函数被调用")
         logger.info(f"开始处理报告分析，消息：{message}")
@@ -233,60 +201,63 @@ def analyze_report_chat(pdf_file, message: str, history: list) -> list:
         if pdf_file is None and not message:
             logger.warning("未上传报告")
             history.append({"role": "assistant", "content": "请先上传报告"})
-            return history
-            
-        model_config = config.get_model_config()['pdf']
-        logger.info(f"使用模型配置：{model_config}")
-        
-        model = genai.GenerativeModel(
-            model_config['model_name'],
-            generation_config=genai.types.GenerationConfig(
-                temperature=model_config['temperature'],
-                max_output_tokens=model_config['max_output_tokens']
-            )
-        )
+            yield history, job_id
+            return
             
+        job = report_jobs.get(job_id)
         if pdf_file is not None:
-            # 保存PDF到临时文件
-            temp_path = os.path.join(config.get_upload_path(), "temp_report.pdf")
-            with open(temp_path, "wb") as f:
-                f.write(pdf_file.read())
+            # gr.File(type="filepath") 提供本地路径，按内容寻址转存到上传目录
+            temp_path = upload_store.save_file(pdf_file, mime_type='application/pdf').path
             logger.info(f"报告已保存到：{temp_path}")
             
-            # 分析报告
-            cache = main.upload_pdf_and_cache(temp_path)
-            result = main.generate_content_from_cache(cache, prompts['report_analysis'])
-            logger.info(f"收到回复：{result}")
-            history.append({"role": "assistant", "content": result})
-        else:
-            # 继续对话
+            # 新报告或点击“分析报告”时提交分析任务，同一份报告已有任务时直接复用
+            if not message or job is None or job.pdf_path != temp_path:
+                job = report_jobs.submit(temp_path)
+                job_id = job.id
+                while not job.finished:
+                    yield history + [{"role": "assistant", "content": job.progress_text()}], job_id
+                    time.sleep(1)
+                content = job.summary if job.state == 'done' else job.progress_text()
+                logger.info(f"获取到的概要总结：{content}")
+                history.append({"role": "assistant", "content": content})
+                if not message:
+                    yield history, job_id
+                    return
+        
+        if message and job is not None and job.report is not None:
+            # 继续对话，只发送问题本身，报告内容由缓存提供
             logger.info(f"继续对话，消息：{message}")
-            response = model.generate_content(message)
-            response_text = response.text
+            response_text = job.report.ask(message)
             logger.info(f"收到回复：{response_text}")
             history.append({"role": "user", "content": message})
             history.append({"role": "assistant", "content": response_text})
-        return history
+        elif message:
+            logger.warning("没有已分析的报告")
+            history.append({"role": "assistant", "content": "请先上传报告再进行对话"})
+        yield history, job_id
         
     except Exception as e:
         error_msg = f"分析报告时发生错误: {str(e)}"
         logger.error(error_msg, exc_info=True)
         history.append({"role": "assistant", "content": error_msg})
-        return history
+        yield history, job_id
 
-def manage_files_ui() -> str:
-    """文件管理界面"""
+def manage_files_ui(page: int = 1, refresh: bool = False) -> str:
+    """文件管理界面（读取本地文件索引，按页显示）"""
     try:
         logger.debug(f"manage_files_ui函数被调用")
         logger.info("开始获取文件列表")
         
-        files = list_all_files()
+        page_size = config.get_file_inventory_config().get('page_size', 50)
+        page = max(1, int(page))
+        files = list_all_files(refresh=refresh, offset=(page - 1) * page_size, limit=page_size, verbose=False)
         if not files:
             logger.info("文件列表为空")
             return "当前没有已上传的文件"
             
-        result = "=== 已上传文件列表 ===\n"
-        for i, (file_type, file) in enumerate(files, 1):
+        total = count_files()
+        result = f"=== 已上传文件列表（共 {total} 个，第 {page}/{max(1, -(-total // page_size))} 页）===\n"
+        for i, (file_type, file) in enumerate(files, (page - 1) * page_size + 1):
             result += f"{i}. 文件名: {file.display_name}\n"
             result += f"   文件URI: {file.uri}\n"
             result += f"   类型: {file_type}\n"
@@ -305,17 +276,17 @@ def delete_file_ui(file_name: str) -> str:
         logger.debug(f"delete_file_ui函数被调用")
         logger.info(f"开始删除文件：{file_name}")
         
-        files = list_all_files()
-        for file_type, file in files:
-            if file.display_name == file_name:
-                if delete_file(file_type, file):
-                    logger.info(f"删除成功：{file_name}")
-                    return f"成功删除文件: {file_name}"
-                else:
-                    logger.error(f"删除失败：{file_name}")
-                    return f"删除文件失败: {file_name}"
-        logger.info(f"文件不存在：{file_name}")
-        return f"未找到文件: {file_name}"
+        found = find_file(file_name)
+        if found is None:
+            logger.info(f"文件不存在：{file_name}")
+            return f"未找到文件: {file_name}"
+        file_type, file = found
+        if delete_file(file_type, file):
+            logger.info(f"删除成功：{file_name}")
+            return f"成功删除文件: {file_name}"
+        else:
+            logger.error(f"删除失败：{file_name}")
+            return f"删除文件失败: {file_name}"
         
     except Exception as e:
         error_msg = f"删除文件时发生错误: {str(e)}"
@@ -345,8 +316,12 @@ with gr.Blocks(css=f"body {{ background-color: {ui_config['theme_color']}; }}")
     gr.Markdown(f"# {ui_config['title']}")
     
     with gr.Tab(ui_config["chat_title"]):
+        def chat_wrapper(message, history, request: gr.Request):
+            # 以浏览器会话为单位限流（见 admission.py）
+            yield from admission.iterate_as(request.session_hash, chat(message, history, request))
+        
         chat_interface = gr.ChatInterface(
-            fn=chat,
+            fn=chat_wrapper,
             title="医疗问答助手",
             description="我是一位专业的医生，可以用通俗易懂的方式解答医学相关的问题"
         )
@@ -377,10 +352,13 @@ with gr.Blocks(css=f"body {{ background-color: {ui_config['theme_color']}; }}")
             )
         
         # 绑定事件
-        def analyze_image_wrapper(image, image_type, message, history):
+        def analyze_image_wrapper(image, image_type, message, history, request: gr.Request):
             if not image:
-                return history + [{"role": "assistant", "content": "请先上传图片"}]
-            return analyze_image_chat(image, image_type, message, history)
+                yield history + [{"role": "assistant", "content": "请先上传图片"}]
+                return
+            yield from admission.iterate_as(
+                request.session_hash,
+                analyze_image_chat(image, image_type, message, history, request.session_hash))
         
         image_submit.click(
             analyze_image_wrapper,
@@ -417,18 +395,25 @@ with gr.Blocks(css=f"body {{ background-color: {ui_config['theme_color']}; }}")
                     report_submit = gr.Button("分析报告")
                     report_clear = gr.Button("清除对话")
         
+                # 当前会话的报告分析任务ID
+                report_job = gr.State("")
+        
         # 绑定事件
+        def analyze_report_wrapper(pdf_file, message, history, job_id, request: gr.Request):
+            yield from admission.iterate_as(request.session_hash,
+                                            analyze_report_chat(pdf_file, message, history, job_id))
+        
         report_submit.click(
-            analyze_report_chat,
-            inputs=[pdf_input, report_msg, report_chatbot],
-            outputs=[report_chatbot]
+            analyze_report_wrapper,
+            inputs=[pdf_input, report_msg, report_chatbot, report_job],
+            outputs=[report_chatbot, report_job]
         )
         report_msg.submit(
-            analyze_report_chat,
-            inputs=[pdf_input, report_msg, report_chatbot],
-            outputs=[report_chatbot]
+            analyze_report_wrapper,
+            inputs=[pdf_input, report_msg, report_chatbot, report_job],
+            outputs=[report_chatbot, report_job]
         )
-        report_clear.click(lambda: None, None, report_chatbot, queue=False)
+        report_clear.click(lambda: (None, ""), None, [report_chatbot, report_job], queue=False)
         
     with gr.Tab(ui_config['file_title']):
         with gr.Column():
@@ -443,12 +428,14 @@ with gr.Blocks(css=f"body {{ background-color: {ui_config['theme_color']}; }}")
                     label="文件名",
                     placeholder="输入要删除的文件名"
                 )
+                file_page = gr.Number(label="页码", value=1, minimum=1, precision=0)
                 delete_btn = gr.Button("删除文件")
                 refresh_btn = gr.Button("刷新列表")
                 clear_cache_btn = gr.Button("清理缓存")
             
             delete_btn.click(delete_file_ui, [file_name], [file_list])
-            refresh_btn.click(manage_files_ui, None, [file_list])
+            refresh_btn.click(lambda page: manage_files_ui(page, refresh=True), [file_page], [file_list])
+            file_page.change(manage_files_ui, [file_page], [file_list])
             clear_cache_btn.click(clear_cache_ui, None, [file_list])
             
     # 创建必要的目录
@@ -456,11 +443,11 @@ with gr.Blocks(css=f"body {{ background-color: {ui_config['theme_color']}; }}")
     os.makedirs(config.get_cache_path(), exist_ok=True)
     
     logger.info("Gradio Web UI 初始化完成")
-    
-    # 启动Gradio应用
-    demo.launch(server_port=7070, server_name="0.0.0.0", share=True)
 
 if __name__ == "__main__":
     # 确保上传和缓存目录存在
     os.makedirs(config.get_upload_path(), exist_ok=True)
     os.makedirs(config.get_cache_path(), exist_ok=True)
+
+    # 启动Gradio应用（只在直接运行时启动，导入本模块不会占用端口或打开分享链接）
+    demo.launch(server_port=7070, server_name="0.0.0.0", share=True)